@@ -2,25 +2,483 @@
 
 from __future__ import print_function
 
+import os
 import sys
+import time
+import threading
+import multiprocessing
 import argparse
 import sqlite3
 import bz2
 import gzip
-# import json
+import json
 import datetime as D
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 def logTime(chkpoint):
     print('*** Checkpoint: {} at \x1b[31m{}\x1b[0m'.format(chkpoint, D.datetime.now()))
     sys.stdout.flush()
 
 
+# Pragmas applied with --fast-load. Every load runs in a single transaction,
+# so the journal only needs to support a rollback, not a crash.
+FAST_LOAD_PRAGMAS = [
+    ('page_size', '65536'),
+    ('journal_mode', 'MEMORY'),
+    ('synchronous', 'OFF'),
+    ('cache_size', '-1048576'),
+    ('temp_store', 'MEMORY'),
+    ('locking_mode', 'EXCLUSIVE'),
+]
+
+# Pragmas of the shard databases written with --shards. They are removed
+# once merged, so they need no journal at all.
+SHARD_PRAGMAS = [
+    ('page_size', '65536'),
+    ('journal_mode', 'OFF'),
+    ('synchronous', 'OFF'),
+    ('cache_size', '-65536'),
+    ('temp_store', 'MEMORY'),
+    ('locking_mode', 'EXCLUSIVE'),
+]
+
+
+def loadPragmas(fastLoad, overrides):
+    '''Returns the (name, value) pragmas to use while loading: the fast load
+    profile if requested, with the NAME=VALUE overrides applied on top.'''
+    pragmas = list(FAST_LOAD_PRAGMAS) if fastLoad else []
+    for override in overrides:
+        name, value = override.split('=', 1)
+        names = [x for x, _ in pragmas]
+        if name in names:
+            pragmas[names.index(name)] = (name, value)
+        else:
+            pragmas.append((name, value))
+    return pragmas
+
+
+def applyPragmas(conn, pragmas):
+    '''Sets the (name, value) pragmas and returns their previous values.
+
+    The page_size is a property of the database file and is not returned.'''
+    previous = []
+    for name, value in pragmas:
+        if name != 'page_size':
+            previous.append((name, conn.execute('PRAGMA %s' % name).fetchone()[0]))
+        conn.execute('PRAGMA %s = %s' % (name, value))
+    return previous
+
+
+def dropIndexes(conn, indexes):
+    '''Drops the indexes which createIndexes builds, so that they are not
+    updated row by row while loading into existing tables.'''
+    for table, column in indexes:
+        conn.execute('DROP INDEX IF EXISTS "idx_%s_%s"' % (table, column))
+
+
+def createIndexes(conn, indexes):
+    '''Builds an index on each (table, column) pair, reporting the time
+    each of them took.'''
+    for table, column in indexes:
+        start = D.datetime.now()
+        conn.execute('CREATE INDEX IF NOT EXISTS "idx_%s_%s" ON "%s" ("%s")' %
+                     (table, column, table, column))
+        conn.commit()
+        logTime('Created index on {}.{} in {:.2f}s'.format(
+            table, column, (D.datetime.now() - start).total_seconds()))
+
+
+def readCheckpoint(conn, target, inputName):
+    '''Returns the (offset, records) stored by the last commit of inputName
+    into target, or (0, 0) if there is none.'''
+    conn.execute('CREATE TABLE IF NOT EXISTS _checkpoints '
+                 '("target" TEXT, "input" TEXT, "offset" INTEGER, '
+                 '"records" INTEGER, "time" TEXT, PRIMARY KEY ("target", "input"))')
+    checkpoint = conn.execute('SELECT "offset", "records" FROM _checkpoints '
+                              'WHERE "target" = ? AND "input" = ?',
+                              (target, inputName)).fetchone()
+    return checkpoint if checkpoint is not None else (0, 0)
+
+
+def writeCheckpoint(conn, target, inputName, offset, records):
+    '''Commits, storing the input offset and the number of records read so
+    far in the same transaction.'''
+    conn.execute('INSERT OR REPLACE INTO _checkpoints VALUES (?, ?, ?, ?, ?)',
+                 (target, inputName, offset, records, str(D.datetime.now())))
+    conn.commit()
+    logTime('Committed {} records'.format(records))
+
+
+class BackgroundReader(object):
+    '''Reads the lines of a (compressed) file in a background thread.
+
+    The thread reads blocks of about blockSize bytes of lines ahead of the
+    consumer and hands them over through a queue of at most depth blocks, so
+    that decompression overlaps with parsing and inserting. Supports
+    readline(), iteration and tell().'''
+
+    def __init__(self, inputFile, depth, blockSize=1 << 20):
+        # Keep the file open after the thread has read it to the end.
+        self.inputFile = inputFile
+        self.queue = queue.Queue(depth)
+        self.depth = depth
+        self.eof = ''
+        self.lines, self.index = [], 0
+        self.finished = False
+        try:
+            self.position = inputFile.tell()
+        except (IOError, OSError, ValueError):
+            self.position = 0
+        self.blocks, self.totalDepth = 0, 0
+        self.consumerWaits, self.readerWaits = 0, 0
+        # A Progress which counts the time spent waiting for lines as read.
+        self.progress = None
+        thread = threading.Thread(target=self.readBlocks,
+                                  args=(inputFile, blockSize))
+        thread.daemon = True
+        thread.start()
+
+    def readBlocks(self, inputFile, blockSize):
+        try:
+            while True:
+                lines = inputFile.readlines(blockSize)
+                self.put(lines)
+                if len(lines) == 0:
+                    break
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.readerWaits += 1
+            self.queue.put(item)
+
+    def nextBlock(self):
+        if self.finished:
+            return False
+
+        try:
+            item = self.queue.get_nowait()
+        except queue.Empty:
+            self.consumerWaits += 1
+            if self.progress is not None:
+                self.progress.enter('read')
+            item = self.queue.get()
+            if self.progress is not None:
+                self.progress.leave()
+
+        if isinstance(item, Exception):
+            raise item
+
+        self.blocks += 1
+        self.totalDepth += self.queue.qsize()
+        self.lines, self.index = item, 0
+        self.finished = len(item) == 0
+        if not self.finished:
+            # readline returns an empty line of the same type at the end.
+            self.eof = item[0][:0]
+        return not self.finished
+
+    def readline(self):
+        if self.index == len(self.lines) and not self.nextBlock():
+            return self.eof
+
+        line = self.lines[self.index]
+        self.index += 1
+        self.position += len(line)
+        return line
+
+    def __iter__(self):
+        while self.index < len(self.lines) or self.nextBlock():
+            line = self.lines[self.index]
+            self.index += 1
+            self.position += len(line)
+            yield line
+
+    def tell(self):
+        return self.position
+
+    def report(self):
+        '''Logs how full the queue was. A nearly empty queue means that reading
+        is the bottleneck, a nearly full one that the import is.'''
+        logTime('Read {} blocks ahead: average queue depth {:.1f} of {}, '
+                'import waited {} times, reader waited {} times'.format(
+                    self.blocks, float(self.totalDepth) / max(self.blocks, 1),
+                    self.depth, self.consumerWaits, self.readerWaits))
+
+
 def JSONReader(file_obj):
     '''Returns a parsed JSON object per line of the file_obj passed.'''
-    for line in file_obj:
+    # Read with readline, so that file_obj.tell() stays exact.
+    for line in iter(file_obj.readline, ''):
         yield eval(line)
 
 
+STAGES = ['read', 'parse', 'convert', 'insert', 'merge', 'other']
+
+
+class Progress(object):
+    '''Measures the throughput of a load and where its time goes.
+
+    The time is split between the stages entered with enter() or by
+    iterating through timed(); the stages nest, and the time outside of any
+    stage counts as other. Reading only counts the time spent waiting for a
+    BackgroundReader; otherwise it is part of parsing.
+
+    Every `every` seconds, count() logs the records per second, the bytes
+    per second of the uncompressed and the compressed input, how much of the
+    input has been consumed with an estimate of the time left, and the share
+    of each stage.'''
+
+    def __init__(self, every=30, totalBytes=None, tell=None, compressedTell=None,
+                 compressed=False):
+        self.every = every
+        # The share consumed of a compressed input is only known from the
+        # position in the compressed file.
+        self.totalBytes = totalBytes if compressedTell is not None or not compressed else None
+        self.tell, self.compressedTell = tell, compressedTell
+        self.records = 0
+        self.firstPosition = self.position(tell) or 0
+        self.firstCompressed = self.position(compressedTell) or 0
+        self.started = self.mark = self.logged = time.time()
+        self.stack = ['other']
+        self.stages = dict((x, 0.0) for x in STAGES)
+
+    def enter(self, stage):
+        now = time.time()
+        self.stages[self.stack[-1]] += now - self.mark
+        self.mark = now
+        self.stack.append(stage)
+
+    def leave(self):
+        now = time.time()
+        self.stages[self.stack.pop()] += now - self.mark
+        self.mark = now
+
+    def timed(self, iterable, stage):
+        '''Yields the items of iterable, counting the time taken to get them
+        as stage. Does what enter() and leave() do, inline, as it runs for
+        every record.'''
+        stages, stack, clock = self.stages, self.stack, time.time
+        iterator = iter(iterable)
+        while True:
+            now = clock()
+            stages[stack[-1]] += now - self.mark
+            self.mark = now
+            stack.append(stage)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                now = clock()
+                stages[stack.pop()] += now - self.mark
+                self.mark = now
+            yield item
+
+    def count(self):
+        self.records += 1
+        if self.every > 0 and self.records % 100 == 0 and \
+                time.time() - self.logged >= self.every:
+            self.log()
+
+    def position(self, tell):
+        try:
+            return tell() if tell is not None else None
+        except (IOError, OSError, ValueError):
+            return None
+
+    def stats(self):
+        '''Returns the statistics of this run so far as a dictionary. The
+        bytes are counted from where the run started.'''
+        now = time.time()
+        seconds = max(now - self.started, 1e-6)
+        stages = dict(self.stages)
+        stages[self.stack[-1]] += now - self.mark
+        stats = {
+            'records': self.records,
+            'seconds': seconds,
+            'records_per_second': self.records / seconds,
+            'stage_seconds': stages,
+        }
+        uncompressed = self.position(self.tell)
+        if uncompressed is not None:
+            stats['bytes'] = uncompressed - self.firstPosition
+            stats['bytes_per_second'] = stats['bytes'] / seconds
+        compressed = self.position(self.compressedTell)
+        if compressed is not None:
+            stats['compressed_bytes'] = compressed - self.firstCompressed
+            stats['compressed_bytes_per_second'] = stats['compressed_bytes'] / seconds
+
+        if self.compressedTell is not None:
+            consumed, rate = compressed, stats.get('compressed_bytes_per_second')
+        else:
+            consumed, rate = uncompressed, stats.get('bytes_per_second')
+        if consumed is not None and self.totalBytes:
+            stats['consumed'] = min(float(consumed) / self.totalBytes, 1.0)
+            if rate > 0:
+                stats['eta_seconds'] = max(self.totalBytes - consumed, 0) / rate
+        return stats
+
+    def log(self):
+        stats = self.stats()
+        parts = ['{} records ({:.0f}/s)'.format(stats['records'], stats['records_per_second'])]
+        if 'bytes' in stats:
+            parts.append('{:.1f} MB ({:.2f} MB/s)'.format(
+                stats['bytes'] / 1e6, stats['bytes_per_second'] / 1e6))
+        if 'compressed_bytes' in stats:
+            parts.append('{:.1f} MB compressed ({:.2f} MB/s)'.format(
+                stats['compressed_bytes'] / 1e6, stats['compressed_bytes_per_second'] / 1e6))
+        if 'consumed' in stats:
+            parts.append('{:.1f}% of the input'.format(100 * stats['consumed']))
+        if 'eta_seconds' in stats:
+            parts.append('ETA {}'.format(D.timedelta(seconds=int(stats['eta_seconds']))))
+        stages = stats['stage_seconds']
+        total = max(sum(stages.values()), 1e-6)
+        parts.append(' '.join('{} {:.0f}%'.format(x, 100 * stages[x] / total)
+                              for x in STAGES if stages[x] > 0))
+        logTime(', '.join(parts))
+        self.logged = time.time()
+
+    def write(self, fileName):
+        '''Writes the statistics as JSON.'''
+        with open(fileName, 'w') as statsFile:
+            json.dump(self.stats(), statsFile, indent=2, sort_keys=True)
+
+
+def compressedTell(inputFile):
+    '''Returns the tell function of the compressed file which inputFile
+    decompresses, or None if it is not exposed, as for bz2 in Python 2.'''
+    rawFile = getattr(inputFile, 'fileobj', None) or getattr(inputFile, '_fp', None)
+    return rawFile.tell if rawFile is not None else None
+
+
+def inputSize(fileName):
+    '''Returns the size of the input file, or None for stdin.'''
+    try:
+        return os.path.getsize(fileName) if fileName != '-' else None
+    except OSError:
+        return None
+
+
+def writeShard(shardFile, tables, chunks, results, insertChunk):
+    '''Creates the (table, columns) tables in the shard database and inserts
+    the chunks taken from the chunks queue with insertChunk(cur, chunk),
+    until it gets None.
+
+    Puts the error which stopped the writer, or None, into the results
+    queue. After an error, the remaining chunks are taken but not inserted.'''
+    failure = None
+    try:
+        conn = sqlite3.connect(shardFile)
+        applyPragmas(conn, SHARD_PRAGMAS)
+        conn.text_factory = str
+        cur = conn.cursor()
+        for table, columns in tables:
+            cur.execute('CREATE TABLE %s (%s)' % (table, columns))
+    except Exception as e:
+        failure = '%s: %s' % (shardFile, e)
+
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            break
+        if failure is not None:
+            continue
+
+        try:
+            insertChunk(cur, chunk)
+        except Exception as e:
+            failure = '%s: %s' % (shardFile, e)
+
+    if failure is None:
+        try:
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            failure = '%s: %s' % (shardFile, e)
+    results.put(failure)
+
+
+def checkWriters(writers, exitcodes):
+    '''Raises RuntimeError if one of the writer processes, whose exit codes
+    were exitcodes, crashed or was killed, or if all of them are gone.'''
+    for writer, exitcode in zip(writers, exitcodes):
+        if exitcode not in (None, 0):
+            raise RuntimeError('The shard writer %s exited with code %d' % (writer.name, exitcode))
+    if all(exitcode is not None for exitcode in exitcodes):
+        raise RuntimeError('The shard writers exited without reporting')
+
+
+def writeShards(shardFiles, chunks, tables, insertChunk, progress=None):
+    '''Inserts the (first, lines, records) chunks into the tables of the
+    shard databases, each written by a process of its own, which take the
+    chunks from a common queue.
+
+    Raises ValueError if a writer failed, and RuntimeError if a writer died,
+    rather than waiting on it forever.'''
+    queued = multiprocessing.Queue(2 * len(shardFiles))
+    results = multiprocessing.Queue()
+    writers = [multiprocessing.Process(target=writeShard,
+                                       args=(shardFile, tables, queued, results,
+                                             insertChunk))
+               for shardFile in shardFiles]
+    for writer in writers:
+        writer.daemon = True
+        writer.start()
+
+    def put(chunk):
+        while True:
+            exitcodes = [writer.exitcode for writer in writers]
+            try:
+                queued.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                checkWriters(writers, exitcodes)
+
+    for chunk in chunks:
+        if progress is not None:
+            for _ in range(chunk[2]):
+                progress.count()
+        put(chunk)
+    for writer in writers:
+        put(None)
+
+    # The exit codes are read before waiting, so that a writer which reported
+    # and then exited has its outcome in results already.
+    outcomes = []
+    while len(outcomes) < len(writers):
+        exitcodes = [writer.exitcode for writer in writers]
+        try:
+            outcomes.append(results.get(timeout=1))
+        except queue.Empty:
+            checkWriters(writers, exitcodes)
+    for writer in writers:
+        writer.join()
+
+    failures = [failure for failure in outcomes if failure is not None]
+    if len(failures) > 0:
+        raise ValueError(failures[0])
+
+
+def mergeShards(cur, tableNames, shardNames):
+    '''Copies the rows of the tables in the attached shard databases into the
+    tables of the main database.'''
+    for shardName in shardNames:
+        rows = 0
+        for table in tableNames:
+            cur.execute('INSERT INTO main.%s SELECT * FROM %s.%s' % (
+                table, shardName, table))
+            rows += cur.rowcount
+        logTime('Merged {} rows from shard {}'.format(rows, shardName))
+
+
 argParser = argparse.ArgumentParser()
 argParser.add_argument('metadata',
         help='The file which contains the json data fields '
@@ -29,6 +487,57 @@ argParser.add_argument('sqlitedb',
         help='The database file which should be populated. '
              'This file will be created if it does not exist.')
 
+argParser.add_argument('--fast-load',
+        help='Apply a pragma profile for bulk loading (in-memory journal, '
+             'no syncing, large cache, exclusive lock) while inserting. '
+             'The previous settings are restored after the commit.',
+        action='store_true')
+argParser.add_argument('--pragma',
+        help='Set a pragma while loading, given as NAME=VALUE, e.g. '
+             'synchronous=FULL. Overrides the --fast-load profile. '
+             'May be repeated.',
+        action='append',
+        default=[])
+argParser.add_argument('--index',
+        help='Build an index on TABLE.COLUMN after all rows have been '
+             'loaded. May be repeated.',
+        action='append',
+        default=[])
+argParser.add_argument('--no-default-indexes',
+        help='Do not build the default indexes of this script.',
+        action='store_true')
+argParser.add_argument('--commit-every',
+        help='Commit after every N lines, storing the input offset reached '
+             'so that the load can be continued with --resume.',
+        type=int,
+        default=0)
+argParser.add_argument('--resume',
+        help='Continue after the last commit of an earlier run with '
+             '--commit-every on the same input.',
+        action='store_true')
+argParser.add_argument('--read-ahead',
+        help='Number of blocks of about 1 MB of lines which a background '
+             'thread decompresses ahead of the import, with --gzip or --bz2. '
+             '0 decompresses inline.',
+        type=int,
+        default=16)
+argParser.add_argument('--shards',
+        help='Number of processes which parse and insert the products into '
+             'shard databases of their own next to the database, which are '
+             'merged into it at the end with ATTACH and INSERT ... SELECT. '
+             'Cannot be combined with --commit-every or --resume.',
+        type=int,
+        default=0)
+argParser.add_argument('--progress',
+        help='Log the throughput, the share of the input consumed and where '
+             'the time goes every N seconds. 0 only logs them at the end.',
+        type=int,
+        default=30)
+argParser.add_argument('--stats',
+        help='Write the throughput and timing statistics of the load to this '
+             'file as JSON at the end.',
+        default=None)
+
 group = argParser.add_mutually_exclusive_group()
 group.add_argument('--gzip',
         help='Assume file uses the gzip compression.',
@@ -38,6 +547,8 @@ group.add_argument('--bz2',
         action='store_true')
 
 args = argParser.parse_args()
+if args.shards > 0 and (args.commit_every > 0 or args.resume):
+    argParser.error('--shards cannot be combined with --commit-every or --resume')
 
 inputFile = None
 if args.bz2:
@@ -46,6 +557,7 @@ elif args.gzip:
     inputFile = gzip.open(args.metadata, 'rU')
 else:
     inputFile = open(args.metadata, 'rU')
+rawTell = compressedTell(inputFile)
 
 
 # asin - ID of the product, e.g. 0000031852
@@ -86,65 +598,154 @@ columns_sales_rank = '"asin" TEXT, "area" TEXT, "rank" INTEGER'
 insert_sales_rank = 'INSERT INTO %s VALUES (?, ?, ?)' % (table_sales_rank,)
 
 conn = sqlite3.connect(args.sqlitedb)
+previousPragmas = applyPragmas(conn, loadPragmas(args.fast_load, args.pragma))
 
 # Always return bytestring
 conn.text_factory = str
 
 cur = conn.cursor()
 
-for (table, columns) in [(table_metadata, columns_metadata),
-                         (table_also_bought, columns_also_bought),
-                         (table_also_viewed, columns_also_viewed),
-                         (table_bought_together, columns_bought_together),
-                         (table_buy_after_viewing, columns_buy_after_viewing),
-                         (table_categories, columns_categories),
-                         (table_sales_rank, columns_sales_rank)]:
+tables = [(table_metadata, columns_metadata),
+          (table_also_bought, columns_also_bought),
+          (table_also_viewed, columns_also_viewed),
+          (table_bought_together, columns_bought_together),
+          (table_buy_after_viewing, columns_buy_after_viewing),
+          (table_categories, columns_categories),
+          (table_sales_rank, columns_sales_rank)]
+
+for (table, columns) in tables:
     try:
         cur.execute('CREATE TABLE %s (%s)' % (table, columns))
         logTime('Created table {}'.format(table))
     except:
         logTime('Skipping table {}'.format(table))
 
+default_indexes = [(table_metadata, 'asin'),
+                   (table_also_bought, 'asin'),
+                   (table_also_viewed, 'asin'),
+                   (table_bought_together, 'asin'),
+                   (table_buy_after_viewing, 'asin'),
+                   (table_categories, 'asin'),
+                   (table_sales_rank, 'asin')]
+indexes = ([] if args.no_default_indexes else default_indexes) + \
+          [tuple(x.split('.', 1)) for x in args.index]
+dropIndexes(conn, indexes)
+
+shardFiles = ['%s.shard%d' % (args.sqlitedb, x) for x in range(args.shards)]
+shardNames = ['shard%d' % x for x in range(args.shards)]
+for shardFile in shardFiles:
+    if os.path.exists(shardFile):
+        os.remove(shardFile)
+attached = []
+
+checkpointing = args.commit_every > 0 or args.resume
+offset, records = 0, 0
+if checkpointing:
+    lastCheckpoint = readCheckpoint(conn, 'amz', args.metadata)
+    if args.resume:
+        offset, records = lastCheckpoint
+        inputFile.seek(offset)
+        logTime('Resuming after line {}'.format(records))
+
+if (args.bz2 or args.gzip) and args.read_ahead > 0:
+    inputFile = BackgroundReader(inputFile, args.read_ahead)
+
+progress = Progress(args.progress, inputSize(args.metadata), inputFile.tell, rawTell,
+                    compressed=args.bz2 or args.gzip)
+if isinstance(inputFile, BackgroundReader):
+    inputFile.progress = progress
+
 def getMaybe(json, field):
     return json[field] if field in json else None
 
-line = 0
-try:
-    for jsonElem in JSONReader(inputFile):
-        line += 1
-        try:
-            metadata = [getMaybe(jsonElem, x) for x in ['asin', 'imUrl', 'title', 'description', 'price', 'brand']]
-            if metadata[-2] is not None:
-                metadata[-2] = float(metadata[-2])
 
-            cur.execute(insert_metadata, metadata)
-            asin = jsonElem['asin']
+def insertProduct(cur, jsonElem):
+    '''Inserts the metadata of the product and its related products, sales
+    ranks and categories.'''
+    metadata = [getMaybe(jsonElem, x) for x in ['asin', 'imUrl', 'title', 'description', 'price', 'brand']]
+    if metadata[-2] is not None:
+        metadata[-2] = float(metadata[-2])
+
+    cur.execute(insert_metadata, metadata)
+    asin = jsonElem['asin']
+
+    related = getMaybe(jsonElem, 'related')
+
+    if related is not None:
+        if 'also_bought' in related:
+            cur.executemany(insert_also_bought, ((asin, x) for x in related['also_bought']))
+
+        if 'also_viewed' in related:
+            cur.executemany(insert_also_viewed, ((asin, x) for x in related['also_viewed']))
+
+        if 'bought_together' in related:
+            cur.executemany(insert_bought_together, ((asin, x) for x in related['bought_together']))
 
-            related = getMaybe(jsonElem, 'related')
+        if 'buy_after_viewing' in related:
+            cur.executemany(insert_buy_after_viewing, ((asin, x) for x in related['buy_after_viewing']))
 
-            if related is not None:
-                if 'also_bought' in related:
-                    cur.executemany(insert_also_bought, ((asin, x) for x in related['also_bought']))
+    salesRank = getMaybe(jsonElem, 'salesRank')
+    if salesRank is not None:
+        cur.executemany(insert_sales_rank, ((asin, k, v) for k, v in salesRank.items()))
 
-                if 'also_viewed' in related:
-                    cur.executemany(insert_also_viewed, ((asin, x) for x in related['also_viewed']))
+    categories = getMaybe(jsonElem, 'categories')
+    if categories is not None:
+        cur.executemany(insert_categories, ((asin, c) for c in categories[0]))
 
-                if 'bought_together' in related:
-                    cur.executemany(insert_bought_together, ((asin, x) for x in related['bought_together']))
 
-                if 'buy_after_viewing' in related:
-                    cur.executemany(insert_buy_after_viewing, ((asin, x) for x in related['buy_after_viewing']))
+def lineChunks(inputFile, chunkSize=10000):
+    '''Groups the lines of the file into (firstLine, lines, count) chunks of
+    chunkSize lines.'''
+    firstLine, lines = 1, []
+    for text in iter(inputFile.readline, ''):
+        lines.append(text)
+        if len(lines) == chunkSize:
+            yield firstLine, lines, len(lines)
+            firstLine, lines = firstLine + len(lines), []
+    if len(lines) > 0:
+        yield firstLine, lines, len(lines)
 
-            salesRank = getMaybe(jsonElem, 'salesRank')
-            if salesRank is not None:
-                cur.executemany(insert_sales_rank, ((asin, k, v) for k, v in salesRank.items()))
 
-            categories = getMaybe(jsonElem, 'categories')
-            if categories is not None:
-                cur.executemany(insert_categories, ((asin, c) for c in categories[0]))
+def insertProducts(cur, chunk):
+    '''Inserts the products of a (firstLine, lines, count) chunk.'''
+    firstLine, lines, _ = chunk
+    for line, text in enumerate(lines, firstLine):
+        try:
+            insertProduct(cur, eval(text))
+        except Exception, e:
+            raise ValueError('Error on line %d: %s' % (line, e))
+
+
+line = records
+progress.enter('insert')
+try:
+    if args.shards > 0:
+        logTime('Writing {} shards'.format(args.shards))
+        writeShards(shardFiles, lineChunks(inputFile), tables, insertProducts, progress)
+        # The shards are attached once written, as this connection could
+        # keep them locked otherwise.
+        for shardFile, shardName in zip(shardFiles, shardNames):
+            conn.execute('ATTACH DATABASE ? AS %s' % shardName, (shardFile,))
+            attached.append(shardName)
+        progress.enter('merge')
+        mergeShards(cur, [table for table, _ in tables], shardNames)
+        progress.leave()
+        products = []
+    else:
+        products = progress.timed(JSONReader(inputFile), 'parse')
+
+    for jsonElem in products:
+        line += 1
+        progress.count()
+        try:
+            insertProduct(cur, jsonElem)
         except Exception, e:
             print("Error on line %d: %s" % (line, e), file=sys.stderr)
             raise e
+
+        if args.commit_every > 0 and line % args.commit_every == 0:
+            writeCheckpoint(conn, 'amz', args.metadata, inputFile.tell(), line)
+
 except Exception, e:
     print('General error on line %d: %s' % (line, e), file=sys.stderr)
     logTime('Rolling back changes')
@@ -152,8 +753,28 @@ except Exception, e:
     cur.close()
 else:
     logTime('Committing to disk')
-    conn.commit()
+    if checkpointing:
+        writeCheckpoint(conn, 'amz', args.metadata, inputFile.tell(), line)
+    else:
+        conn.commit()
     cur.close()
 
+progress.leave()
+progress.log()
+if isinstance(inputFile, BackgroundReader):
+    inputFile.report()
+
+for shardName in attached:
+    conn.execute('DETACH DATABASE %s' % shardName)
+for shardFile in shardFiles:
+    if os.path.exists(shardFile):
+        os.remove(shardFile)
+
+createIndexes(conn, indexes)
+applyPragmas(conn, previousPragmas)
+
+if args.stats is not None:
+    progress.write(args.stats)
+
 logTime('Finished')
 
@@ -0,0 +1,568 @@
+#!/usr/bin/env python
+'''Benchmarks the importers on synthetic inputs.
+
+Generates inputs shaped like each supported dataset, runs the importer on
+the plain, gzip and bz2 versions of it and writes the rows per second, the
+peak memory of the importer and the size of the database as JSON, so that
+runs on different versions of the scripts can be compared.
+
+The inputs are generated once per size and seed in the work directory and
+reused by later runs.'''
+
+from __future__ import print_function
+import argparse
+import bz2
+import datetime as D
+import gzip
+import json
+import os
+import random
+import shlex
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+
+WORDS = ['the', 'of', 'and', 'a', 'to', 'in', 'is', 'you', 'that', 'it',
+         'he', 'was', 'for', 'on', 'are', 'as', 'with', 'his', 'they', 'at',
+         'be', 'this', 'have', 'from', 'or', 'one', 'had', 'by', 'word', 'but',
+         'not', 'what', 'all', 'were', 'we', 'when', 'your', 'can', 'said',
+         'there', 'use', 'an', 'each', 'which', 'she', 'do', 'how', 'their',
+         'if', 'will', 'up', 'other', 'about', 'out', 'many', 'then', 'them',
+         'sqlite', 'python', 'data', 'import', 'table', 'query', 'index']
+
+SUBREDDITS = ['AskReddit', 'funny', 'pics', 'news', 'gaming', 'worldnews',
+              'todayilearned', 'videos', 'science', 'programming']
+
+CATEGORIES = ['Books', 'Electronics', 'Movies & TV', 'Music', 'Toys & Games',
+              'Clothing', 'Home & Kitchen', 'Sports & Outdoors']
+
+WIKI_LINKS = ['CATEGORY', 'IMAGE', 'MAIN', 'TALK', 'USER', 'USER_TALK',
+              'OTHER', 'EXTERNAL', 'TEMPLATE']
+
+# The columns of the StackExchange files, as the kind of value to generate.
+STACKEXCHANGE = {
+    'Badges': [('Id', 'id'), ('UserId', 'user'), ('Name', 'name'),
+               ('Date', 'date')],
+    'Comments': [('Id', 'id'), ('PostId', 'post'), ('Score', 'small'),
+                 ('Text', 'text'), ('CreationDate', 'date'),
+                 ('UserId', 'user'), ('UserDisplayName', 'name')],
+    'Posts': [('Id', 'id'), ('PostTypeId', 'type'), ('ParentID', 'post'),
+              ('AcceptedAnswerId', 'post'), ('CreationDate', 'date'),
+              ('Score', 'small'), ('ViewCount', 'large'), ('Body', 'html'),
+              ('OwnerUserId', 'user'), ('LastEditorUserId', 'user'),
+              ('LastEditDate', 'date'), ('LastActivityDate', 'date'),
+              ('Title', 'title'), ('Tags', 'tags'), ('AnswerCount', 'small'),
+              ('CommentCount', 'small'), ('FavoriteCount', 'small')],
+    'Votes': [('Id', 'id'), ('PostId', 'post'), ('UserId', 'user'),
+              ('VoteTypeId', 'type'), ('CreationDate', 'date'),
+              ('BountyAmount', 'small')],
+    'PostHistory': [('Id', 'id'), ('PostHistoryTypeId', 'type'),
+                    ('PostId', 'post'), ('RevisionGUID', 'guid'),
+                    ('CreationDate', 'date'), ('UserId', 'user'),
+                    ('Comment', 'title'), ('Text', 'html')],
+    'PostLinks': [('Id', 'id'), ('CreationDate', 'date'), ('PostId', 'post'),
+                  ('RelatedPostId', 'post'), ('LinkTypeId', 'type')],
+    'Users': [('Id', 'id'), ('Reputation', 'large'), ('CreationDate', 'date'),
+              ('DisplayName', 'name'), ('LastAccessDate', 'date'),
+              ('WebsiteUrl', 'url'), ('Location', 'name'),
+              ('AboutMe', 'html'), ('Views', 'large'), ('UpVotes', 'large'),
+              ('DownVotes', 'small'), ('AccountId', 'user')],
+    'Tags': [('Id', 'id'), ('TagName', 'tag'), ('Count', 'large'),
+             ('ExcerptPostId', 'post'), ('WikiPostId', 'post')],
+}
+
+
+def logTime(chkpoint):
+    print('*** Checkpoint: {} at \x1b[31m{}\x1b[0m'.format(chkpoint, D.datetime.now()),
+          file=sys.stderr)
+    sys.stderr.flush()
+
+
+def words(rand, low, high):
+    return ' '.join(rand.choice(WORDS) for _ in range(rand.randint(low, high)))
+
+
+def timestamp(rand, year, separator=' '):
+    return '{}-{:02d}-{:02d}{}{:02d}:{:02d}:{:02d}'.format(
+        year, rand.randint(1, 12), rand.randint(1, 28), separator,
+        rand.randint(0, 23), rand.randint(0, 59), rand.randint(0, 59))
+
+
+def base36(number):
+    digits = ''
+    while True:
+        number, digit = divmod(number, 36)
+        digits = '0123456789abcdefghijklmnopqrstuvwxyz'[digit] + digits
+        if number == 0:
+            return digits
+
+
+def generateReddit(outFile, size, rand):
+    '''Reddit comments, one JSON object per line.'''
+    for i in range(size):
+        link = base36(rand.randint(10 ** 6, 10 ** 7))
+        comment = {
+            'archived': False,
+            'author': 'user{}'.format(rand.randint(0, size // 10 + 1)),
+            'author_flair_css_class': None,
+            'author_flair_text': None,
+            'body': words(rand, 1, 60),
+            'controversiality': int(rand.random() < 0.05),
+            'created_utc': str(1420070400 + i),
+            'distinguished': None,
+            'downs': 0,
+            'edited': False,
+            'gilded': int(rand.random() < 0.01),
+            'id': base36(10 ** 8 + i),
+            'link_id': 't3_' + link,
+            'name': 't1_' + base36(10 ** 8 + i),
+            'parent_id': 't3_' + link,
+            'retrieved_on': 1425124282,
+            'score': rand.randint(-10, 500),
+            'score_hidden': False,
+            'subreddit': rand.choice(SUBREDDITS),
+            'subreddit_id': 't5_2qh1i',
+            'ups': rand.randint(-10, 500),
+        }
+        outFile.write(json.dumps(comment) + '\n')
+
+
+def generateReviews(outFile, size, rand):
+    '''Amazon reviews, one JSON object per line.'''
+    for i in range(size):
+        helpful = rand.randint(0, 20)
+        review = {
+            'reviewerID': 'A{:013d}'.format(rand.randint(0, size)),
+            'asin': '{:010d}'.format(rand.randint(0, size // 5 + 1)),
+            'reviewerName': words(rand, 1, 2).title(),
+            'helpful': [rand.randint(0, helpful), helpful],
+            'reviewText': words(rand, 10, 150),
+            'overall': float(rand.randint(1, 5)),
+            'summary': words(rand, 2, 8),
+            'unixReviewTime': 1252800000 + i * 60,
+        }
+        review['reviewTime'] = D.datetime.utcfromtimestamp(
+            review['unixReviewTime']).strftime('%m %d, %Y')
+        outFile.write(json.dumps(review) + '\n')
+
+
+def generateMetadata(outFile, size, rand):
+    '''Amazon product metadata, one Python literal per line.'''
+    for i in range(size):
+        product = {
+            'asin': '{:010d}'.format(i),
+            'title': words(rand, 2, 10),
+            'price': round(rand.random() * 100, 2),
+            'imUrl': 'http://ecx.images-amazon.com/images/I/{}.jpg'.format(base36(i)),
+            'related': {
+                'also_bought': ['{:010d}'.format(rand.randint(0, size)) for _ in range(rand.randint(0, 10))],
+                'also_viewed': ['{:010d}'.format(rand.randint(0, size)) for _ in range(rand.randint(0, 5))],
+            },
+            'salesRank': {rand.choice(CATEGORIES): rand.randint(1, 10 ** 6)},
+            'categories': [[rand.choice(CATEGORIES), words(rand, 1, 2)]],
+        }
+        if rand.random() < 0.6:
+            product['brand'] = words(rand, 1, 1).title()
+        if rand.random() < 0.3:
+            product['description'] = words(rand, 10, 80)
+        outFile.write(repr(product) + '\n')
+
+
+def generateMeme(outFile, size, rand):
+    '''Memetracker blocks of P, T, Q and L lines.'''
+    for i in range(size):
+        outFile.write('P\thttp://site{}.com/{}/page{}.html\n'.format(
+            rand.randint(0, 5000), rand.randint(2008, 2009), i))
+        outFile.write('T\t{}\n'.format(timestamp(rand, 2008)))
+        for _ in range(rand.randint(0, 3)):
+            outFile.write('Q\t{}\n'.format(words(rand, 3, 15)))
+        for _ in range(rand.randint(0, 6)):
+            outFile.write('L\thttp://site{}.com/page{}.html\n'.format(
+                rand.randint(0, 5000), rand.randint(0, size)))
+        outFile.write('\n')
+
+
+def generateClusters(outFile, size, rand):
+    '''Memetracker phrase clusters: A lines for the roots, B lines for the
+    phrases and C lines for the urls mentioning them.'''
+    for header in range(6):
+        outFile.write('# header line {}\n'.format(header))
+    phraseId = 0
+    for clusterId in range(size):
+        phrases = rand.randint(1, 4)
+        outFile.write('{}\t{}\t{}\t{}\n'.format(
+            phrases, rand.randint(1, 1000), words(rand, 3, 12), clusterId))
+        for _ in range(phrases):
+            urls = rand.randint(1, 5)
+            phraseId += 1
+            outFile.write('\t{}\t{}\t{}\t{}\n'.format(
+                rand.randint(1, 500), urls, words(rand, 3, 12), phraseId))
+            for _ in range(urls):
+                outFile.write('\t\t{}\t{}\t{}\thttp://site{}.com/page{}.html\n'.format(
+                    timestamp(rand, 2008), rand.randint(1, 10), rand.choice('MB'),
+                    rand.randint(0, 5000), rand.randint(0, size)))
+            outFile.write('\n')
+
+
+def generateWiki(outFile, size, rand):
+    '''Wikipedia revision metadata, REVISION blocks of 14 lines.'''
+    for i in range(size):
+        article = i // 5
+        outFile.write('REVISION {} {} Article_{} {}Z User_{} {}\n'.format(
+            article, 10 ** 6 + i, article, timestamp(rand, 2004, 'T'),
+            rand.randint(0, 5000), rand.randint(0, 5000)))
+        for link in WIKI_LINKS:
+            outFile.write(' '.join([link] + ['{}_{}'.format(rand.choice(WORDS).title(), rand.randint(0, 1000))
+                                             for _ in range(rand.randint(0, 8))]) + '\n')
+        outFile.write('COMMENT {}\n'.format(words(rand, 0, 8)))
+        outFile.write('MINOR {}\n'.format(int(rand.random() < 0.3)))
+        outFile.write('TEXTDATA {}\n'.format(rand.randint(10, 50000)))
+        outFile.write('\n')
+
+
+def stackExchangeValue(kind, i, size, rand):
+    if kind == 'id':
+        return str(i)
+    elif kind in ('post', 'user'):
+        return str(rand.randint(1, size))
+    elif kind == 'type':
+        return str(rand.randint(1, 5))
+    elif kind == 'small':
+        return str(rand.randint(0, 50))
+    elif kind == 'large':
+        return str(rand.randint(0, 100000))
+    elif kind == 'date':
+        return timestamp(rand, 2012, 'T') + '.{:03d}'.format(rand.randint(0, 999))
+    elif kind == 'name':
+        return words(rand, 1, 2).title()
+    elif kind == 'title':
+        return words(rand, 4, 12).capitalize() + '?'
+    elif kind == 'text':
+        return words(rand, 5, 40)
+    elif kind == 'html':
+        return '<p>{}</p>\n\n<pre><code>{}</code></pre>\n'.format(
+            words(rand, 20, 150), words(rand, 0, 20))
+    elif kind == 'tag':
+        # Unique names from the words the tags of the posts are drawn from.
+        name = WORDS[(i - 1) % len(WORDS)]
+        return name if i <= len(WORDS) else '{}{}'.format(name, (i - 1) // len(WORDS))
+    elif kind == 'tags':
+        return ''.join('<{}>'.format(rand.choice(WORDS)) for _ in range(rand.randint(1, 5)))
+    elif kind == 'url':
+        return 'http://site{}.com/'.format(rand.randint(0, 5000))
+    elif kind == 'guid':
+        return '{:032x}'.format(rand.getrandbits(128))
+
+
+def escapeAttribute(value):
+    return (value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+                 .replace('"', '&quot;').replace('\n', '&#xA;'))
+
+
+def generateStackExchange(directory, size, rand):
+    '''One XML file of <row> elements per table, size rows in all. The
+    optional columns are left out of a fifth of the rows.'''
+    perTable = max(size // len(STACKEXCHANGE), 1)
+    for table in sorted(STACKEXCHANGE):
+        with open(os.path.join(directory, table + '.xml'), 'w') as outFile:
+            outFile.write('<?xml version="1.0" encoding="utf-8"?>\n<{}>\n'.format(table.lower()))
+            for i in range(1, perTable + 1):
+                attributes = ['{}="{}"'.format(column, escapeAttribute(stackExchangeValue(kind, i, perTable, rand)))
+                              for column, kind in STACKEXCHANGE[table]
+                              if kind == 'id' or rand.random() >= 0.2]
+                outFile.write('  <row {} />\n'.format(' '.join(attributes)))
+            outFile.write('</{}>\n'.format(table.lower()))
+
+
+# The importer of each format as (generator, file name, Python 2 only,
+# script, extra arguments, compressions supported).
+FORMATS = {
+    'reddit': (generateReddit, 'reddit.json', False, 'json2sqlite.py', ['comments'], ('plain', 'gz', 'bz2')),
+    'reviews': (generateReviews, 'reviews.json', False, 'json2sqlite.py', ['reviews'], ('plain', 'gz', 'bz2')),
+    'metadata': (generateMetadata, 'metadata.txt', True, 'amazon_metadata2sqlite.py', [], ('plain', 'gz', 'bz2')),
+    'meme': (generateMeme, 'quotes.txt', True, 'meme2sqlite.py', ['meme'], ('plain', 'gz', 'bz2')),
+    'clusters': (generateClusters, 'clusters.txt', True, 'meme_clusters2sqlite.py', ['clusters'], ('plain', 'gz', 'bz2')),
+    'wiki': (generateWiki, 'wiki.txt', True, 'wikimeta2sqlite.py', ['main'], ('plain', 'gz', 'bz2')),
+    'stackexchange': (generateStackExchange, 'stackexchange', False, 'so2sqlite.py', [], ('plain', 'gz', 'bz2')),
+    # The rows read through ElementTree, to compare with the expat reader.
+    'stackexchange-iterparse': (generateStackExchange, 'stackexchange', False, 'so2sqlite.py',
+                                ['--parser', 'iterparse'], ('plain', 'gz', 'bz2')),
+}
+
+
+def compress(fileName, compression):
+    '''Writes the gzip or bz2 version of fileName next to it.'''
+    opener = gzip.GzipFile if compression == 'gz' else bz2.BZ2File
+    with open(fileName, 'rb') as inFile:
+        with opener(fileName + '.' + compression, 'wb') as outFile:
+            shutil.copyfileobj(inFile, outFile, 1 << 20)
+
+
+def prepareInput(workDir, name, size, seed, compression):
+    '''Returns the path to the input of the format, generating it if it
+    does not exist yet.'''
+    generator, fileName = FORMATS[name][:2]
+    directory = os.path.join(workDir, '{}-{}-{}'.format(name, size, seed))
+    path = os.path.join(directory, fileName)
+    if not os.path.exists(directory):
+        logTime('Generating {} records of {}'.format(size, name))
+        # Generated in a temporary directory, so that an interrupted run
+        # does not leave a partial input behind.
+        partial = directory + '.partial'
+        if os.path.exists(partial):
+            shutil.rmtree(partial)
+        os.makedirs(partial)
+        rand = random.Random(seed)
+        if generator is generateStackExchange:
+            os.makedirs(os.path.join(partial, fileName))
+            generator(os.path.join(partial, fileName), size, rand)
+        else:
+            with open(os.path.join(partial, fileName), 'w') as outFile:
+                generator(outFile, size, rand)
+        os.rename(partial, directory)
+    if generator is generateStackExchange and compression != 'plain':
+        # The compressed XML files go to a directory of their own, as
+        # so2sqlite.py would read the plain ones first.
+        if not os.path.exists(path + '.' + compression):
+            logTime('Compressing {} with {}'.format(path, compression))
+            partial = path + '.' + compression + '.partial'
+            if os.path.exists(partial):
+                shutil.rmtree(partial)
+            os.makedirs(partial)
+            for xmlFile in sorted(x for x in os.listdir(path) if x.endswith('.xml')):
+                compress(os.path.join(path, xmlFile), compression)
+                os.rename(os.path.join(path, xmlFile + '.' + compression),
+                          os.path.join(partial, xmlFile + '.' + compression))
+            os.rename(partial, path + '.' + compression)
+        path += '.' + compression
+    elif compression != 'plain':
+        if not os.path.exists(path + '.' + compression):
+            logTime('Compressing {} with {}'.format(path, compression))
+            compress(path, compression)
+        path += '.' + compression
+    return path
+
+
+def inputSize(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, x)) for x in os.listdir(path)
+                   if '.xml' in x)
+    return os.path.getsize(path)
+
+
+def highWaterMark(pid):
+    '''Returns the peak resident memory in bytes of the running process
+    from /proc, or None.'''
+    try:
+        with open('/proc/{}/status'.format(pid)) as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def runImporter(command, cwd, logFile):
+    '''Runs the command, returning its exit code, the seconds it took and
+    its peak resident memory in bytes (None where it cannot be measured).
+    The memory of the processes it starts itself is not counted.
+
+    The peak reported by wait4() includes the memory of this process when
+    it forked, so where /proc exists the peak is sampled from there while
+    the command runs instead.'''
+    with open(logFile, 'w') as log:
+        started = time.time()
+        process = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+        peakRss = None
+        if os.path.exists('/proc/self/status'):
+            while process.poll() is None:
+                time.sleep(0.02)
+                # The mark only grows until the process exits, except
+                # that it starts again when the forked process execs.
+                peakRss = highWaterMark(process.pid) or peakRss
+        elif hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = (os.WEXITSTATUS(status) if os.WIFEXITED(status)
+                                  else -os.WTERMSIG(status))
+            # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+            peakRss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        else:
+            process.wait()
+        return process.returncode, time.time() - started, peakRss
+
+
+def countRows(dbFile):
+    '''Returns the number of rows of each table of the database, except the
+    internal ones whose name starts with an underscore.'''
+    conn = sqlite3.connect(dbFile)
+    try:
+        tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+                  if not row[0].startswith(('sqlite_', '_'))]
+        return dict((table, conn.execute('SELECT COUNT(*) FROM "{}"'.format(table)).fetchone()[0])
+                    for table in tables)
+    finally:
+        conn.close()
+
+
+def benchmark(args, name, compression):
+    '''Runs the importer of the format on one input and returns the
+    measurements of the fastest of the repeated runs.'''
+    generator, _, python2, script, extra, _ = FORMATS[name]
+    inputPath = prepareInput(args.work_dir, name, args.size, args.seed, compression)
+    directory = os.path.dirname(inputPath)
+    label = '{}-{}'.format(name, compression)
+    dbFile = os.path.join(directory, label + '.sqlite')
+    statsFile = os.path.join(directory, label + '.stats.json')
+    logFile = os.path.join(directory, label + '.log')
+
+    command = [args.python2 if python2 else args.python, os.path.join(SCRIPTS, script)]
+    if generator is generateStackExchange:
+        # so2sqlite.py takes the directory of the dump, and finds the
+        # compressed files by their extension.
+        command += [os.path.abspath(inputPath), '--database', os.path.abspath(dbFile)] + extra
+    else:
+        command += [os.path.abspath(inputPath), os.path.abspath(dbFile)] + extra
+        if compression != 'plain':
+            command.append('--gzip' if compression == 'gz' else '--bz2')
+    command += ['--progress', '0', '--stats', os.path.abspath(statsFile)]
+    command += shlex.split(args.importer_args)
+
+    best = None
+    for _ in range(args.repeat):
+        if os.path.exists(dbFile):
+            os.remove(dbFile)
+        returncode, seconds, peakRss = runImporter(command, directory, logFile)
+        if best is None or seconds < best[1]:
+            best = (returncode, seconds, peakRss)
+        if returncode != 0:
+            break
+    returncode, seconds, peakRss = best
+
+    result = {
+        'format': name,
+        'compression': compression,
+        'importer': script,
+        'command': command,
+        'returncode': returncode,
+        'input_bytes': inputSize(inputPath),
+        'seconds': seconds,
+        'peak_rss_bytes': peakRss,
+    }
+    if returncode != 0 or not os.path.exists(dbFile):
+        logTime('{} failed with exit code {}, see {}'.format(label, returncode, logFile))
+        return result
+
+    tables = countRows(dbFile)
+    result['tables'] = tables
+    result['rows'] = sum(tables.values())
+    result['rows_per_second'] = result['rows'] / seconds
+    result['db_bytes'] = os.path.getsize(dbFile)
+    if os.path.exists(statsFile):
+        with open(statsFile) as stats:
+            result['stats'] = json.load(stats)
+    if not args.keep:
+        os.remove(dbFile)
+
+    logTime('{}: {} rows in {:.1f} s ({:.0f} rows/s), peak RSS {}, database {:.1f} MB'.format(
+        label, result['rows'], seconds, result['rows_per_second'],
+        '{:.1f} MB'.format(peakRss / 1e6) if peakRss is not None else 'unknown',
+        result['db_bytes'] / 1e6))
+    return result
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=SCRIPTS,
+                                       stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the importers on synthetic inputs.')
+    parser.add_argument('--formats',
+            help='Comma separated formats to benchmark, out of {}. '
+                 'Defaults to all of them.'.format(', '.join(sorted(FORMATS))),
+            default=','.join(sorted(FORMATS)))
+    parser.add_argument('--compressions',
+            help='Comma separated versions of the inputs to benchmark, out of '
+                 'plain, gz and bz2. Formats whose importer cannot read a '
+                 'compression are skipped for it.',
+            default='plain,gz,bz2')
+    parser.add_argument('--size',
+            help='Number of records (blocks for the block based formats) '
+                 'to generate per format.',
+            type=int,
+            default=100000)
+    parser.add_argument('--seed',
+            help='Seed of the generated inputs.',
+            type=int,
+            default=1)
+    parser.add_argument('--repeat',
+            help='Run every importer N times and keep the fastest run.',
+            type=int,
+            default=1)
+    parser.add_argument('--work-dir',
+            help='Directory for the generated inputs and the databases.',
+            default='benchmark-data')
+    parser.add_argument('--python',
+            help='Interpreter for json2sqlite.py and so2sqlite.py.',
+            default=sys.executable)
+    parser.add_argument('--python2',
+            help='Interpreter for the importers which run on Python 2 only.',
+            default='python2')
+    parser.add_argument('--importer-args',
+            help='Extra arguments passed to every importer, e.g. '
+                 '--importer-args="--fast-load".',
+            default='')
+    parser.add_argument('--keep',
+            help='Keep the databases instead of removing them after measuring.',
+            action='store_true')
+    parser.add_argument('--output',
+            help='Write the results as JSON to this file instead of stdout.',
+            default=None)
+    args = parser.parse_args()
+
+    formats = [x.strip() for x in args.formats.split(',') if x.strip()]
+    compressions = [x.strip() for x in args.compressions.split(',') if x.strip()]
+    for name in formats:
+        if name not in FORMATS:
+            parser.error('Unknown format {}'.format(name))
+    for compression in compressions:
+        if compression not in ('plain', 'gz', 'bz2'):
+            parser.error('Unknown compression {}'.format(compression))
+
+    if not os.path.exists(args.work_dir):
+        os.makedirs(args.work_dir)
+
+    report = {
+        'started': D.datetime.now().isoformat(),
+        'commit': gitCommit(),
+        'size': args.size,
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'python': args.python,
+        'python2': args.python2,
+        'importer_args': args.importer_args,
+        'runs': [],
+    }
+    for name in formats:
+        for compression in compressions:
+            if compression not in FORMATS[name][5]:
+                logTime('Skipping {}-{}, {} does not read {} inputs'.format(
+                    name, compression, FORMATS[name][3], compression))
+                continue
+            report['runs'].append(benchmark(args, name, compression))
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(args.output, 'w') as outFile:
+            json.dump(report, outFile, indent=2, sort_keys=True)
+        logTime('Wrote {}'.format(args.output))
@@ -2,13 +2,27 @@
 
 from __future__ import print_function
 
+import os
 import sys
+import io
+import time
+import threading
 import argparse
 import sqlite3
 import bz2
 import gzip
+import zlib
 import json
+import re
+import glob
+import ast
+import itertools
+import importlib
+import collections
+import multiprocessing
 import six
+from six.moves import queue
+from binascii import hexlify, unhexlify
 import datetime as D
 
 if sys.version_info > (3,):
@@ -20,24 +34,1145 @@ def logTime(chkpoint):
     sys.stdout.flush()
 
 
-def JSONReader(file_obj):
-    '''Returns a parsed JSON object per line of the file_obj passed.'''
+# Pragmas applied with --fast-load. Every load runs in a single transaction,
+# so the journal only needs to support a rollback, not a crash.
+FAST_LOAD_PRAGMAS = [
+    ('page_size', '65536'),
+    ('journal_mode', 'MEMORY'),
+    ('synchronous', 'OFF'),
+    ('cache_size', '-1048576'),
+    ('temp_store', 'MEMORY'),
+    ('locking_mode', 'EXCLUSIVE'),
+]
+
+# Pragmas of the shard databases written with --shards. They are removed
+# once merged, so they need no journal at all.
+SHARD_PRAGMAS = [
+    ('page_size', '65536'),
+    ('journal_mode', 'OFF'),
+    ('synchronous', 'OFF'),
+    ('cache_size', '-65536'),
+    ('temp_store', 'MEMORY'),
+    ('locking_mode', 'EXCLUSIVE'),
+]
+
+
+def loadPragmas(fastLoad, overrides):
+    '''Returns the (name, value) pragmas to use while loading: the fast load
+    profile if requested, with the NAME=VALUE overrides applied on top.'''
+    pragmas = list(FAST_LOAD_PRAGMAS) if fastLoad else []
+    for override in overrides:
+        name, value = override.split('=', 1)
+        names = [x for x, _ in pragmas]
+        if name in names:
+            pragmas[names.index(name)] = (name, value)
+        else:
+            pragmas.append((name, value))
+    return pragmas
+
+
+def applyPragmas(conn, pragmas):
+    '''Sets the (name, value) pragmas and returns their previous values.
+
+    The page_size is a property of the database file and is not returned.'''
+    previous = []
+    for name, value in pragmas:
+        if name != 'page_size':
+            previous.append((name, conn.execute('PRAGMA %s' % name).fetchone()[0]))
+        conn.execute('PRAGMA %s = %s' % (name, value))
+    return previous
+
+
+def dropIndexes(conn, indexes):
+    '''Drops the indexes which createIndexes builds, so that they are not
+    updated row by row while loading into existing tables.'''
+    for table, column in indexes:
+        conn.execute('DROP INDEX IF EXISTS "idx_%s_%s"' % (table, column))
+
+
+def createIndexes(conn, indexes):
+    '''Builds an index on each (table, column) pair, reporting the time
+    each of them took.'''
+    for table, column in indexes:
+        start = D.datetime.now()
+        conn.execute('CREATE INDEX IF NOT EXISTS "idx_%s_%s" ON "%s" ("%s")' %
+                     (table, column, table, column))
+        conn.commit()
+        logTime('Created index on {}.{} in {:.2f}s'.format(
+            table, column, (D.datetime.now() - start).total_seconds()))
+
+
+def openInput(fileName, useBz2=False, useGzip=False, processes=0):
+    '''Opens the (possibly compressed) input for reading lines of bytes.
+
+    The file name '-' stands for stdin, which does not need to be seekable.
+    Compressed files other than stdin are decompressed by a pool of
+    processes if processes is positive.'''
+    if processes > 0 and fileName != '-' and (useBz2 or useGzip):
+        inputFile = ParallelDecompressor(fileName, 'bz2' if useBz2 else 'gzip',
+                                         processes)
+    elif fileName == '-':
+        source = getattr(sys.stdin, 'buffer', sys.stdin)
+        if six.PY2 and (useBz2 or useGzip):
+            # BZ2File only opens file names and GzipFile seeks in Python 2.
+            inputFile = StreamDecompressor(source, 'bz2' if useBz2 else 'gzip')
+        elif useBz2:
+            inputFile = bz2.BZ2File(source)
+        elif useGzip:
+            inputFile = gzip.GzipFile(fileobj=source)
+        else:
+            inputFile = source
+    elif useBz2:
+        inputFile = bz2.BZ2File(fileName)
+    elif useGzip:
+        inputFile = gzip.GzipFile(fileName)
+    else:
+        inputFile = open(fileName, 'rb')
+    return inputFile
+
+
+def skipTo(inputFile, offset):
+    '''Moves inputFile forward to the (uncompressed) offset.
+
+    Plain files seek directly. Compressed files can only be decompressed up
+    to the offset, and stdin is read up to it.'''
+    try:
+        inputFile.seek(offset)
+    except (IOError, OSError, ValueError):
+        while offset > 0:
+            data = inputFile.read(min(offset, 1 << 20))
+            if len(data) == 0:
+                break
+            offset -= len(data)
+
+
+def readCheckpoint(conn, target, inputName):
+    '''Returns the (offset, records) stored by the last commit of inputName
+    into target, or (0, 0) if there is none.'''
+    conn.execute('CREATE TABLE IF NOT EXISTS _checkpoints '
+                 '("target" TEXT, "input" TEXT, "offset" INTEGER, '
+                 '"records" INTEGER, "time" TEXT, PRIMARY KEY ("target", "input"))')
+    checkpoint = conn.execute('SELECT "offset", "records" FROM _checkpoints '
+                              'WHERE "target" = ? AND "input" = ?',
+                              (target, inputName)).fetchone()
+    return checkpoint if checkpoint is not None else (0, 0)
+
+
+def writeCheckpoint(conn, target, inputName, offset, records):
+    '''Commits, storing the input offset and the number of records read so
+    far in the same transaction.'''
+    conn.execute('INSERT OR REPLACE INTO _checkpoints VALUES (?, ?, ?, ?, ?)',
+                 (target, inputName, offset, records, str(D.datetime.now())))
+    conn.commit()
+    logTime('Committed {} records'.format(records))
+
+
+class Rejects(object):
+    '''Keeps the records which could not be loaded in the <table>_rejects
+    table, with their position in the input, the stage which failed (parse,
+    convert or insert), the error and the raw record. They are written in
+    batches, in the transaction of the load.
+
+    With fileColumn, the name of the input file is kept too, for the inputs
+    whose positions start again with every file.
+
+    Raises ValueError once more than maxErrors records have been rejected.'''
+
+    def __init__(self, table, position='line', maxErrors=None, batchSize=1000,
+                 fileColumn=False):
+        self.table = table + '_rejects'
+        self.position = position
+        self.fileColumn = fileColumn
+        self.maxErrors = maxErrors
+        self.batchSize = batchSize
+        self.pending = []
+        self.counts = {}
+
+    def create(self, cur):
+        cur.execute('CREATE TABLE IF NOT EXISTS %s ("%s" INTEGER, "stage" TEXT, '
+                    '"error" TEXT, "raw" TEXT)' % (self.table, self.position))
+        columns = [x[1] for x in cur.execute('PRAGMA table_info(%s)' % self.table).fetchall()]
+        if self.fileColumn and 'file' not in columns:
+            cur.execute('ALTER TABLE %s ADD COLUMN "file" TEXT' % self.table)
+
+    def add(self, cur, position, stage, error, raw, fileName=None):
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8', 'replace')
+        self.pending.append((position, stage, str(error), raw) +
+                            ((fileName,) if self.fileColumn else ()))
+        if len(self.pending) >= self.batchSize:
+            self.flush(cur)
+        self.merge({stage: 1})
+
+    def merge(self, counts):
+        '''Adds the counts by stage of records rejected elsewhere.'''
+        for stage, count in counts.items():
+            self.counts[stage] = self.counts.get(stage, 0) + count
+        if self.maxErrors is not None and self.total() > self.maxErrors:
+            raise ValueError('More than {} records rejected, see table {}'.format(
+                self.maxErrors, self.table))
+
+    def flush(self, cur):
+        if len(self.pending) > 0:
+            cur.executemany('INSERT INTO %s VALUES (?, ?, ?, ?%s)' % (
+                self.table, ', ?' if self.fileColumn else ''), self.pending)
+            self.pending = []
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def log(self):
+        if self.total() > 0:
+            logTime('Rejected {} records ({}), see table {}'.format(
+                self.total(),
+                ', '.join('{} {}'.format(self.counts[x], x) for x in sorted(self.counts)),
+                self.table))
+
+
+class BackgroundReader(object):
+    '''Reads the lines of a (compressed) file in a background thread.
+
+    The thread reads blocks of about blockSize bytes of lines ahead of the
+    consumer and hands them over through a queue of at most depth blocks, so
+    that decompression overlaps with parsing and inserting. Supports
+    readline(), iteration and tell().'''
+
+    def __init__(self, inputFile, depth, blockSize=1 << 20):
+        # Keep the file open after the thread has read it to the end.
+        self.inputFile = inputFile
+        self.queue = queue.Queue(depth)
+        self.depth = depth
+        self.eof = ''
+        self.lines, self.index = [], 0
+        self.finished = False
+        try:
+            self.position = inputFile.tell()
+        except (IOError, OSError, ValueError):
+            self.position = 0
+        self.blocks, self.totalDepth = 0, 0
+        self.consumerWaits, self.readerWaits = 0, 0
+        # A Progress which counts the time spent waiting for lines as read.
+        self.progress = None
+        thread = threading.Thread(target=self.readBlocks,
+                                  args=(inputFile, blockSize))
+        thread.daemon = True
+        thread.start()
+
+    def readBlocks(self, inputFile, blockSize):
+        try:
+            while True:
+                lines = inputFile.readlines(blockSize)
+                self.put(lines)
+                if len(lines) == 0:
+                    break
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.readerWaits += 1
+            self.queue.put(item)
+
+    def nextBlock(self):
+        if self.finished:
+            return False
+
+        try:
+            item = self.queue.get_nowait()
+        except queue.Empty:
+            self.consumerWaits += 1
+            if self.progress is not None:
+                self.progress.enter('read')
+            item = self.queue.get()
+            if self.progress is not None:
+                self.progress.leave()
+
+        if isinstance(item, Exception):
+            raise item
+
+        self.blocks += 1
+        self.totalDepth += self.queue.qsize()
+        self.lines, self.index = item, 0
+        self.finished = len(item) == 0
+        if not self.finished:
+            # readline returns an empty line of the same type at the end.
+            self.eof = item[0][:0]
+        return not self.finished
+
+    def readline(self):
+        if self.index == len(self.lines) and not self.nextBlock():
+            return self.eof
+
+        line = self.lines[self.index]
+        self.index += 1
+        self.position += len(line)
+        return line
+
+    def __iter__(self):
+        while self.index < len(self.lines) or self.nextBlock():
+            line = self.lines[self.index]
+            self.index += 1
+            self.position += len(line)
+            yield line
+
+    def tell(self):
+        return self.position
+
+    def report(self):
+        '''Logs how full the queue was. A nearly empty queue means that reading
+        is the bottleneck, a nearly full one that the import is.'''
+        logTime('Read {} blocks ahead: average queue depth {:.1f} of {}, '
+                'import waited {} times, reader waited {} times'.format(
+                    self.blocks, float(self.totalDepth) / max(self.blocks, 1),
+                    self.depth, self.consumerWaits, self.readerWaits))
+
+
+# A bz2 block starts with the 48 bit number pi and a stream ends with sqrt(pi),
+# both followed by a 32 bit CRC. Neither is aligned to a byte.
+BZ2_BLOCK_MAGIC = 0x314159265359
+BZ2_EOS_MAGIC = 0x177245385090
+BZ2_HEADER = 0x425a6839  # 'BZh9', the largest block size
+GZIP_MAGIC = b'\x1f\x8b\x08'
+
+
+def readBits(data, start, count):
+    '''Returns count bits of data from bit offset start as an integer.'''
+    first, last = start // 8, (start + count + 7) // 8
+    value = int(hexlify(data[first:last]), 16)
+    return (value >> (last * 8 - start - count)) & ((1 << count) - 1)
+
+
+def findBits(data, magic):
+    '''Returns the bit offsets of the 48 bit magic number in data which are
+    followed by at least 32 more bits of data.'''
+    found = []
+    for shift in range(8):
+        # The magic number shifted into a window of 7 bytes; the bytes it
+        # fills completely are searched for, the partial ones compared after.
+        window = magic << (8 - shift)
+        mask = ((1 << 48) - 1) << (8 - shift)
+        keyStart = 0 if shift == 0 else 1
+        key = unhexlify('%014x' % window)[keyStart:6]
+        index = data.find(key)
+        while index >= 0:
+            start = index - keyStart
+            if start >= 0 and start * 8 + shift + 80 <= len(data) * 8 and \
+                    int(hexlify(data[start:start + 7]), 16) & mask == window:
+                found.append(start * 8 + shift)
+            index = data.find(key, index + 1)
+    return sorted(found)
+
+
+def bz2Boundaries(fileName, windowSize=1 << 24):
+    '''Yields (bitOffset, isBlock, crc) for the start of every block and the
+    end of every stream of a bz2 file, in order.'''
+    with open(fileName, 'rb') as compressed:
+        base, data, last = 0, b'', -1
+        while True:
+            more = compressed.read(windowSize)
+            data += more
+            for bit, isBlock in sorted([(x, True) for x in findBits(data, BZ2_BLOCK_MAGIC)] +
+                                       [(x, False) for x in findBits(data, BZ2_EOS_MAGIC)]):
+                if base * 8 + bit > last:
+                    last = base * 8 + bit
+                    yield last, isBlock, readBits(data, bit + 48, 32)
+
+            if len(more) == 0:
+                break
+            # Keep the end, where a magic number may have been cut off.
+            base += len(data) - 16
+            data = data[-16:]
+
+
+def bz2Ranges(fileName, rangeSize):
+    '''Groups the blocks of a bz2 file into ranges of about rangeSize
+    compressed bytes, which do not cross the end of a stream.
+
+    Yields (startBit, endBit, crc), with the CRC of the stream which holds
+    only the blocks of the range.'''
+    start, crc = None, 0
+    for bit, isBlock, blockCRC in bz2Boundaries(fileName):
+        if start is not None and (not isBlock or bit - start >= rangeSize * 8):
+            yield start, bit, crc
+            start, crc = None, 0
+        if isBlock:
+            if start is None:
+                start = bit
+            crc = (((crc << 1) | (crc >> 31)) & 0xffffffff) ^ blockCRC
+    if start is not None:
+        raise IOError('Compressed file ended before the end of its data')
+
+
+def decompressBz2Range(fileName, startBit, endBit, crc):
+    '''Decompresses the blocks between two bit offsets of a bz2 file, by
+    wrapping them into a stream of their own.'''
+    with open(fileName, 'rb') as compressed:
+        compressed.seek(startBit // 8)
+        data = compressed.read((endBit + 7) // 8 - startBit // 8)
+    count = endBit - startBit
+    stream = (((BZ2_HEADER << count | readBits(data, startBit % 8, count)) << 48 |
+               BZ2_EOS_MAGIC) << 32) | crc
+    length = (32 + count + 80 + 7) // 8
+    stream <<= length * 8 - (32 + count + 80)
+    return bz2.decompress(unhexlify('%0*x' % (length * 2, stream)))
+
+
+def decompressBz2Sequential(fileName, skip=0, readSize=1 << 20):
+    '''Decompresses all the streams of a bz2 file one after the other, in
+    this process, leaving out the first skip bytes of the output.
+
+    Yields (data, compressedOffset) pairs.'''
+    with open(fileName, 'rb') as compressed:
+        decompressor = bz2.BZ2Decompressor()
+        data = compressed.read(readSize)
+        while len(data) > 0:
+            try:
+                output = decompressor.decompress(data)
+            except EOFError:
+                # The stream before ended with the data read before.
+                decompressor = bz2.BZ2Decompressor()
+                continue
+            if len(decompressor.unused_data) > 0:
+                data = decompressor.unused_data
+                decompressor = bz2.BZ2Decompressor()
+            else:
+                data = compressed.read(readSize)
+
+            if skip >= len(output):
+                skip -= len(output)
+                continue
+            yield output[skip:], compressed.tell() - len(data)
+            skip = 0
+
+
+def plausibleMember(data):
+    '''Tells whether data starts with a gzip member: the header flags must be
+    valid and the beginning must decompress.'''
+    if len(data) < 18 or ord(data[3:4]) & 0xe0:
+        return False
+    try:
+        zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data[:1 << 16])
+    except zlib.error:
+        return False
+    return True
+
+
+def gzipRanges(fileName, rangeSize, windowSize=1 << 20):
+    '''Splits a gzip file into ranges of about rangeSize bytes, at the first
+    plausible member header after each rangeSize bytes. Yields (start, end)
+    byte offsets; the end of the last range is None.'''
+    with open(fileName, 'rb') as compressed:
+        start = 0
+        while True:
+            position, end = start + rangeSize, None
+            while end is None:
+                compressed.seek(position)
+                data = compressed.read(windowSize + (1 << 16))
+                index = data.find(GZIP_MAGIC)
+                while 0 <= index < windowSize:
+                    if plausibleMember(data[index:]):
+                        end = position + index
+                        break
+                    index = data.find(GZIP_MAGIC, index + 1)
+                if len(data) <= windowSize:
+                    break
+                position += windowSize
+
+            yield start, end
+            if end is None:
+                break
+            start = end
+
+
+def decompressGzipRange(fileName, start, end):
+    '''Decompresses the gzip members between two byte offsets of a file.
+
+    Returns the data and whether the last member ended at the end of the
+    range, which it does not when the range was split at a false header.'''
+    with open(fileName, 'rb') as compressed:
+        compressed.seek(start)
+        data = compressed.read(-1 if end is None else end - start)
+
+    # A member which ends with the range leaves the extra byte unused.
+    data += b'\x00'
+    output = []
+    try:
+        while True:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            output.append(decompressor.decompress(data))
+            data = decompressor.unused_data
+            if len(data) == 0:
+                return b''.join(output), False
+            if len(data.strip(b'\x00')) == 0:
+                return b''.join(output), True
+    except zlib.error:
+        return None, False
+
+
+def decompressRange(task):
+    '''Decompresses a range of a bz2 or gzip file in a worker process.'''
+    fileName, kind, start, end, crc = task
+    if kind == 'bz2':
+        return decompressBz2Range(fileName, start, end, crc), True
+    return decompressGzipRange(fileName, start, end)
+
+
+class ParallelDecompressor(object):
+    '''Decompresses the blocks of a bz2 file or the members of a gzip file in
+    a pool of processes, in ranges of about rangeSize compressed bytes.
+
+    The decompressed ranges are put back together in order. Supports
+    readline(), readlines(), iteration, tell() and seeking forward, so that
+    it can also be used through a BackgroundReader. A gzip file with a single member is
+    decompressed by a single process.
+
+    The bz2 blocks are found by their magic numbers, which may also occur by
+    chance inside the compressed data. A false block start makes the blocks
+    around it fail to decompress, so when a range fails the rest of the file
+    is decompressed sequentially by this process instead, from the
+    beginning, leaving out what was already read.'''
+
+    def __init__(self, fileName, kind, processes, rangeSize=1 << 22):
+        self.fileName, self.kind, self.processes = fileName, kind, processes
+        self.pool = multiprocessing.Pool(processes)
+        if kind == 'bz2':
+            ranges = bz2Ranges(fileName, rangeSize)
+        else:
+            ranges = ((start, end, None)
+                      for start, end in gzipRanges(fileName, rangeSize))
+        self.chunks = self.decompressFile(ranges)
+        self.data, self.position = b'', 0
+        self.lines, self.index = [], 0
+        self.compressed = 0
+
+    def decompressFile(self, ranges):
+        '''Yields the decompressed ranges in order, falling back to sequential
+        decompression if a bz2 range fails.'''
+        emitted = 0
+        try:
+            for data in self.decompressRanges(ranges):
+                emitted += len(data)
+                yield data
+        except (IOError, OSError, ValueError, EOFError) as e:
+            if self.kind != 'bz2':
+                raise
+            logTime('Decompressing sequentially after a failed range: {}'.format(e))
+            # Only the ranges in flight are left to the pool; terminate() can
+            # deadlock on them in Python 2.
+            self.pool.close()
+            for data, compressed in decompressBz2Sequential(self.fileName, emitted):
+                self.compressed = compressed
+                yield data
+
+    def decompressRanges(self, ranges):
+        '''Yields the decompressed ranges in order, with at most
+        2 * processes ranges in flight.'''
+        pending = collections.deque()
+        exhausted = False
+        mergeStart = None
+        while True:
+            while not exhausted and len(pending) < 2 * self.processes:
+                nextRange = next(ranges, None)
+                if nextRange is None:
+                    exhausted = True
+                    break
+                task = (self.fileName, self.kind) + nextRange
+                pending.append((task, self.pool.apply_async(decompressRange, (task,))))
+
+            if len(pending) == 0:
+                break
+
+            task, result = pending.popleft()
+            _, _, start, end, _ = task
+            data, complete = result.get()
+            if mergeStart is not None:
+                # The range before was split at a false member header.
+                start, mergeStart = mergeStart, None
+                data, complete = decompressGzipRange(self.fileName, start, end)
+            if not complete:
+                if end is None:
+                    raise IOError('Compressed file ended before the end of its data')
+                mergeStart = start
+                continue
+
+            if end is None:
+                self.compressed = os.path.getsize(self.fileName)
+            else:
+                self.compressed = (end + 7) // 8 if self.kind == 'bz2' else end
+            yield data
+
+        self.pool.close()
+
+    def fill(self):
+        '''Appends the next decompressed range to the data, returning False
+        at the end of the file.'''
+        data = next(self.chunks, None)
+        if data is None:
+            return False
+        self.data += data
+        return True
+
+    def readlines(self, hint=-1):
+        '''Returns the complete lines of at least the next decompressed range.'''
+        if self.index < len(self.lines):
+            lines = self.lines[self.index:]
+            self.lines, self.index = [], 0
+            return lines
+
+        while True:
+            end = self.data.rfind(b'\n') + 1
+            if end > 0 or not self.fill():
+                break
+        if end == 0:
+            end = len(self.data)
+
+        lines = io.BytesIO(self.data[:end]).readlines()
+        self.data = self.data[end:]
+        self.position += end
+        return lines
+
+    def readline(self):
+        if self.index == len(self.lines):
+            self.lines, self.index = self.readlines(), 0
+            if len(self.lines) == 0:
+                return b''
+
+        line = self.lines[self.index]
+        self.index += 1
+        return line
+
+    def __iter__(self):
+        while True:
+            lines = self.readlines()
+            if len(lines) == 0:
+                break
+            for line in lines:
+                yield line
+
+    def seek(self, offset):
+        '''Skips forward to the uncompressed offset.'''
+        unread = b''.join(self.readlines()) if self.index < len(self.lines) else b''
+        self.data = unread + self.data
+        self.position -= len(unread)
+        while self.position + len(self.data) < offset:
+            self.position += len(self.data)
+            self.data = b''
+            if not self.fill():
+                return
+        self.data = self.data[max(offset - self.position, 0):]
+        self.position = max(offset, self.position)
+
+    def tell(self):
+        return self.position - sum(len(x) for x in self.lines[self.index:])
+
+    def compressedPosition(self):
+        '''Returns the compressed offset up to which the file has been
+        decompressed.'''
+        return self.compressed
+
+
+class StreamDecompressor(ParallelDecompressor):
+    '''Decompresses a bz2 or gzip stream which cannot seek, such as stdin,
+    in this process, one stream or member after the other. It reads lines
+    like a ParallelDecompressor, only its data comes from a decompressor
+    object fed with blocks of readSize compressed bytes.'''
+
+    def __init__(self, source, kind, readSize=1 << 20):
+        self.source, self.kind, self.readSize = source, kind, readSize
+        self.decompressor = self.newDecompressor()
+        self.unused = b''
+        self.data, self.position = b'', 0
+        self.lines, self.index = [], 0
+        self.compressed = 0
+
+    def newDecompressor(self):
+        if self.kind == 'bz2':
+            return bz2.BZ2Decompressor()
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def fill(self):
+        while True:
+            data = self.unused or self.source.read(self.readSize)
+            self.compressed += 0 if self.unused else len(data)
+            self.unused = b''
+            if len(data) == 0 or (self.kind == 'gzip' and len(data.strip(b'\x00')) == 0):
+                # gzip allows zeros to pad the end of the input.
+                return False
+            try:
+                output = self.decompressor.decompress(data)
+            except EOFError:
+                # The bz2 stream before ended with the data read before.
+                self.decompressor, self.unused = self.newDecompressor(), data
+                continue
+            if len(self.decompressor.unused_data) > 0:
+                self.unused = self.decompressor.unused_data
+                self.decompressor = self.newDecompressor()
+            if len(output) > 0:
+                self.data += output
+                return True
+
+
+STAGES = ['read', 'parse', 'convert', 'insert', 'merge', 'other']
+
+
+class Progress(object):
+    '''Measures the throughput of a load and where its time goes.
+
+    The time is split between the stages entered with enter() or by
+    iterating through timed(); the stages nest, and the time outside of any
+    stage counts as other. Reading only counts the time spent waiting for a
+    BackgroundReader; otherwise it is part of parsing.
+
+    Every `every` seconds, count() logs the records per second, the bytes
+    per second of the uncompressed and the compressed input, how much of the
+    input has been consumed with an estimate of the time left, and the share
+    of each stage.'''
+
+    def __init__(self, every=30, totalBytes=None, tell=None, compressedTell=None,
+                 compressed=False):
+        self.every = every
+        # The share consumed of a compressed input is only known from the
+        # position in the compressed file.
+        self.totalBytes = totalBytes if compressedTell is not None or not compressed else None
+        self.tell, self.compressedTell = tell, compressedTell
+        self.records = 0
+        self.firstPosition = self.position(tell) or 0
+        self.firstCompressed = self.position(compressedTell) or 0
+        self.started = self.mark = self.logged = time.time()
+        self.stack = ['other']
+        self.stages = dict((x, 0.0) for x in STAGES)
+
+    def enter(self, stage):
+        now = time.time()
+        self.stages[self.stack[-1]] += now - self.mark
+        self.mark = now
+        self.stack.append(stage)
+
+    def leave(self):
+        now = time.time()
+        self.stages[self.stack.pop()] += now - self.mark
+        self.mark = now
+
+    def timed(self, iterable, stage):
+        '''Yields the items of iterable, counting the time taken to get them
+        as stage. Does what enter() and leave() do, inline, as it runs for
+        every record.'''
+        stages, stack, clock = self.stages, self.stack, time.time
+        iterator = iter(iterable)
+        while True:
+            now = clock()
+            stages[stack[-1]] += now - self.mark
+            self.mark = now
+            stack.append(stage)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                now = clock()
+                stages[stack.pop()] += now - self.mark
+                self.mark = now
+            yield item
+
+    def count(self):
+        self.records += 1
+        if self.every > 0 and self.records % 100 == 0 and \
+                time.time() - self.logged >= self.every:
+            self.log()
+
+    def position(self, tell):
+        try:
+            return tell() if tell is not None else None
+        except (IOError, OSError, ValueError):
+            return None
+
+    def stats(self):
+        '''Returns the statistics of this run so far as a dictionary. The
+        bytes are counted from where the run started.'''
+        now = time.time()
+        seconds = max(now - self.started, 1e-6)
+        stages = dict(self.stages)
+        stages[self.stack[-1]] += now - self.mark
+        stats = {
+            'records': self.records,
+            'seconds': seconds,
+            'records_per_second': self.records / seconds,
+            'stage_seconds': stages,
+        }
+        uncompressed = self.position(self.tell)
+        if uncompressed is not None:
+            stats['bytes'] = uncompressed - self.firstPosition
+            stats['bytes_per_second'] = stats['bytes'] / seconds
+        compressed = self.position(self.compressedTell)
+        if compressed is not None:
+            stats['compressed_bytes'] = compressed - self.firstCompressed
+            stats['compressed_bytes_per_second'] = stats['compressed_bytes'] / seconds
+
+        if self.compressedTell is not None:
+            consumed, rate = compressed, stats.get('compressed_bytes_per_second')
+        else:
+            consumed, rate = uncompressed, stats.get('bytes_per_second')
+        if consumed is not None and self.totalBytes:
+            stats['consumed'] = min(float(consumed) / self.totalBytes, 1.0)
+            if rate > 0:
+                stats['eta_seconds'] = max(self.totalBytes - consumed, 0) / rate
+        return stats
+
+    def log(self):
+        stats = self.stats()
+        parts = ['{} records ({:.0f}/s)'.format(stats['records'], stats['records_per_second'])]
+        if 'bytes' in stats:
+            parts.append('{:.1f} MB ({:.2f} MB/s)'.format(
+                stats['bytes'] / 1e6, stats['bytes_per_second'] / 1e6))
+        if 'compressed_bytes' in stats:
+            parts.append('{:.1f} MB compressed ({:.2f} MB/s)'.format(
+                stats['compressed_bytes'] / 1e6, stats['compressed_bytes_per_second'] / 1e6))
+        if 'consumed' in stats:
+            parts.append('{:.1f}% of the input'.format(100 * stats['consumed']))
+        if 'eta_seconds' in stats:
+            parts.append('ETA {}'.format(D.timedelta(seconds=int(stats['eta_seconds']))))
+        stages = stats['stage_seconds']
+        total = max(sum(stages.values()), 1e-6)
+        parts.append(' '.join('{} {:.0f}%'.format(x, 100 * stages[x] / total)
+                              for x in STAGES if stages[x] > 0))
+        logTime(', '.join(parts))
+        self.logged = time.time()
+
+    def write(self, fileName):
+        '''Writes the statistics as JSON.'''
+        with open(fileName, 'w') as statsFile:
+            json.dump(self.stats(), statsFile, indent=2, sort_keys=True)
+
+
+def compressedTell(inputFile):
+    '''Returns the tell function of the compressed file which inputFile
+    decompresses, or None if it is not exposed, as for bz2 in Python 2.'''
+    if isinstance(inputFile, ParallelDecompressor):
+        return inputFile.compressedPosition
+    rawFile = getattr(inputFile, 'fileobj', None) or getattr(inputFile, '_fp', None)
+    return rawFile.tell if rawFile is not None else None
+
+
+def inputSize(fileName):
+    '''Returns the size of the input file, or None for stdin.'''
+    try:
+        return os.path.getsize(fileName) if fileName != '-' else None
+    except OSError:
+        return None
+
+
+def expandInputs(patterns):
+    '''Returns the input file names, replacing the glob patterns among the
+    given names with the files they match, in sorted order.'''
+    fileNames = []
+    for pattern in patterns:
+        if pattern != '-' and any(x in pattern for x in '*?['):
+            matches = sorted(glob.glob(pattern))
+            if len(matches) == 0:
+                raise IOError('No files match {}'.format(pattern))
+            fileNames.extend(matches)
+        else:
+            fileNames.append(pattern)
+    return fileNames
+
+
+class InputFiles(object):
+    '''Reads a batch of (compressed) input files one after the other.
+
+    Up to `ahead` files are open at a time: the current one and the ones
+    after it, whose background readers decompress them while the current one
+    is being imported. Iterating yields (name, inputFile, offset, records)
+    for every file, with inputFile at the offset which the checkpoint of an
+    earlier run reached after `records` lines. The files which an earlier run
+    has imported completely, whose checkpoint has no offset, are skipped.
+
+    tell() and compressedTell() return the position in the whole batch.'''
+
+    def __init__(self, fileNames, checkpoints, useBz2=False, useGzip=False,
+                 processes=0, readAhead=0, ahead=1):
+        self.useBz2, self.useGzip = useBz2, useGzip
+        self.processes, self.readAhead = processes, readAhead
+        self.ahead = max(ahead, 1)
+        self.checkpoints = checkpoints
+        self.size = None if '-' in fileNames else \
+            sum(inputSize(x) or 0 for x in fileNames)
+        self.pending = collections.deque(fileNames)
+        self.opened = collections.deque()
+        self.doneBytes, self.doneCompressed = 0, 0
+        # A Progress which the background reader of the current file reports
+        # its waits to.
+        self.progress = None
+        self.openAhead()
+        self.firstLine = self.opened[0][3] + 1 if len(self.opened) > 0 else 1
+        self.tellsCompressed = len(self.opened) > 0 and self.opened[0][4] is not None
+
+    def openNext(self):
+        while len(self.pending) > 0:
+            name = self.pending.popleft()
+            offset, records = self.checkpoints.get(name, (0, 0))
+            if offset is None:
+                logTime('Skipping {}, it has already been imported'.format(name))
+                size = inputSize(name) or 0
+                self.doneCompressed += size
+                if not (self.useBz2 or self.useGzip):
+                    self.doneBytes += size
+                continue
+
+            inputFile = openInput(name, useBz2=self.useBz2, useGzip=self.useGzip,
+                                  processes=self.processes)
+            rawTell = compressedTell(inputFile)
+            if offset > 0:
+                skipTo(inputFile, offset)
+                logTime('Resuming {} after line {}'.format(name, records))
+            if (self.useBz2 or self.useGzip) and self.readAhead > 0:
+                inputFile = BackgroundReader(inputFile, self.readAhead)
+            self.opened.append((name, inputFile, offset, records, rawTell))
+            return True
+        return False
+
+    def openAhead(self):
+        while len(self.opened) < self.ahead and self.openNext():
+            pass
+
+    def __iter__(self):
+        while len(self.opened) > 0:
+            name, inputFile, offset, records, rawTell = self.opened[0]
+            if isinstance(inputFile, BackgroundReader):
+                inputFile.progress = self.progress
+            yield name, inputFile, offset, records
+
+            if isinstance(inputFile, BackgroundReader):
+                inputFile.report()
+            try:
+                self.doneBytes += inputFile.tell()
+            except (IOError, OSError, ValueError):
+                # stdin cannot tell its position.
+                pass
+            self.doneCompressed += inputSize(name) or 0
+            self.opened.popleft()
+            self.openAhead()
+
+    def tell(self):
+        if len(self.opened) == 0:
+            return self.doneBytes
+        return self.doneBytes + self.opened[0][1].tell()
+
+    def compressedTell(self):
+        if len(self.opened) == 0:
+            return self.doneCompressed
+        rawTell = self.opened[0][4]
+        return self.doneCompressed + (rawTell() if rawTell is not None else 0)
+
+
+def recordLines(inputs, firstLine, every, checkpoints):
+    '''Yields the non-empty lines of the (name, inputFile, offset, records)
+    inputs one after the other, numbering them from firstLine on.
+
+    After every `every` lines of an input a (line, name, offset, records)
+    tuple is appended to checkpoints, with the number of the last line
+    yielded, the offset just after it in the input and the number of lines
+    of the input up to there. At the end of an input, the tuple has no
+    offset, which marks it as imported completely.'''
+    line = firstLine - 1
+    for name, inputFile, offset, records in inputs:
+        logTime('Reading {} from line {}'.format(name, line + 1))
+        for text in inputFile:
+            offset += len(text)
+            text = text.strip()
+            if len(text) == 0:
+                continue
+
+            line += 1
+            records += 1
+            if every > 0 and records % every == 0:
+                checkpoints.append((line, name, offset, records))
+            yield text
+
+        checkpoints.append((line, name, None, records))
+
+
+# Modules which --json-backend auto tries, fastest first.
+JSON_BACKENDS = ['orjson', 'ujson', 'simdjson', 'json']
+
+
+def jsonModule(backend='json'):
+    '''Returns the named JSON module, or the first installed one of
+    JSON_BACKENDS for 'auto'. Falls back to the standard json module if the
+    backend is not installed.'''
+    for name in JSON_BACKENDS if backend == 'auto' else [backend]:
+        try:
+            return importlib.import_module(name)
+        except ImportError:
+            continue
+    return json
+
+
+def jsonLoads(backend='json'):
+    '''Returns the loads function of the JSON backend.
+
+    Lines which a faster backend rejects, e.g. integers beyond 64 bits for
+    orjson, are parsed again with json.loads, so that every backend accepts
+    the same input.'''
+    module = jsonModule(backend)
+    if module is json:
+        return json.loads
+
+    def loads(text):
+        try:
+            return module.loads(text)
+        except ValueError:
+            return json.loads(text)
+    return loads
+
+
+CONDITION = re.compile(r'^\s*(\w+)\s*(==|=|!=|<=|>=|<|>|not\s+in\b|in\b)\s*(.+)$')
+# Strings which appear verbatim in quotes in any JSON encoding, and which
+# cannot be the text of a number compared as a string.
+PLAIN_STRING = re.compile(r'^[A-Za-z0-9_ .:-]+$')
+NUMBER_STRING = re.compile(r'^[0-9 .:-]*$')
+
+
+def parseCondition(text):
+    '''Parses a KEY OPERATOR VALUE condition for --where, where the value is
+    a Python literal, e.g. "subreddit in ('pics', 'funny')".'''
+    match = CONDITION.match(text)
+    if match is None:
+        raise argparse.ArgumentTypeError(
+            "Expected KEY OPERATOR VALUE, e.g. \"created_utc >= 1420070400\", "
+            "not '%s'" % text)
+    key, operator, value = match.groups()
+    try:
+        value = ast.literal_eval(value.strip())
+    except (ValueError, SyntaxError):
+        raise argparse.ArgumentTypeError("Invalid value in '%s'" % text)
+    operator = ' '.join(operator.split())
+    if operator in ('in', 'not in') and not isinstance(value, (list, tuple, set, frozenset)):
+        value = (value,)
+    return key, operator, value
+
+
+def isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def compareValue(value, operator, literal):
+    '''Tells whether a JSON value satisfies the condition. Strings are
+    compared with numbers as numbers, e.g. Reddit's created_utc.'''
+    literals = literal if operator in ('in', 'not in') else [literal]
+    if isinstance(value, six.string_types) and all(isNumber(x) for x in literals):
+        try:
+            value = float(value)
+        except ValueError:
+            return False
+    elif isNumber(value) and all(isinstance(x, six.string_types) for x in literals):
+        value = unicode(value)
+
+    try:
+        return (value == literal if operator in ('=', '==')
+                else value != literal if operator == '!='
+                else value < literal if operator == '<'
+                else value <= literal if operator == '<='
+                else value > literal if operator == '>'
+                else value >= literal if operator == '>='
+                else value in literal if operator == 'in'
+                else value not in literal)
+    except TypeError:
+        return False
+
+
+class RecordFilter(object):
+    '''Selects the records to load and the keys to keep of them.
+
+    A record is loaded if all the (key, operator, value) conditions hold;
+    a missing or null key satisfies no condition. Before a line is parsed,
+    it is checked to contain one of the quoted values of every = or in
+    condition on plain strings, as it cannot match otherwise.'''
+
+    def __init__(self, columns=None, conditions=()):
+        self.columns = columns
+        self.conditions = list(conditions)
+        self.needles = []
+        for key, operator, value in self.conditions:
+            values = value if operator == 'in' else [value]
+            if operator in ('=', '==', 'in') and all(
+                    isinstance(x, six.string_types) and PLAIN_STRING.match(x) and
+                    not NUMBER_STRING.match(x) for x in values):
+                self.needles.append([('"%s"' % x).encode('ascii') for x in values])
+
+    def parse(self, line, loads):
+        '''Returns the projected record of the line, or None if it does not
+        match.'''
+        for needles in self.needles:
+            if not any(x in line for x in needles):
+                return None
+
+        record = loads(line)
+        for key, operator, value in self.conditions:
+            if record.get(key) is None or not compareValue(record[key], operator, value):
+                return None
+
+        if self.columns is not None:
+            record = dict((x, record[x]) for x in self.columns if x in record)
+        return record
+
+
+# Stands in for the record of a line which could not be parsed.
+Unparsed = collections.namedtuple('Unparsed', ['text', 'error'])
+
+
+def parseLine(line, loads, recordFilter=None):
+    '''Returns the parsed JSON object of the line, None if recordFilter
+    rejects it, or an Unparsed value if it is not valid JSON.'''
+    try:
+        return loads(line) if recordFilter is None else recordFilter.parse(line, loads)
+    except Exception as e:
+        return Unparsed(line, str(e))
+
+
+def JSONReader(file_obj, loads=json.loads, recordFilter=None):
+    '''Returns a (line, record) pair per line of the file_obj passed, where
+    record is the parsed JSON object, None for the lines which recordFilter
+    rejects, or an Unparsed value for the lines which are not valid JSON.
+    The text of the line is kept to store it with the records rejected
+    later on.'''
     for line in file_obj:
         line = line.strip()
         if len(line) == 0:
             continue
 
-        yield json.loads(line)
+        yield line, parseLine(line, loads, recordFilter)
+
+
+def sampleReader(numberedRecords, sample, skipped):
+    '''Yields the records of the (line, (text, record)) pairs of
+    numberedRecords, keeping each pair in sample.
+
+    This allows the records consumed while guessing types to be replayed
+    afterwards, so that the input is read only once. Unparsed records are
+    kept in sample but not yielded. Filtered records are only counted in
+    skipped[0], so that a selective filter does not buffer the input.'''
+    for line, (text, record) in numberedRecords:
+        if record is None:
+            skipped[0] += 1
+            continue
+        sample.append((line, (text, record)))
+        if not isinstance(record, Unparsed):
+            yield record
 
 
-def guess_types(reader, max_sample_size=100, headers=None):
+def guess_types(reader, max_sample_size=100, headers=None, max_rows=None):
     '''Guess column types (as for SQLite) of JSON.
 
     Source code from: csv2sqlite.py
     '''
 
     if headers is None:
-        _headers = sorted(six.advance_iterator(reader).keys())
+        try:
+            _headers = sorted(six.advance_iterator(reader).keys())
+        except StopIteration:
+            raise ValueError('No records to guess the columns from')
     else:
         _headers = sorted(headers)
 
@@ -92,6 +1227,9 @@ def guess_types(reader, max_sample_size=100, headers=None):
         if have_max_samples:
             break
 
+        if max_rows is not None and row_index + 1 >= max_rows:
+            break
+
     for column,colresult in enumerate(results):
         for _type, _ in options:
             if colresult[_type] > 0 and colresult[_type] >= colresult[types[column]]:
@@ -100,94 +1238,883 @@ def guess_types(reader, max_sample_size=100, headers=None):
     return types, _headers
 
 
-
-argParser = argparse.ArgumentParser()
-argParser.add_argument('jsonfile',
-        help='The file which contains the json data fields '
-             'from which to populate the sqlite3 db.')
-argParser.add_argument('sqlitedb',
-        help='The database file which should be populated. '
-             'This file will be created if it does not exist.')
-argParser.add_argument('table',
-        help='The table to which to add the data.'
-             'It will be created if it doe snot exist.')
-argParser.add_argument('--headers',
-        help='List of headers, one in each line.',
-        default=None)
-
-group = argParser.add_mutually_exclusive_group()
-group.add_argument('--gzip',
-        help='Assume file uses the gzip compression.',
-        action='store_true')
-group.add_argument('--bz2',
-        help='Assume file uses bz2 compression.',
-        action='store_true')
-
-args = argParser.parse_args()
-
-inputFile = None
-if args.bz2:
-    inputFile = bz2.BZ2File(args.jsonfile, 'rt')
-elif args.gzip:
-    inputFile = gzip.open(args.jsonfile, 'rt')
-else:
-    inputFile = open(args.jsonfile, 'rt')
-
-if args.headers is not None:
-    with open(args.headers, 'rt') as headersFile:
-        providedHeaders = [x.strip() for x in headersFile.readlines()]
-else:
-    providedHeaders = None
-
-types, headers = guess_types(JSONReader(inputFile), headers=providedHeaders)
-num_columns = len(headers)
-inputFile.seek(0)
-
-columns = ','.join(
-    ['"%s" %s' % (header, _type) for (header, _type) in zip(headers, types)]
-    )
-
-conn = sqlite3.connect(args.sqlitedb)
-
-# Cannot handle non-ASCII input?
-conn.text_factory = str
-
-cur = conn.cursor()
-
-try:
-    create_query = 'CREATE TABLE %s (%s)' % (args.table, columns)
-    cur.execute(create_query)
-    logTime('Created table {}'.format(args.table))
-except:
-    logTime('Skipping creation of table {}'.format(args.table))
-
-insert_query = 'INSERT INTO %s VALUES (%s)' % (args.table, ','.join(['?'] * num_columns))
-
-line = 0
-try:
-    for jsonElem in JSONReader(inputFile):
-        line += 1
-        row = [jsonElem[x] if x in jsonElem else '' for x in headers]
+def convertRow(row, types):
+    '''Casts the values of a row to the guessed column types.'''
+    converted = []
+    for x, y in zip(row, types):
         try:
-            row = [
+            converted.append(
                 None if x == ''
                 else float(unicode(x).replace(',', '')) if y == 'real'
                 else int(x) if y == 'integer'
-                else unicode(x) for (x,y) in zip(row, types) ]
-            cur.execute(insert_query, row)
-        except ValueError as e:
-            print("Unable to convert value '%s' to type '%s' on line %d" % (x, y, line), file=sys.stderr)
+                else unicode(x))
+        except ValueError:
+            raise ValueError("Unable to convert value '%s' to type '%s'" % (x, y))
+    return converted
+
+
+def convertRecords(numberedRecords, headers, types, adaptive=False):
+    '''Converts (line, (text, record)) pairs to rows of the column types.
+
+    Yields (line, text, row, newValues, error) tuples, where either row is
+    None and error is the (stage, message) pair of the record which could
+    not be parsed or converted, or error is None. text is the input line of
+    the record, to be stored if it is rejected. If adaptive is set,
+    newValues holds the values of the keys of the record which are not in
+    headers, and is None otherwise. A filtered record, which is None, yields
+    (line, text, None, None, None).'''
+    known = set(headers)
+    for line, (text, jsonElem) in numberedRecords:
+        if jsonElem is None:
+            yield line, text, None, None, None
+            continue
+
+        if isinstance(jsonElem, Unparsed):
+            yield line, text, None, None, ('parse', jsonElem.error)
+            continue
+
+        newValues = None
+        if len(known) != len(headers):
+            # extendSchema appended columns to headers since.
+            known = set(headers)
+        if adaptive and not known.issuperset(jsonElem):
+            newValues = dict((k, v) for k, v in jsonElem.items() if k not in known)
+
+        row = [jsonElem[x] if x in jsonElem else '' for x in headers]
+        try:
+            row, error = convertRow(row, types), None
         except Exception as e:
-            print("Error on line %d: %s" % (line, e), file=sys.stderr)
-except Exception as e:
-    print('General error on line %d: %s' % (line, e), file=sys.stderr)
-    logTime('Rolling back changes')
-    conn.rollback()
-    cur.close()
-else:
-    logTime('Committing to disk')
-    conn.commit()
-    cur.close()
+            row, error = None, ('convert', str(e))
+        yield line, text, row, newValues, error
+
+
+def insertQuery(table, headers):
+    '''Returns the query inserting a row of values of headers into table.'''
+    return 'INSERT INTO %s (%s) VALUES (%s)' % (
+        table,
+        ','.join(['"%s"' % header for header in headers]),
+        ','.join(['?'] * len(headers)))
+
+
+def addColumn(cur, table, headers, types, header, _type):
+    '''Adds a column to table, extending headers and types in place.'''
+    cur.execute('ALTER TABLE %s ADD COLUMN "%s" %s' % (table, header, _type))
+    headers.append(header)
+    types.append(_type)
+    logTime('Added column {} {} to table {}'.format(header, _type, table))
+
+
+def extendSchema(cur, table, headers, types, newValues):
+    '''Adds a column to table for every key of newValues missing from headers.
+
+    The type of each new column is guessed from its value. Returns whether
+    any column was added.'''
+    added = False
+    for key in sorted(newValues.keys()):
+        if key not in headers:
+            _type = guess_types(iter([{key: newValues[key]}]), headers=[key])[0][0]
+            addColumn(cur, table, headers, types, key, _type)
+            added = True
+    return added
+
+
+def completeRow(row, newValues, headers, types):
+    '''Pads a row converted before columns were added to the table, and
+    fills in the converted values of the keys which introduced them.'''
+    row = row + [None] * (len(headers) - len(row))
+    if newValues is not None:
+        for key, value in newValues.items():
+            column = headers.index(key)
+            row[column] = convertRow([value], [types[column]])[0]
+    return row
+
+
+class Dictionary(object):
+    '''Interns the values of a column in the lookup table <table>_<column>,
+    which gives each distinct value an integer id, stored in the column in
+    place of the value.
+
+    The ids of the last cacheSize values seen are kept in memory. Once the
+    cache is full, the least recently used value is evicted, and looked up
+    in the lookup table again if it comes back.'''
+
+    def __init__(self, table, column, _type, cacheSize=100000):
+        self.table = '%s_%s' % (table, column)
+        self.column = column
+        self.type = _type
+        self.cacheSize = cacheSize
+        self.cache = collections.OrderedDict()
+        self.hits, self.misses, self.added = 0, 0, 0
+        self.select_query = 'SELECT "id" FROM %s WHERE "value" = ?' % self.table
+        self.insert_query = 'INSERT INTO %s ("value") VALUES (?)' % self.table
+
+    def create(self, cur):
+        cur.execute('CREATE TABLE IF NOT EXISTS %s ("id" INTEGER PRIMARY KEY, '
+                    '"value" %s UNIQUE)' % (self.table, self.type))
+
+    def intern(self, cur, value):
+        '''Returns the id of the value, adding it to the lookup table if it
+        is new. None stays None.'''
+        if value is None:
+            return None
+
+        valueId = self.cache.get(value)
+        if valueId is not None:
+            self.hits += 1
+            if len(self.cache) >= self.cacheSize:
+                # Recency only matters once values have to be evicted.
+                del self.cache[value]
+                self.cache[value] = valueId
+            return valueId
+
+        self.misses += 1
+        found = cur.execute(self.select_query, (value,)).fetchone()
+        if found is not None:
+            valueId = found[0]
+        else:
+            cur.execute(self.insert_query, (value,))
+            valueId = cur.lastrowid
+            self.added += 1
+        if len(self.cache) >= self.cacheSize:
+            self.cache.popitem(last=False)
+        self.cache[value] = valueId
+        return valueId
+
+    def log(self):
+        seen = self.hits + self.misses
+        logTime('Encoded {} values of column {}, {} of them new, {:.1f}% found in the cache'.format(
+            seen, self.column, self.added, 100.0 * self.hits / seen if seen > 0 else 0))
+
+
+def createDecodedView(conn, table, headers, dictionaries):
+    '''(Re)creates the view <table>_decoded, which shows the rows of table
+    with the values of the encoded columns in place of their ids.'''
+    encoded = dict((x.column, x) for x in dictionaries)
+    columns, joins = [], []
+    for header in headers:
+        if header in encoded:
+            lookup = encoded[header].table
+            columns.append('%s."value" AS "%s"' % (lookup, header))
+            joins.append('LEFT JOIN %s ON %s."id" = %s."%s"' % (lookup, lookup, table, header))
+        else:
+            columns.append('%s."%s"' % (table, header))
+    view = table + '_decoded'
+    conn.execute('DROP VIEW IF EXISTS %s' % view)
+    conn.execute('CREATE VIEW %s AS SELECT %s FROM %s %s' % (
+        view, ', '.join(columns), table, ' '.join(joins)))
+    logTime('Created view {}'.format(view))
+
+
+def convertChunk(task):
+    '''Parses and converts a chunk of JSON lines in a worker process.
+
+    Returns the list of converted (line, text, row, newValues, error) tuples and,
+    if a line could not be processed, a (line, message) pair describing the
+    failure.'''
+    firstLine, lines, headers, types, adaptive, backend, recordFilter = task
+    loads = jsonLoads(backend)
+    records = [(line, (text, parseLine(text, loads, recordFilter)))
+               for line, text in enumerate(lines, firstLine)]
+    try:
+        return list(convertRecords(records, headers, types, adaptive)), None
+    except Exception as e:
+        return [], (firstLine, str(e))
+
+
+def chunkLines(inputFile, firstLine, chunkSize):
+    '''Groups the non-empty lines of inputFile into lists of chunkSize lines.
+
+    Yields (line, lines) pairs, where line is the number of the first line
+    of the chunk.'''
+    chunk = []
+    for text in inputFile:
+        text = text.strip()
+        if len(text) == 0:
+            continue
+
+        chunk.append(text)
+        if len(chunk) >= chunkSize:
+            yield firstLine, chunk
+            firstLine += len(chunk)
+            chunk = []
+
+    if len(chunk) > 0:
+        yield firstLine, chunk
+
+
+def convertParallel(pool, workers, inputFile, firstLine, headers, types,
+                    chunkSize, ordered=False, adaptive=False, backend='json',
+                    recordFilter=None):
+    '''Converts the lines of inputFile in the worker processes of pool.
+
+    Yields the same (line, text, row, newValues, error) tuples as convertRecords.
+    Every chunk is converted with the headers and types as they are when it
+    is submitted. The chunks
+    are yielded in input order if ordered is set, and as soon as they are
+    ready otherwise. At most 2 * workers chunks are in flight at a time.
+    An exception raised while converting a chunk is raised again here.'''
+    results = queue.Queue()
+    pending = {}
+    ready = {}
+    submitted, emitted = 0, 0
+
+    chunks = chunkLines(inputFile, firstLine, chunkSize)
+    exhausted = False
+    while not exhausted or emitted < submitted:
+        while not exhausted and submitted - emitted < 2 * workers:
+            try:
+                chunkLine, chunk = six.advance_iterator(chunks)
+            except StopIteration:
+                exhausted = True
+                break
+
+            task = (chunkLine, chunk, list(headers), list(types), adaptive,
+                    backend, recordFilter)
+            callbacks = {'callback': lambda result, index=submitted: results.put((index, result))}
+            if six.PY3:
+                # A chunk which fails puts its exception in place of its result.
+                callbacks['error_callback'] = lambda e, index=submitted: results.put((index, e))
+            pending[submitted] = pool.apply_async(convertChunk, (task,), **callbacks)
+            submitted += 1
+
+        if emitted == submitted:
+            continue
+
+        while True:
+            try:
+                index, result = results.get(timeout=1)
+                break
+            except queue.Empty:
+                # Python 2 has no error_callback, a failed chunk is only seen
+                # as a finished but unsuccessful result.
+                for asyncResult in pending.values():
+                    if asyncResult.ready() and not asyncResult.successful():
+                        asyncResult.get()
+        del pending[index]
+        if isinstance(result, BaseException):
+            raise result
+        ready[index] = result
+        for index in sorted(ready.keys()):
+            if ordered and index != emitted:
+                break
+
+            converted, failure = ready.pop(index)
+            emitted += 1
+            for result in converted:
+                yield result
+
+            if failure is not None:
+                raise ValueError('Unable to process line %d: %s' % failure)
+
+
+def insertBatch(cur, insert_query, batch, rejects):
+    '''Inserts the rows of a list of (line, row, text) tuples using
+    executemany.
+
+    If a row fails, the rows before it have already been inserted; the
+    failing row is retried alone so that it can be rejected with its line
+    number and input text, and the rest of the batch is sent again.'''
+    while len(batch) > 0:
+        sent = [0]
+
+        def rows():
+            for _, row, _ in batch:
+                sent[0] += 1
+                yield row
+
+        try:
+            cur.executemany(insert_query, rows())
+            return
+        except Exception:
+            failed = max(sent[0] - 1, 0)
+            line, row, text = batch[failed]
+            try:
+                cur.execute(insert_query, row)
+            except Exception as e:
+                rejects.add(cur, line, 'insert', e, text)
+            batch = batch[failed + 1:]
+
+
+def writeShard(shardFile, table, columns, headers, types, chunks, results,
+               backend='json', recordFilter=None, batchSize=1, maxErrors=None):
+    '''Inserts the (firstLine, lines) chunks taken from the chunks queue into
+    table in the shard database, until it gets None. The rejected records go
+    to the rejects table of the shard.
+
+    Puts the number of records filtered out, the counts of rejected records
+    by stage and the error which stopped the writer, or None, into the
+    results queue. After an error, the remaining chunks are taken but not
+    inserted.'''
+    filtered, failure = 0, None
+    rejects = Rejects(table, maxErrors=maxErrors)
+    try:
+        conn = sqlite3.connect(shardFile)
+        applyPragmas(conn, SHARD_PRAGMAS)
+        conn.text_factory = str
+        cur = conn.cursor()
+        cur.execute('CREATE TABLE %s (%s)' % (table, columns))
+        rejects.create(cur)
+        insert_query = insertQuery(table, headers)
+    except Exception as e:
+        failure = '%s: %s' % (shardFile, e)
+
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            break
+        if failure is not None:
+            continue
+
+        try:
+            firstLine, lines = chunk
+            converted, failure = convertChunk(
+                (firstLine, lines, headers, types, False, backend, recordFilter))
+            batch = []
+            for line, text, row, _, error in converted:
+                if error is not None:
+                    stage, message = error
+                    rejects.add(cur, line, stage, message, text)
+                elif row is None:
+                    filtered += 1
+                else:
+                    batch.append((line, row, text))
+                    if len(batch) >= batchSize:
+                        insertBatch(cur, insert_query, batch, rejects)
+                        batch = []
+            insertBatch(cur, insert_query, batch, rejects)
+            if failure is not None:
+                failure = 'Unable to process line %d: %s' % failure
+        except Exception as e:
+            failure = '%s: %s' % (shardFile, e)
+
+    if failure is None:
+        try:
+            rejects.flush(cur)
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            failure = '%s: %s' % (shardFile, e)
+    results.put((filtered, rejects.counts, failure))
+
+
+def checkWriters(writers, exitcodes):
+    '''Raises RuntimeError if one of the writer processes, whose exit codes
+    were exitcodes, crashed or was killed, or if all of them are gone.'''
+    for writer, exitcode in zip(writers, exitcodes):
+        if exitcode not in (None, 0):
+            raise RuntimeError('The shard writer %s exited with code %d' % (writer.name, exitcode))
+    if all(exitcode is not None for exitcode in exitcodes):
+        raise RuntimeError('The shard writers exited without reporting')
+
+
+def writeShards(shardFiles, chunks, table, columns, headers, types,
+                backend='json', recordFilter=None, batchSize=1, progress=None,
+                rejects=None):
+    '''Inserts the (firstLine, lines) chunks into table in the shard
+    databases, each written by a process of its own, which take the chunks
+    from a common queue. The records rejected by the writers are counted in
+    rejects.
+
+    Returns the number of records filtered out. Raises ValueError if a line
+    could not be processed, and RuntimeError if a writer died, rather than
+    waiting on it forever.'''
+    maxErrors = rejects.maxErrors if rejects is not None else None
+    queued = multiprocessing.Queue(2 * len(shardFiles))
+    results = multiprocessing.Queue()
+    writers = [multiprocessing.Process(target=writeShard,
+                                       args=(shardFile, table, columns, headers, types,
+                                             queued, results, backend, recordFilter,
+                                             batchSize, maxErrors))
+               for shardFile in shardFiles]
+    for writer in writers:
+        writer.daemon = True
+        writer.start()
+
+    def put(chunk):
+        while True:
+            exitcodes = [writer.exitcode for writer in writers]
+            try:
+                queued.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                checkWriters(writers, exitcodes)
+
+    for chunk in chunks:
+        if progress is not None:
+            for _ in chunk[1]:
+                progress.count()
+        put(chunk)
+    for writer in writers:
+        put(None)
+
+    # The exit codes are read before waiting, so that a writer which reported
+    # and then exited has its outcome in results already.
+    outcomes = []
+    while len(outcomes) < len(writers):
+        exitcodes = [writer.exitcode for writer in writers]
+        try:
+            outcomes.append(results.get(timeout=1))
+        except queue.Empty:
+            checkWriters(writers, exitcodes)
+    for writer in writers:
+        writer.join()
+
+    failures = [failure for _, _, failure in outcomes if failure is not None]
+    if len(failures) > 0:
+        raise ValueError(failures[0])
+    if rejects is not None:
+        for _, counts, _ in outcomes:
+            rejects.merge(counts)
+    return sum(filtered for filtered, _, _ in outcomes)
+
+
+def mergeShards(cur, table, headers, shardNames, rejects=None, dictionaries=()):
+    '''Copies the rows of table, and of the rejects table, in the attached
+    shard databases into the tables of the main database.
+
+    The shards hold the values of the encoded columns, which are added to
+    the lookup tables of the dictionaries and replaced by their ids.'''
+    encoded = dict((x.column, x) for x in dictionaries)
+    columns = ','.join(['"%s"' % header for header in headers])
+    values = ','.join([
+        '(SELECT "id" FROM main.%s WHERE "value" = s."%s")' % (encoded[header].table, header)
+        if header in encoded else 's."%s"' % header
+        for header in headers])
+    for shardName in shardNames:
+        for dictionary in dictionaries:
+            cur.execute('INSERT OR IGNORE INTO main.%s ("value") SELECT DISTINCT "%s" '
+                        'FROM %s.%s WHERE "%s" IS NOT NULL' % (
+                            dictionary.table, dictionary.column, shardName, table,
+                            dictionary.column))
+            dictionary.added += cur.rowcount
+        cur.execute('INSERT INTO main.%s (%s) SELECT %s FROM %s.%s AS s' % (
+            table, columns, values, shardName, table))
+        logTime('Merged {} rows from shard {}'.format(cur.rowcount, shardName))
+        if rejects is not None:
+            cur.execute('INSERT INTO main.%s SELECT * FROM %s.%s' % (
+                rejects.table, shardName, rejects.table))
+
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('jsonfile',
+            help='The files which contain the json data fields '
+                 'from which to populate the sqlite3 db, imported one after '
+                 'the other. Glob patterns like RC_2015-*.bz2 are expanded. '
+                 'Use - to read from stdin.',
+            nargs='+')
+    argParser.add_argument('sqlitedb',
+            help='The database file which should be populated. '
+                 'This file will be created if it does not exist.')
+    argParser.add_argument('table',
+            help='The table to which to add the data.'
+                 'It will be created if it doe snot exist.')
+    argParser.add_argument('--headers',
+            help='List of headers, one in each line.',
+            default=None)
+    argParser.add_argument('--columns',
+            help='Comma separated list of the keys to load; the others are '
+                 'dropped right after parsing.',
+            default=None)
+    argParser.add_argument('--where',
+            help='Only load the records for which KEY OPERATOR VALUE holds, '
+                 'e.g. "subreddit in (\'pics\', \'funny\')" or '
+                 '"created_utc >= 1420070400". The operators are =, !=, <, '
+                 '<=, >, >=, in and not in, the value is a Python literal. '
+                 'May be repeated; all conditions have to hold.',
+            type=parseCondition,
+            action='append',
+            default=[])
+    argParser.add_argument('--adaptive-schema',
+            help='Add a column to the table whenever a key which is not '
+                 'a column yet appears in the input, instead of dropping it. '
+                 'Also adds the missing columns to an existing table.',
+            action='store_true')
+    argParser.add_argument('--sample-rows',
+            help='Maximum number of records used for guessing column types. '
+                 'Columns with no values in these records are stored as text.',
+            type=int,
+            default=10000)
+    argParser.add_argument('--batch-size',
+            help='Number of rows to send to SQLite with one executemany call.',
+            type=int,
+            default=1)
+    argParser.add_argument('--workers',
+            help='Number of processes which parse and convert the JSON lines. '
+                 'By default, everything is done in a single process.',
+            type=int,
+            default=0)
+    argParser.add_argument('--shards',
+            help='Number of processes which parse, convert and insert the '
+                 'records into shard databases of their own next to the '
+                 'database, which are merged into it at the end with ATTACH '
+                 'and INSERT ... SELECT. Cannot be combined with --workers, '
+                 '--adaptive-schema, --commit-every or --resume.',
+            type=int,
+            default=0)
+    argParser.add_argument('--encode',
+            help='Comma separated list of columns to dictionary-encode. The '
+                 'table stores an integer id in place of each value, the '
+                 'lookup table <table>_<column> the distinct values, and the '
+                 'view <table>_decoded shows the rows with their values.',
+            default=None)
+    argParser.add_argument('--encode-cache',
+            help='Number of values of each encoded column whose ids are kept '
+                 'in memory. The least recently used ones are evicted first.',
+            type=int,
+            default=100000)
+    argParser.add_argument('--max-errors',
+            help='Stop the load, rolling back to the last commit, once more '
+                 'than N records have been rejected. The rejected records '
+                 'are kept in the table <table>_rejects. By default, the '
+                 'load goes on however many records are rejected.',
+            type=int,
+            default=None)
+    argParser.add_argument('--json-backend',
+            help='JSON module used to parse the lines. auto picks the first '
+                 'installed one of orjson, ujson and simdjson. Falls back to '
+                 'json if the chosen module is not installed.',
+            choices=['auto'] + JSON_BACKENDS,
+            default='json')
+    argParser.add_argument('--chunk-size',
+            help='Number of lines sent to a worker process at a time.',
+            type=int,
+            default=10000)
+    argParser.add_argument('--ordered',
+            help='Insert the rows in input order when using --workers.',
+            action='store_true')
+    argParser.add_argument('--commit-every',
+            help='Commit after every N lines, storing the input offset '
+                 'reached so that the load can be continued with --resume. '
+                 'Implies --ordered.',
+            type=int,
+            default=0)
+    argParser.add_argument('--resume',
+            help='Continue after the last commit of an earlier run with '
+                 '--commit-every on the same input.',
+            action='store_true')
+    argParser.add_argument('--read-ahead',
+            help='Number of blocks of about 1 MB of lines which a background '
+                 'thread decompresses ahead of the import, with --gzip or --bz2. '
+                 '0 decompresses inline.',
+            type=int,
+            default=16)
+    argParser.add_argument('--parallel-files',
+            help='Number of input files which are decompressed at the same '
+                 'time, with --gzip or --bz2: the one being imported and the '
+                 'next ones, which are read ahead.',
+            type=int,
+            default=2)
+    argParser.add_argument('--decompress-workers',
+            help='Number of processes which decompress the input, with --bz2 '
+                 'or --gzip. The blocks of bz2 files and the members of '
+                 'concatenated gzip files are decompressed in parallel.',
+            type=int,
+            default=0)
+
+    argParser.add_argument('--fast-load',
+            help='Apply a pragma profile for bulk loading (in-memory journal, '
+                 'no syncing, large cache, exclusive lock) while inserting. '
+                 'The previous settings are restored after the commit.',
+            action='store_true')
+    argParser.add_argument('--pragma',
+            help='Set a pragma while loading, given as NAME=VALUE, e.g. '
+                 'synchronous=FULL. Overrides the --fast-load profile. '
+                 'May be repeated.',
+            action='append',
+            default=[])
+    argParser.add_argument('--index',
+            help='Build an index on TABLE.COLUMN after all rows have been '
+                 'loaded. May be repeated.',
+            action='append',
+            default=[])
+    argParser.add_argument('--progress',
+            help='Log the throughput, the share of the input consumed and where '
+                 'the time goes every N seconds. 0 only logs them at the end.',
+            type=int,
+            default=30)
+    argParser.add_argument('--stats',
+            help='Write the throughput and timing statistics of the load to this '
+                 'file as JSON at the end.',
+            default=None)
+
+    group = argParser.add_mutually_exclusive_group()
+    group.add_argument('--gzip',
+            help='Assume file uses the gzip compression.',
+            action='store_true')
+    group.add_argument('--bz2',
+            help='Assume file uses bz2 compression.',
+            action='store_true')
+
+    args = argParser.parse_args()
+
+    try:
+        fileNames = expandInputs(args.jsonfile)
+    except IOError as e:
+        argParser.error(str(e))
+
+    if args.shards > 0 and (args.workers > 0 or args.adaptive_schema or
+                            args.commit_every > 0 or args.resume):
+        argParser.error('--shards cannot be combined with --workers, '
+                        '--adaptive-schema, --commit-every or --resume')
+
+    if args.headers is not None:
+        with open(args.headers, 'rt') as headersFile:
+            providedHeaders = [x.strip() for x in headersFile.readlines()]
+    else:
+        providedHeaders = None
+
+    if args.columns is not None:
+        columns = [x.strip() for x in args.columns.split(',')]
+        if providedHeaders is not None:
+            columns = [x for x in columns if x in providedHeaders]
+        providedHeaders = columns
+
+    if args.columns is not None or len(args.where) > 0:
+        recordFilter = RecordFilter(providedHeaders if args.columns else None, args.where)
+    else:
+        recordFilter = None
+
+    conn = sqlite3.connect(args.sqlitedb)
+    previousPragmas = applyPragmas(conn, loadPragmas(args.fast_load, args.pragma))
+
+    # Cannot handle non-ASCII input?
+    conn.text_factory = str
+
+    shardFiles = ['%s.shard%d' % (args.sqlitedb, x) for x in range(args.shards)]
+    shardNames = ['shard%d' % x for x in range(args.shards)]
+    for shardFile in shardFiles:
+        if os.path.exists(shardFile):
+            os.remove(shardFile)
+
+    checkpointing = args.commit_every > 0 or args.resume
+    lastCheckpoints = {}
+    if checkpointing:
+        for fileName in fileNames:
+            lastCheckpoints[fileName] = readCheckpoint(conn, args.table, fileName)
+
+    inputs = InputFiles(fileNames, lastCheckpoints if args.resume else {},
+                        useBz2=args.bz2, useGzip=args.gzip,
+                        processes=args.decompress_workers,
+                        readAhead=args.read_ahead, ahead=args.parallel_files)
+    if len(inputs.opened) == 0:
+        logTime('All the inputs have already been imported')
+        applyPragmas(conn, previousPragmas)
+        sys.exit(0)
+    records = inputs.firstLine - 1
+
+    progress = Progress(args.progress, inputs.size, inputs.tell,
+                        inputs.compressedTell if inputs.tellsCompressed else None,
+                        compressed=args.bz2 or args.gzip)
+    inputs.progress = progress
+    checkpoints = collections.deque()
+    lines = recordLines(inputs, inputs.firstLine, args.commit_every, checkpoints)
+    if args.json_backend != 'json':
+        logTime('Parsing JSON with {}'.format(jsonModule(args.json_backend).__name__))
+    reader = enumerate(progress.timed(
+        JSONReader(lines, jsonLoads(args.json_backend), recordFilter), 'parse'), records + 1)
+    sample, skipped = [], [0]
+    if args.adaptive_schema:
+        # Guess the types of all the keys which appear in the sample.
+        parsed = list(itertools.islice(sampleReader(reader, sample, skipped),
+                                       args.sample_rows))
+        sampleHeaders = set(providedHeaders or [])
+        for record in parsed:
+            sampleHeaders.update(record.keys())
+        types, headers = guess_types(iter(parsed), headers=sampleHeaders)
+    else:
+        types, headers = guess_types(sampleReader(reader, sample, skipped),
+                                     headers=providedHeaders,
+                                     max_rows=args.sample_rows)
+    # The first line after the sample, counting the records filtered out.
+    sampleEnd = records + len(sample) + skipped[0] + 1
+    progress.records += skipped[0]
+
+    encodedColumns = [x.strip() for x in args.encode.split(',')] if args.encode else []
+    for column in encodedColumns:
+        if column not in headers:
+            argParser.error('Cannot encode {}, which is not a column of the table'.format(column))
+
+    # The shards hold the values of the encoded columns, the table their ids.
+    shardColumns = ','.join(
+        ['"%s" %s' % (header, _type) for (header, _type) in zip(headers, types)]
+        )
+    columns = ','.join(
+        ['"%s" %s' % (header, 'integer' if header in encodedColumns else _type)
+         for (header, _type) in zip(headers, types)]
+        )
+
+    cur = conn.cursor()
+
+    try:
+        create_query = 'CREATE TABLE %s (%s)' % (args.table, columns)
+        cur.execute(create_query)
+        logTime('Created table {}'.format(args.table))
+    except:
+        logTime('Skipping creation of table {}'.format(args.table))
+        # The columns which hold ids must be the ones encoded now.
+        for x in cur.execute('PRAGMA table_info(%s)' % args.table).fetchall():
+            lookup = cur.execute('SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?',
+                                 ('table', '%s_%s' % (args.table, x[1]))).fetchone()
+            wasEncoded = x[2].lower() == 'integer' and lookup is not None
+            if wasEncoded != (x[1] in encodedColumns):
+                argParser.error('The table {} was created {} --encode {}'.format(
+                    args.table, 'with' if wasEncoded else 'without', x[1]))
+    rejects = Rejects(args.table, maxErrors=args.max_errors)
+    rejects.create(cur)
+
+    indexes = [tuple(x.split('.', 1)) for x in args.index]
+    dropIndexes(conn, indexes)
+
+    if args.adaptive_schema:
+        # Continue from the columns of the table, which may already exist.
+        guessed = dict(zip(headers, types))
+        tableInfo = cur.execute('PRAGMA table_info(%s)' % args.table).fetchall()
+        headers = [x[1] for x in tableInfo]
+        types = [guessed.get(x[1], x[2].lower()) for x in tableInfo]
+        for header in sorted(guessed.keys()):
+            if header not in headers:
+                addColumn(cur, args.table, headers, types, header, guessed[header])
+
+    insert_query = insertQuery(args.table, headers)
+
+    dictionaries = []
+    for column in encodedColumns:
+        index = headers.index(column)
+        dictionary = Dictionary(args.table, column, types[index], args.encode_cache)
+        dictionary.create(cur)
+        dictionaries.append((index, dictionary))
+
+    if args.shards > 0:
+        # The main process only inserts the sample, the shard writers the rest.
+        pool = None
+        converted = convertRecords(iter(sample), headers, types)
+    elif args.workers > 0:
+        pool = multiprocessing.Pool(args.workers)
+        converted = itertools.chain(
+            convertRecords(iter(sample), headers, types,
+                           args.adaptive_schema),
+            convertParallel(pool, args.workers, lines, sampleEnd,
+                            headers, types, args.chunk_size,
+                            ordered=args.ordered or checkpointing,
+                            adaptive=args.adaptive_schema,
+                            backend=args.json_backend,
+                            recordFilter=recordFilter))
+    else:
+        pool = None
+        converted = convertRecords(
+            itertools.chain(sample, reader),
+            headers, types, args.adaptive_schema)
+    converted = progress.timed(converted, 'convert')
+
+    line = 0
+    filtered = skipped[0]
+    batch = []
+    attached = []
+    progress.enter('insert')
+    try:
+        if args.shards > 0:
+            logTime('Writing {} shards'.format(args.shards))
+            filtered += writeShards(
+                shardFiles, chunkLines(lines, sampleEnd, args.chunk_size),
+                args.table, shardColumns, headers, types, backend=args.json_backend,
+                recordFilter=recordFilter, batchSize=args.batch_size, progress=progress,
+                rejects=rejects)
+            # The shards are attached once written, as this connection could
+            # keep them locked otherwise, and before the sample is inserted,
+            # as ATTACH cannot run inside a transaction.
+            for shardFile, shardName in zip(shardFiles, shardNames):
+                conn.execute('ATTACH DATABASE ? AS %s' % shardName, (shardFile,))
+                attached.append(shardName)
+
+        for line, text, row, newValues, error in converted:
+            progress.count()
+            # Everything up to a checkpoint has been handled once a later
+            # line arrives, and nothing after it has been inserted yet.
+            while len(checkpoints) > 0 and checkpoints[0][0] < line:
+                _, fileName, checkpointOffset, checkpointRecords = checkpoints.popleft()
+                insertBatch(cur, insert_query, batch, rejects)
+                batch = []
+                if checkpointing:
+                    rejects.flush(cur)
+                    writeCheckpoint(conn, args.table, fileName,
+                                    checkpointOffset, checkpointRecords)
+
+            if error is not None:
+                stage, message = error
+                rejects.add(cur, line, stage, message, text)
+                continue
+
+            if row is None:
+                filtered += 1
+                continue
+
+            if newValues is not None and \
+                    extendSchema(cur, args.table, headers, types, newValues):
+                insertBatch(cur, insert_query, batch, rejects)
+                batch = []
+                insert_query = insertQuery(args.table, headers)
+
+            if newValues is not None or len(row) < len(headers):
+                try:
+                    row = completeRow(row, newValues, headers, types)
+                except ValueError as e:
+                    rejects.add(cur, line, 'convert', e, text)
+                    continue
+
+            for column, dictionary in dictionaries:
+                row[column] = dictionary.intern(cur, row[column])
+
+            batch.append((line, row, text))
+            if len(batch) >= args.batch_size:
+                insertBatch(cur, insert_query, batch, rejects)
+                batch = []
+
+        insertBatch(cur, insert_query, batch, rejects)
+        rejects.flush(cur)
+
+        if args.shards > 0:
+            progress.enter('merge')
+            mergeShards(cur, args.table, headers, shardNames, rejects,
+                        [x for _, x in dictionaries])
+            progress.leave()
+    except Exception as e:
+        print('General error on line %d: %s' % (line, e), file=sys.stderr)
+        logTime('Rolling back changes')
+        conn.rollback()
+        cur.close()
+    else:
+        if recordFilter is not None:
+            logTime('Skipped {} records which did not match'.format(filtered))
+        rejects.log()
+        logTime('Committing to disk')
+        if checkpointing:
+            for _, fileName, checkpointOffset, checkpointRecords in checkpoints:
+                writeCheckpoint(conn, args.table, fileName,
+                                checkpointOffset, checkpointRecords)
+        conn.commit()
+        cur.close()
+        if len(dictionaries) > 0:
+            for _, dictionary in dictionaries:
+                dictionary.log()
+            createDecodedView(conn, args.table, headers, [x for _, x in dictionaries])
+
+    progress.leave()
+    progress.log()
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+
+    for shardName in attached:
+        conn.execute('DETACH DATABASE %s' % shardName)
+    for shardFile in shardFiles:
+        if os.path.exists(shardFile):
+            os.remove(shardFile)
+
+    createIndexes(conn, indexes)
+    applyPragmas(conn, previousPragmas)
 
-logTime('Finished')
+    if args.stats is not None:
+        progress.write(args.stats)
 
+    logTime('Finished')
@@ -3,14 +3,466 @@ from __future__ import print_function
 import sqlite3
 import gzip
 import bz2
+import os
 import sys
+import time
+import json
+import threading
 import argparse
 import datetime as D
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 def logTime(chkpoint):
     print('*** Checkpoint: {} at \x1b[31m{}\x1b[0m'.format(chkpoint, D.datetime.now()))
     sys.stdout.flush()
 
+
+# Pragmas applied with --fast-load. Every load runs in a single transaction,
+# so the journal only needs to support a rollback, not a crash.
+FAST_LOAD_PRAGMAS = [
+    ('page_size', '65536'),
+    ('journal_mode', 'MEMORY'),
+    ('synchronous', 'OFF'),
+    ('cache_size', '-1048576'),
+    ('temp_store', 'MEMORY'),
+    ('locking_mode', 'EXCLUSIVE'),
+]
+
+
+def loadPragmas(fastLoad, overrides):
+    '''Returns the (name, value) pragmas to use while loading: the fast load
+    profile if requested, with the NAME=VALUE overrides applied on top.'''
+    pragmas = list(FAST_LOAD_PRAGMAS) if fastLoad else []
+    for override in overrides:
+        name, value = override.split('=', 1)
+        names = [x for x, _ in pragmas]
+        if name in names:
+            pragmas[names.index(name)] = (name, value)
+        else:
+            pragmas.append((name, value))
+    return pragmas
+
+
+def applyPragmas(conn, pragmas):
+    '''Sets the (name, value) pragmas and returns their previous values.
+
+    The page_size is a property of the database file and is not returned.'''
+    previous = []
+    for name, value in pragmas:
+        if name != 'page_size':
+            previous.append((name, conn.execute('PRAGMA %s' % name).fetchone()[0]))
+        conn.execute('PRAGMA %s = %s' % (name, value))
+    return previous
+
+
+def dropIndexes(conn, indexes):
+    '''Drops the indexes which createIndexes builds, so that they are not
+    updated row by row while loading into existing tables.'''
+    for table, column in indexes:
+        conn.execute('DROP INDEX IF EXISTS "idx_%s_%s"' % (table, column))
+
+
+def createIndexes(conn, indexes):
+    '''Builds an index on each (table, column) pair, reporting the time
+    each of them took.'''
+    for table, column in indexes:
+        start = D.datetime.now()
+        conn.execute('CREATE INDEX IF NOT EXISTS "idx_%s_%s" ON "%s" ("%s")' %
+                     (table, column, table, column))
+        conn.commit()
+        logTime('Created index on {}.{} in {:.2f}s'.format(
+            table, column, (D.datetime.now() - start).total_seconds()))
+
+
+def readCheckpoint(conn, target, inputName):
+    '''Returns the (offset, records) stored by the last commit of inputName
+    into target, or (0, 0) if there is none.'''
+    conn.execute('CREATE TABLE IF NOT EXISTS _checkpoints '
+                 '("target" TEXT, "input" TEXT, "offset" INTEGER, '
+                 '"records" INTEGER, "time" TEXT, PRIMARY KEY ("target", "input"))')
+    checkpoint = conn.execute('SELECT "offset", "records" FROM _checkpoints '
+                              'WHERE "target" = ? AND "input" = ?',
+                              (target, inputName)).fetchone()
+    return checkpoint if checkpoint is not None else (0, 0)
+
+
+def writeCheckpoint(conn, target, inputName, offset, records):
+    '''Commits, storing the input offset and the number of records read so
+    far in the same transaction.'''
+    conn.execute('INSERT OR REPLACE INTO _checkpoints VALUES (?, ?, ?, ?, ?)',
+                 (target, inputName, offset, records, str(D.datetime.now())))
+    conn.commit()
+    logTime('Committed {} records'.format(records))
+
+
+class Rejects(object):
+    '''Keeps the records which could not be loaded in the <table>_rejects
+    table, with their position in the input, the stage which failed (parse,
+    convert or insert), the error and the raw record. They are written in
+    batches, in the transaction of the load.
+
+    With fileColumn, the name of the input file is kept too, for the inputs
+    whose positions start again with every file.
+
+    Raises ValueError once more than maxErrors records have been rejected.'''
+
+    def __init__(self, table, position='line', maxErrors=None, batchSize=1000,
+                 fileColumn=False):
+        self.table = table + '_rejects'
+        self.position = position
+        self.fileColumn = fileColumn
+        self.maxErrors = maxErrors
+        self.batchSize = batchSize
+        self.pending = []
+        self.counts = {}
+
+    def create(self, cur):
+        cur.execute('CREATE TABLE IF NOT EXISTS %s ("%s" INTEGER, "stage" TEXT, '
+                    '"error" TEXT, "raw" TEXT)' % (self.table, self.position))
+        columns = [x[1] for x in cur.execute('PRAGMA table_info(%s)' % self.table).fetchall()]
+        if self.fileColumn and 'file' not in columns:
+            cur.execute('ALTER TABLE %s ADD COLUMN "file" TEXT' % self.table)
+
+    def add(self, cur, position, stage, error, raw, fileName=None):
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8', 'replace')
+        self.pending.append((position, stage, str(error), raw) +
+                            ((fileName,) if self.fileColumn else ()))
+        if len(self.pending) >= self.batchSize:
+            self.flush(cur)
+        self.merge({stage: 1})
+
+    def merge(self, counts):
+        '''Adds the counts by stage of records rejected elsewhere.'''
+        for stage, count in counts.items():
+            self.counts[stage] = self.counts.get(stage, 0) + count
+        if self.maxErrors is not None and self.total() > self.maxErrors:
+            raise ValueError('More than {} records rejected, see table {}'.format(
+                self.maxErrors, self.table))
+
+    def flush(self, cur):
+        if len(self.pending) > 0:
+            cur.executemany('INSERT INTO %s VALUES (?, ?, ?, ?%s)' % (
+                self.table, ', ?' if self.fileColumn else ''), self.pending)
+            self.pending = []
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def log(self):
+        if self.total() > 0:
+            logTime('Rejected {} records ({}), see table {}'.format(
+                self.total(),
+                ', '.join('{} {}'.format(self.counts[x], x) for x in sorted(self.counts)),
+                self.table))
+
+
+class BackgroundReader(object):
+    '''Reads the lines of a (compressed) file in a background thread.
+
+    The thread reads blocks of about blockSize bytes of lines ahead of the
+    consumer and hands them over through a queue of at most depth blocks, so
+    that decompression overlaps with parsing and inserting. Supports
+    readline(), iteration and tell().'''
+
+    def __init__(self, inputFile, depth, blockSize=1 << 20):
+        # Keep the file open after the thread has read it to the end.
+        self.inputFile = inputFile
+        self.queue = queue.Queue(depth)
+        self.depth = depth
+        self.eof = ''
+        self.lines, self.index = [], 0
+        self.finished = False
+        try:
+            self.position = inputFile.tell()
+        except (IOError, OSError, ValueError):
+            self.position = 0
+        self.blocks, self.totalDepth = 0, 0
+        self.consumerWaits, self.readerWaits = 0, 0
+        # A Progress which counts the time spent waiting for lines as read.
+        self.progress = None
+        thread = threading.Thread(target=self.readBlocks,
+                                  args=(inputFile, blockSize))
+        thread.daemon = True
+        thread.start()
+
+    def readBlocks(self, inputFile, blockSize):
+        try:
+            while True:
+                lines = inputFile.readlines(blockSize)
+                self.put(lines)
+                if len(lines) == 0:
+                    break
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.readerWaits += 1
+            self.queue.put(item)
+
+    def nextBlock(self):
+        if self.finished:
+            return False
+
+        try:
+            item = self.queue.get_nowait()
+        except queue.Empty:
+            self.consumerWaits += 1
+            if self.progress is not None:
+                self.progress.enter('read')
+            item = self.queue.get()
+            if self.progress is not None:
+                self.progress.leave()
+
+        if isinstance(item, Exception):
+            raise item
+
+        self.blocks += 1
+        self.totalDepth += self.queue.qsize()
+        self.lines, self.index = item, 0
+        self.finished = len(item) == 0
+        if not self.finished:
+            # readline returns an empty line of the same type at the end.
+            self.eof = item[0][:0]
+        return not self.finished
+
+    def readline(self):
+        if self.index == len(self.lines) and not self.nextBlock():
+            return self.eof
+
+        line = self.lines[self.index]
+        self.index += 1
+        self.position += len(line)
+        return line
+
+    def __iter__(self):
+        while self.index < len(self.lines) or self.nextBlock():
+            line = self.lines[self.index]
+            self.index += 1
+            self.position += len(line)
+            yield line
+
+    def tell(self):
+        return self.position
+
+    def report(self):
+        '''Logs how full the queue was. A nearly empty queue means that reading
+        is the bottleneck, a nearly full one that the import is.'''
+        logTime('Read {} blocks ahead: average queue depth {:.1f} of {}, '
+                'import waited {} times, reader waited {} times'.format(
+                    self.blocks, float(self.totalDepth) / max(self.blocks, 1),
+                    self.depth, self.consumerWaits, self.readerWaits))
+
+STAGES = ['read', 'parse', 'convert', 'insert', 'other']
+
+
+class Progress(object):
+    '''Measures the throughput of a load and where its time goes.
+
+    The time is split between the stages entered with enter() or by
+    iterating through timed(); the stages nest, and the time outside of any
+    stage counts as other. Reading only counts the time spent waiting for a
+    BackgroundReader; otherwise it is part of parsing.
+
+    Every `every` seconds, count() logs the records per second, the bytes
+    per second of the uncompressed and the compressed input, how much of the
+    input has been consumed with an estimate of the time left, and the share
+    of each stage.'''
+
+    def __init__(self, every=30, totalBytes=None, tell=None, compressedTell=None,
+                 compressed=False):
+        self.every = every
+        # The share consumed of a compressed input is only known from the
+        # position in the compressed file.
+        self.totalBytes = totalBytes if compressedTell is not None or not compressed else None
+        self.tell, self.compressedTell = tell, compressedTell
+        self.records = 0
+        self.firstPosition = self.position(tell) or 0
+        self.firstCompressed = self.position(compressedTell) or 0
+        self.started = self.mark = self.logged = time.time()
+        self.stack = ['other']
+        self.stages = dict((x, 0.0) for x in STAGES)
+
+    def enter(self, stage):
+        now = time.time()
+        self.stages[self.stack[-1]] += now - self.mark
+        self.mark = now
+        self.stack.append(stage)
+
+    def leave(self):
+        now = time.time()
+        self.stages[self.stack.pop()] += now - self.mark
+        self.mark = now
+
+    def timed(self, iterable, stage):
+        '''Yields the items of iterable, counting the time taken to get them
+        as stage. Does what enter() and leave() do, inline, as it runs for
+        every record.'''
+        stages, stack, clock = self.stages, self.stack, time.time
+        iterator = iter(iterable)
+        while True:
+            now = clock()
+            stages[stack[-1]] += now - self.mark
+            self.mark = now
+            stack.append(stage)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                now = clock()
+                stages[stack.pop()] += now - self.mark
+                self.mark = now
+            yield item
+
+    def count(self):
+        self.records += 1
+        if self.every > 0 and self.records % 100 == 0 and \
+                time.time() - self.logged >= self.every:
+            self.log()
+
+    def position(self, tell):
+        try:
+            return tell() if tell is not None else None
+        except (IOError, OSError, ValueError):
+            return None
+
+    def stats(self):
+        '''Returns the statistics of this run so far as a dictionary. The
+        bytes are counted from where the run started.'''
+        now = time.time()
+        seconds = max(now - self.started, 1e-6)
+        stages = dict(self.stages)
+        stages[self.stack[-1]] += now - self.mark
+        stats = {
+            'records': self.records,
+            'seconds': seconds,
+            'records_per_second': self.records / seconds,
+            'stage_seconds': stages,
+        }
+        uncompressed = self.position(self.tell)
+        if uncompressed is not None:
+            stats['bytes'] = uncompressed - self.firstPosition
+            stats['bytes_per_second'] = stats['bytes'] / seconds
+        compressed = self.position(self.compressedTell)
+        if compressed is not None:
+            stats['compressed_bytes'] = compressed - self.firstCompressed
+            stats['compressed_bytes_per_second'] = stats['compressed_bytes'] / seconds
+
+        if self.compressedTell is not None:
+            consumed, rate = compressed, stats.get('compressed_bytes_per_second')
+        else:
+            consumed, rate = uncompressed, stats.get('bytes_per_second')
+        if consumed is not None and self.totalBytes:
+            stats['consumed'] = min(float(consumed) / self.totalBytes, 1.0)
+            if rate > 0:
+                stats['eta_seconds'] = max(self.totalBytes - consumed, 0) / rate
+        return stats
+
+    def log(self):
+        stats = self.stats()
+        parts = ['{} records ({:.0f}/s)'.format(stats['records'], stats['records_per_second'])]
+        if 'bytes' in stats:
+            parts.append('{:.1f} MB ({:.2f} MB/s)'.format(
+                stats['bytes'] / 1e6, stats['bytes_per_second'] / 1e6))
+        if 'compressed_bytes' in stats:
+            parts.append('{:.1f} MB compressed ({:.2f} MB/s)'.format(
+                stats['compressed_bytes'] / 1e6, stats['compressed_bytes_per_second'] / 1e6))
+        if 'consumed' in stats:
+            parts.append('{:.1f}% of the input'.format(100 * stats['consumed']))
+        if 'eta_seconds' in stats:
+            parts.append('ETA {}'.format(D.timedelta(seconds=int(stats['eta_seconds']))))
+        stages = stats['stage_seconds']
+        total = max(sum(stages.values()), 1e-6)
+        parts.append(' '.join('{} {:.0f}%'.format(x, 100 * stages[x] / total)
+                              for x in STAGES if stages[x] > 0))
+        logTime(', '.join(parts))
+        self.logged = time.time()
+
+    def write(self, fileName):
+        '''Writes the statistics as JSON.'''
+        with open(fileName, 'w') as statsFile:
+            json.dump(self.stats(), statsFile, indent=2, sort_keys=True)
+
+
+def compressedTell(inputFile):
+    '''Returns the tell function of the compressed file which inputFile
+    decompresses, or None if it is not exposed, as for bz2 in Python 2.'''
+    rawFile = getattr(inputFile, 'fileobj', None) or getattr(inputFile, '_fp', None)
+    return rawFile.tell if rawFile is not None else None
+
+
+def inputSize(fileName):
+    '''Returns the size of the input file, or None for stdin.'''
+    try:
+        return os.path.getsize(fileName) if fileName != '-' else None
+    except OSError:
+        return None
+
+
+# The days since 1970-01-01 of each date parsed by epochSeconds.
+EPOCH_DAYS = {}
+
+
+def epochSeconds(text):
+    '''Returns the seconds since 1970-01-01 of a YYYY-MM-DD HH:MM:SS UTC
+    timestamp, which may use a T between the date and the time and end with
+    a fraction of a second or a Z.
+
+    The fields are read at their fixed positions rather than with strptime,
+    and the days of each date are only computed once.'''
+    if text[4:5] != '-' or text[7:8] != '-' or text[13:14] != ':' or text[16:17] != ':':
+        raise ValueError('Not a timestamp: {}'.format(text))
+    date = text[:10]
+    days = EPOCH_DAYS.get(date)
+    if days is None:
+        days = (D.date(int(text[0:4]), int(text[5:7]), int(text[8:10])) -
+                D.date(1970, 1, 1)).days
+        EPOCH_DAYS[date] = days
+    return days * 86400 + int(text[11:13]) * 3600 + int(text[14:16]) * 60 + int(text[17:19])
+
+
+def epochMilliseconds(text):
+    '''Returns the milliseconds since 1970-01-01 of a timestamp read by
+    epochSeconds.'''
+    fraction = text[20:23].rstrip('Z') if text[19:20] == '.' else ''
+    return epochSeconds(text) * 1000 + (int(fraction.ljust(3, '0')) if fraction else 0)
+
+
+def createTimeView(conn, table, columns, timeColumns, textFormat, unit):
+    '''(Re)creates the view <table>_decoded, which shows the rows of table
+    with the epoch timestamps of timeColumns as text in textFormat, a
+    strftime format.'''
+    if unit == 'ms':
+        textFormat = textFormat.replace('%S', '%f')
+    fields = []
+    for column in columns:
+        if column in timeColumns:
+            value = '"%s" / 1000.0' % column if unit == 'ms' else '"%s"' % column
+            fields.append("strftime('%s', %s, 'unixepoch') AS \"%s\"" % (textFormat, value, column))
+        else:
+            fields.append('"%s"' % column)
+    view = table + '_decoded'
+    conn.execute('DROP VIEW IF EXISTS %s' % view)
+    conn.execute('CREATE VIEW %s AS SELECT %s FROM %s' % (view, ', '.join(fields), table))
+    logTime('Created view {}'.format(view))
+
+
+def columnType(cur, table, column):
+    '''Returns the declared type of the column of table.'''
+    for x in cur.execute('PRAGMA table_info(%s)' % table).fetchall():
+        if x[1] == column:
+            return x[2].upper()
+    return None
+
+
 argParser = argparse.ArgumentParser()
 argParser.add_argument('clusterFile',
         help='The file to read clusters from.')
@@ -19,6 +471,63 @@ argParser.add_argument('sqlitedb',
 argParser.add_argument('table_prefix',
         help='The prefix of table names in SQLite.')
 
+argParser.add_argument('--fast-load',
+        help='Apply a pragma profile for bulk loading (in-memory journal, '
+             'no syncing, large cache, exclusive lock) while inserting. '
+             'The previous settings are restored after the commit.',
+        action='store_true')
+argParser.add_argument('--pragma',
+        help='Set a pragma while loading, given as NAME=VALUE, e.g. '
+             'synchronous=FULL. Overrides the --fast-load profile. '
+             'May be repeated.',
+        action='append',
+        default=[])
+argParser.add_argument('--index',
+        help='Build an index on TABLE.COLUMN after all rows have been '
+             'loaded. May be repeated.',
+        action='append',
+        default=[])
+argParser.add_argument('--no-default-indexes',
+        help='Do not build the default indexes of this script.',
+        action='store_true')
+argParser.add_argument('--commit-every',
+        help='Commit after every N blocks, storing the input offset reached '
+             'so that the load can be continued with --resume.',
+        type=int,
+        default=0)
+argParser.add_argument('--resume',
+        help='Continue after the last commit of an earlier run with '
+             '--commit-every on the same input.',
+        action='store_true')
+argParser.add_argument('--read-ahead',
+        help='Number of blocks of about 1 MB of lines which a background '
+             'thread decompresses ahead of the import, with --gzip or --bz2. '
+             '0 decompresses inline.',
+        type=int,
+        default=16)
+argParser.add_argument('--epoch',
+        help='Store the timestamps as integer seconds (s) or milliseconds '
+             '(ms) since 1970-01-01 UTC rather than as text, and add the '
+             'view <table>_decoded which shows them as text.',
+        choices=['s', 'ms'],
+        default=None)
+argParser.add_argument('--max-errors',
+        help='Stop the load, rolling back to the last commit, once more than '
+             'N blocks have been rejected. The rejected blocks are kept in '
+             'the table <table_prefix>_rejects. By default, the load goes on '
+             'however many blocks are rejected.',
+        type=int,
+        default=None)
+argParser.add_argument('--progress',
+        help='Log the throughput, the share of the input consumed and where '
+             'the time goes every N seconds. 0 only logs them at the end.',
+        type=int,
+        default=30)
+argParser.add_argument('--stats',
+        help='Write the throughput and timing statistics of the load to this '
+             'file as JSON at the end.',
+        default=None)
+
 group = argParser.add_mutually_exclusive_group()
 group.add_argument('--gzip',
         help='Assume file uses the gzip compression.',
@@ -35,8 +544,10 @@ elif args.gzip:
     inputFile = gzip.open(args.clusterFile, 'rU')
 else:
     inputFile = open(args.clusterFile, 'rU')
+rawTell = compressedTell(inputFile)
 
 conn = sqlite3.connect(args.sqlitedb)
+previousPragmas = applyPragmas(conn, loadPragmas(args.fast_load, args.pragma))
 
 # Always return bytestring instead of unicode.
 conn.text_factory = str
@@ -44,17 +555,24 @@ conn.text_factory = str
 cur = conn.cursor()
 
 def blockReader(inputFile):
-    '''Read one cluster block from the passed file.'''
+    '''Read one cluster block from the passed file.
+
+    The lines of the block are kept in its 'lines'. As the blocks are only
+    delimited by the counts of their lines, reading stops at a malformed
+    block, which is yielded as a dict with its 'error' and the 'raw' lines
+    read of it instead.'''
     line = 0
     A_line, B_line, C_line = '', '', ''
     while True:
+        lines = []
         try:
-            block = {}
+            block = {'lines': lines}
 
             line += 1
             A_line = inputFile.readline()
             if A_line == '':
                 break
+            lines.append(A_line)
 
             A_data = A_line.split('\t')
             B_count = int(A_data[0])
@@ -70,7 +588,9 @@ def blockReader(inputFile):
                 B = block['B'][b_cluster_num]
 
                 line += 1
-                B_line = inputFile.readline().strip()
+                B_line = inputFile.readline()
+                lines.append(B_line)
+                B_line = B_line.strip()
                 B_data = B_line.split('\t')
                 B['total_phrase_frequency'] = int(B_data[0])
 
@@ -85,7 +605,9 @@ def blockReader(inputFile):
                     C = B['C'][c_cluster_num]
 
                     line += 1
-                    C_line = inputFile.readline().strip()
+                    C_line = inputFile.readline()
+                    lines.append(C_line)
+                    C_line = C_line.strip()
                     C_data = C_line.split('\t')
                     C['timestamp'] = C_data[0]
                     C['frequency_in_url'] = int(C_data[1])
@@ -94,7 +616,9 @@ def blockReader(inputFile):
 
                 line += 1
                 # There is an empty line after each C block, except last one
-                emptyLine = inputFile.readline().strip()
+                emptyLine = inputFile.readline()
+                lines.append(emptyLine)
+                emptyLine = emptyLine.strip()
                 assert emptyLine == '', "Empty line after C block not found. Found '{}' instead".format(emptyLine)
 
             yield block
@@ -102,11 +626,9 @@ def blockReader(inputFile):
         except IOError as e:
             print('Encountered error: ', e, ' at line: ', line)
             break
-        except IndexError as e:
-            print('Encountered index error: ', e, ' at line: ', line)
-            print('A_line = ', A_line)
-            print('B_line = ', B_line)
-            print('C_line = ', C_line)
+        except Exception as e:
+            yield {'error': '%s at line %d' % (e, line), 'raw': ''.join(lines)}
+            logTime('Stopped reading at the malformed block ending at line {}'.format(line))
             break
 
 # Skip the header of the file
@@ -123,8 +645,12 @@ table_derivative = table_prefix + '_derivatives'
 columns_derivative = '"cluster_id" INTEGER, "total_phrase_frequency" INTEGER, "num_urls" INTEGER, "phrase" TEXT, "phrase_id" INTEGER'
 insert_derivative = 'INSERT INTO %s VALUES (?, ?, ?, ?, ?)' % (table_derivative,)
 
+# With --epoch, the timestamps are numbers.
+timeType = 'INTEGER' if args.epoch else 'TEXT'
+toEpoch = epochMilliseconds if args.epoch == 'ms' else epochSeconds
+
 table_phrase_info = table_prefix + '_phrase_info'
-columns_phrase_info = '"cluster_id" INTEGER, "phrase_id" INTEGER, "frequency_in_url" INTEGER, "timestamp" TEXT, "url_type" TEXT, "url" TEXT'
+columns_phrase_info = '"cluster_id" INTEGER, "phrase_id" INTEGER, "frequency_in_url" INTEGER, "timestamp" %s, "url_type" TEXT, "url" TEXT' % timeType
 insert_phrase_info = 'INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?)' % (table_phrase_info,)
 
 for table, columns in [(table_root, columns_root),
@@ -137,11 +663,49 @@ for table, columns in [(table_root, columns_root),
     except:
         logTime('Skipping creation of table {}'.format(table))
 
-blockNum = 0
-
+if columnType(cur, table_phrase_info, 'timestamp') != timeType:
+    argParser.error('The table {} was created {} --epoch'.format(
+        table_phrase_info, 'without' if args.epoch else 'with'))
+
+rejects = Rejects(table_prefix, position='block', maxErrors=args.max_errors)
+rejects.create(cur)
+
+default_indexes = [(table_root, 'cluster_id'),
+                   (table_derivative, 'cluster_id'),
+                   (table_derivative, 'phrase_id'),
+                   (table_phrase_info, 'cluster_id'),
+                   (table_phrase_info, 'phrase_id')]
+indexes = ([] if args.no_default_indexes else default_indexes) + \
+          [tuple(x.split('.', 1)) for x in args.index]
+dropIndexes(conn, indexes)
+
+checkpointing = args.commit_every > 0 or args.resume
+offset, records = 0, 0
+if checkpointing:
+    lastCheckpoint = readCheckpoint(conn, args.table_prefix, args.clusterFile)
+    if args.resume:
+        offset, records = lastCheckpoint
+        inputFile.seek(offset)
+        logTime('Resuming after block {}'.format(records))
+
+if (args.bz2 or args.gzip) and args.read_ahead > 0:
+    inputFile = BackgroundReader(inputFile, args.read_ahead)
+
+progress = Progress(args.progress, inputSize(args.clusterFile), inputFile.tell, rawTell,
+                    compressed=args.bz2 or args.gzip)
+if isinstance(inputFile, BackgroundReader):
+    inputFile.progress = progress
+
+blockNum = records
+
+progress.enter('insert')
 try:
-    for block in blockReader(inputFile):
+    for block in progress.timed(blockReader(inputFile), 'parse'):
         blockNum += 1
+        progress.count()
+        if 'error' in block:
+            rejects.add(cur, blockNum, 'parse', block['error'], block['raw'])
+            continue
 
         try:
             cur.execute(insert_root, (block['cluster_size'],
@@ -159,12 +723,17 @@ try:
                     cur.execute(insert_phrase_info, (block['cluster_id'],
                                                      B['phrase_id'],
                                                      C['frequency_in_url'],
-                                                     C['timestamp'],
+                                                     toEpoch(C['timestamp']) if args.epoch
+                                                     else C['timestamp'],
                                                      C['url_type'],
                                                      C['url']))
 
         except Exception as e:
-            print("Error in block %d: %s" % (blockNum, e), file=sys.stderr)
+            rejects.add(cur, blockNum, 'insert', e, ''.join(block['lines']))
+
+        if args.commit_every > 0 and blockNum % args.commit_every == 0:
+            rejects.flush(cur)
+            writeCheckpoint(conn, args.table_prefix, args.clusterFile, inputFile.tell(), blockNum)
 
 except Exception as e:
     print('General error in block %d: %s' % (blockNum, e), file=sys.stderr)
@@ -172,9 +741,30 @@ except Exception as e:
     conn.rollback()
     cur.close()
 else:
+    rejects.flush(cur)
+    rejects.log()
     logTime('Committing to disk')
-    conn.commit()
+    if checkpointing:
+        writeCheckpoint(conn, args.table_prefix, args.clusterFile, inputFile.tell(), blockNum)
+    else:
+        conn.commit()
     cur.close()
+    if args.epoch:
+        createTimeView(conn, table_phrase_info,
+                       ['cluster_id', 'phrase_id', 'frequency_in_url', 'timestamp',
+                        'url_type', 'url'],
+                       ['timestamp'], '%Y-%m-%d %H:%M:%S', args.epoch)
+
+progress.leave()
+progress.log()
+if isinstance(inputFile, BackgroundReader):
+    inputFile.report()
+
+createIndexes(conn, indexes)
+applyPragmas(conn, previousPragmas)
+
+if args.stats is not None:
+    progress.write(args.stats)
 
 logTime('Finished')
 
@@ -1,20 +1,30 @@
 #!/usr/bin/env python
 from __future__ import print_function
 
+import argparse
+import bz2
+import gzip
+import lzma
 import sqlite3
 import os
+import time
+import json
+import datetime
 import xml.etree.cElementTree as etree
+from xml.parsers import expat
 import logging
+import multiprocessing
+import queue
 
 ANATHOMY = {
     'Badges': {
-        'Id': 'INTEGER',
+        'Id': 'INTEGER PRIMARY KEY',
         'UserId': 'INTEGER',
         'Name': 'TEXT',
         'Date': 'DATETIME',
     },
     'Comments': {
-        'Id': 'INTEGER',
+        'Id': 'INTEGER PRIMARY KEY',
         'PostId': 'INTEGER',
         'Score': 'INTEGER',
         'Text': 'TEXT',
@@ -23,7 +33,7 @@ ANATHOMY = {
         'UserDisplayName': 'TEXT'
     },
     'Posts': {
-        'Id': 'INTEGER',
+        'Id': 'INTEGER PRIMARY KEY',
         'PostTypeId': 'INTEGER',  # 1: Question, 2: Answer
         'ParentID': 'INTEGER',  # (only present if PostTypeId is 2)
         'AcceptedAnswerId': 'INTEGER',  # (only present if PostTypeId is 1)
@@ -46,7 +56,7 @@ ANATHOMY = {
         'ClosedDate': 'DATETIME'
     },
     'Votes': {
-        'Id': 'INTEGER',
+        'Id': 'INTEGER PRIMARY KEY',
         'PostId': 'INTEGER',
         'UserId': 'INTEGER',
         'VoteTypeId': 'INTEGER',
@@ -67,7 +77,7 @@ ANATHOMY = {
         'BountyAmount': 'INTEGER'
     },
     'PostHistory': {
-        'Id': 'INTEGER',
+        'Id': 'INTEGER PRIMARY KEY',
         'PostHistoryTypeId': 'INTEGER',
         'PostId': 'INTEGER',
         'RevisionGUID': 'INTEGER',
@@ -78,7 +88,7 @@ ANATHOMY = {
         'Text': 'TEXT'
     },
     'PostLinks': {
-        'Id': 'INTEGER',
+        'Id': 'INTEGER PRIMARY KEY',
         'CreationDate': 'DATETIME',
         'PostId': 'INTEGER',
         'RelatedPostId': 'INTEGER',
@@ -86,7 +96,7 @@ ANATHOMY = {
         'LinkTypeId': 'INTEGER'
     },
     'Users': {
-        'Id': 'INTEGER',
+        'Id': 'INTEGER PRIMARY KEY',
         'Reputation': 'INTEGER',
         'CreationDate': 'DATETIME',
         'DisplayName': 'TEXT',
@@ -103,7 +113,7 @@ ANATHOMY = {
         'ProfileImageUrl': 'TEXT'
     },
     'Tags': {
-        'Id': 'INTEGER',
+        'Id': 'INTEGER PRIMARY KEY',
         'TagName': 'TEXT',
         'Count': 'INTEGER',
         'ExcerptPostId': 'INTEGER',
@@ -112,60 +122,916 @@ ANATHOMY = {
 }
 
 
+# Pragmas applied with --fast-load. Each file is loaded in a single
+# transaction, so the journal only needs to support a rollback, not a crash.
+FAST_LOAD_PRAGMAS = [
+    ('page_size', '65536'),
+    ('journal_mode', 'MEMORY'),
+    ('synchronous', 'OFF'),
+    ('cache_size', '-1048576'),
+    ('temp_store', 'MEMORY'),
+    ('locking_mode', 'EXCLUSIVE'),
+]
+
+# Pragmas of the shard databases written with --shards. They are removed
+# once merged, so they need no journal at all.
+SHARD_PRAGMAS = [
+    ('page_size', '65536'),
+    ('journal_mode', 'OFF'),
+    ('synchronous', 'OFF'),
+    ('cache_size', '-65536'),
+    ('temp_store', 'MEMORY'),
+    ('locking_mode', 'EXCLUSIVE'),
+]
+
+
+def load_pragmas(fast_load, overrides):
+    '''Returns the (name, value) pragmas to use while loading: the fast load
+    profile if requested, with the NAME=VALUE overrides applied on top.'''
+    pragmas = list(FAST_LOAD_PRAGMAS) if fast_load else []
+    for override in overrides:
+        name, value = override.split('=', 1)
+        names = [x for x, _ in pragmas]
+        if name in names:
+            pragmas[names.index(name)] = (name, value)
+        else:
+            pragmas.append((name, value))
+    return pragmas
+
+
+def apply_pragmas(db, pragmas):
+    '''Sets the (name, value) pragmas and returns their previous values.
+
+    The page_size is a property of the database file and is not returned.'''
+    previous = []
+    for name, value in pragmas:
+        if name != 'page_size':
+            previous.append((name, db.execute('PRAGMA %s' % name).fetchone()[0]))
+        db.execute('PRAGMA %s = %s' % (name, value))
+    return previous
+
+
+# The columns referring to the rows of other tables, indexed after the load
+# unless --no-default-indexes is given.
+FOREIGN_KEYS = ['PostId', 'UserId', 'OwnerUserId', 'ParentID', 'RelatedPostId']
+
+
+# The tags of every post, split from Posts.Tags. The tag names are staged in
+# _post_tags while loading and only turned into the Id of the tags once
+# Tags has been loaded.
+POST_TAGS = ('CREATE TABLE IF NOT EXISTS PostTags (PostId INTEGER, TagId INTEGER, '
+             'PRIMARY KEY (PostId, TagId)) WITHOUT ROWID')
+STAGED_POST_TAGS = 'CREATE TABLE IF NOT EXISTS _post_tags (PostId INTEGER, TagName TEXT)'
+
+
+def split_tags(tags):
+    '''Returns the names of the tags packed into the Tags of a post, as
+    <python><sqlite> or, in newer dumps, |python|sqlite|.'''
+    if tags.startswith('<') and tags.endswith('>'):
+        return tags[1:-1].split('><')
+    if tags.startswith('|') and tags.endswith('|'):
+        return [x for x in tags[1:-1].split('|') if x]
+    return [tags]
+
+
+def stage_post_tags(db, tag_batch, failed):
+    '''Stages the (row_num, PostId, TagName) tags of tag_batch, except those
+    of the rows which failed to be inserted.'''
+    rows = [(post_id, name) for row_num, post_id, name in tag_batch if row_num not in failed]
+    if rows:
+        db.executemany('INSERT INTO _post_tags VALUES (?, ?)', rows)
+
+
+def resolve_post_tags(db, indexes=()):
+    '''Moves the (PostId, TagName) pairs staged while loading Posts into
+    PostTags, with the Id of the tag of that name. Keeps them staged until
+    Tags has been loaded. The (table, column) indexes on PostTags are
+    dropped while it is filled and built again after, in whichever run
+    loads the second of Posts and Tags.'''
+    tables = set(row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+    if '_post_tags' not in tables:
+        return
+    if 'Tags' not in tables:
+        print('The tags of the posts are kept in _post_tags until Tags is loaded')
+        return
+    db.execute(POST_TAGS)
+    drop_indexes(db, indexes)
+    rows = db.execute('INSERT OR IGNORE INTO PostTags (PostId, TagId) '
+                      'SELECT _post_tags.PostId, Tags.Id FROM _post_tags '
+                      'JOIN Tags ON Tags.TagName = _post_tags.TagName').rowcount
+    unknown = db.execute('SELECT COUNT(*) FROM _post_tags WHERE NOT EXISTS '
+                         '(SELECT 1 FROM Tags WHERE Tags.TagName = _post_tags.TagName)').fetchone()[0]
+    if unknown > 0:
+        logging.warning('{0} tags of posts are not in Tags'.format(unknown))
+    db.execute('DROP TABLE _post_tags')
+    db.commit()
+    print('Inserted {0} rows into PostTags'.format(rows))
+    create_indexes(db, indexes)
+
+
+def drop_indexes(db, indexes):
+    '''Drops the indexes which create_indexes builds, so that they are not
+    updated row by row while loading into existing tables.'''
+    for table, column in indexes:
+        db.execute('DROP INDEX IF EXISTS "idx_{0}_{1}"'.format(table, column))
+
+
+def create_indexes(db, indexes):
+    '''Builds an index on each (table, column) pair, reporting the time
+    each of them took.'''
+    for table, column in indexes:
+        start = time.time()
+        db.execute('CREATE INDEX IF NOT EXISTS "idx_{0}_{1}" ON "{0}" ("{1}")'.format(
+            table, column))
+        db.commit()
+        print('Created index on {0}.{1} in {2:.2f}s'.format(table, column, time.time() - start))
+
+
+def read_checkpoint(db, table, file_path):
+    '''Returns the (offset, records) stored by the last commit of file_path
+    into table, or (0, 0) if there is none.'''
+    db.execute('CREATE TABLE IF NOT EXISTS _checkpoints '
+               '("target" TEXT, "input" TEXT, "offset" INTEGER, '
+               '"records" INTEGER, "time" TEXT, PRIMARY KEY ("target", "input"))')
+    checkpoint = db.execute('SELECT "offset", "records" FROM _checkpoints '
+                            'WHERE "target" = ? AND "input" = ?',
+                            (table, file_path)).fetchone()
+    return checkpoint if checkpoint is not None else (0, 0)
+
+
+def write_checkpoint(db, table, file_path, offset, records):
+    '''Commits, storing the number of rows read so far in the same
+    transaction. The offset is only known once the whole file has been read,
+    and is None before.'''
+    db.execute('INSERT OR REPLACE INTO _checkpoints VALUES (?, ?, ?, ?, ?)',
+               (table, file_path, offset, records, str(datetime.datetime.now())))
+    db.commit()
+
+
+STAGES = ['read', 'parse', 'convert', 'insert', 'merge', 'other']
+
+
+class Progress(object):
+    '''Measures the throughput of a load and where its time goes.
+
+    The time is split between the stages entered with enter() or by
+    iterating through timed(); the stages nest, and the time outside of any
+    stage counts as other.
+
+    Every `every` seconds, count() prints the rows per second, the bytes per
+    second of the input, how much of it has been consumed with an estimate
+    of the time left, and the share of each stage.'''
+
+    def __init__(self, every=30, total_bytes=None, tell=None):
+        self.every = every
+        self.total_bytes = total_bytes
+        self.tell = tell
+        self.records = 0
+        self.first_position = self.position() or 0
+        self.started = self.mark = self.logged = time.time()
+        self.stack = ['other']
+        self.stages = dict((x, 0.0) for x in STAGES)
+
+    def enter(self, stage):
+        now = time.time()
+        self.stages[self.stack[-1]] += now - self.mark
+        self.mark = now
+        self.stack.append(stage)
+
+    def leave(self):
+        now = time.time()
+        self.stages[self.stack.pop()] += now - self.mark
+        self.mark = now
+
+    def timed(self, iterable, stage):
+        '''Yields the items of iterable, counting the time taken to get them
+        as stage.'''
+        iterator = iter(iterable)
+        while True:
+            self.enter(stage)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                self.leave()
+            yield item
+
+    def count(self):
+        self.records += 1
+        if self.every > 0 and self.records % 100 == 0 and \
+                time.time() - self.logged >= self.every:
+            self.log()
+
+    def merge(self, stats):
+        '''Adds the rows and the stage times of the stats of a load run by
+        another process. Its time replaces the time spent here waiting for
+        it.'''
+        self.records += stats['records']
+        for stage, seconds in stats['stage_seconds'].items():
+            self.stages[stage] += seconds
+        self.mark = time.time()
+
+    def position(self):
+        try:
+            return self.tell() if self.tell is not None else None
+        except (IOError, OSError, ValueError):
+            return None
+
+    def stats(self):
+        '''Returns the statistics of this run so far as a dictionary. The
+        bytes are counted from where the run started.'''
+        now = time.time()
+        seconds = max(now - self.started, 1e-6)
+        stages = dict(self.stages)
+        stages[self.stack[-1]] += now - self.mark
+        stats = {
+            'records': self.records,
+            'seconds': seconds,
+            'records_per_second': self.records / seconds,
+            'stage_seconds': stages,
+        }
+        position = self.position()
+        if position is not None:
+            stats['bytes'] = position - self.first_position
+            stats['bytes_per_second'] = stats['bytes'] / seconds
+            if self.total_bytes:
+                stats['consumed'] = min(float(position) / self.total_bytes, 1.0)
+                if stats['bytes'] > 0:
+                    stats['eta_seconds'] = (max(self.total_bytes - position, 0) /
+                                            stats['bytes_per_second'])
+        return stats
+
+    def log(self):
+        stats = self.stats()
+        parts = ['{0} rows ({1:.0f}/s)'.format(stats['records'], stats['records_per_second'])]
+        if 'bytes' in stats:
+            parts.append('{0:.1f} MB ({1:.2f} MB/s)'.format(
+                stats['bytes'] / 1e6, stats['bytes_per_second'] / 1e6))
+        if 'consumed' in stats:
+            parts.append('{0:.1f}% of the input'.format(100 * stats['consumed']))
+        if 'eta_seconds' in stats:
+            parts.append('ETA {0}'.format(datetime.timedelta(seconds=int(stats['eta_seconds']))))
+        stages = stats['stage_seconds']
+        total = max(sum(stages.values()), 1e-6)
+        parts.append(' '.join('{0} {1:.0f}%'.format(x, 100 * stages[x] / total)
+                              for x in STAGES if stages[x] > 0))
+        print('\n' + ', '.join(parts), flush=True)
+        self.logged = time.time()
+
+    def write(self, file_name):
+        '''Writes the statistics as JSON.'''
+        with open(file_name, 'w') as stats_file:
+            json.dump(self.stats(), stats_file, indent=2, sort_keys=True)
+
+
+# The days since 1970-01-01 of each date parsed by epoch_seconds.
+EPOCH_DAYS = {}
+
+
+def epoch_seconds(text):
+    '''Returns the seconds since 1970-01-01 of a YYYY-MM-DDTHH:MM:SS[.fff]
+    UTC timestamp.
+
+    The fields are read at their fixed positions rather than with strptime,
+    and the days of each date are only computed once.'''
+    if text[4:5] != '-' or text[7:8] != '-' or text[13:14] != ':' or text[16:17] != ':':
+        raise ValueError('Not a timestamp: {}'.format(text))
+    date = text[:10]
+    days = EPOCH_DAYS.get(date)
+    if days is None:
+        days = (datetime.date(int(text[0:4]), int(text[5:7]), int(text[8:10])) -
+                datetime.date(1970, 1, 1)).days
+        EPOCH_DAYS[date] = days
+    return days * 86400 + int(text[11:13]) * 3600 + int(text[14:16]) * 60 + int(text[17:19])
+
+
+def epoch_milliseconds(text):
+    '''Returns the milliseconds since 1970-01-01 of a timestamp read by
+    epoch_seconds.'''
+    fraction = text[20:23] if text[19:20] == '.' else ''
+    return epoch_seconds(text) * 1000 + (int(fraction.ljust(3, '0')) if fraction else 0)
+
+
+def create_time_view(db, table, columns, time_columns, unit):
+    '''(Re)creates the view <table>_decoded, which shows the rows of table
+    with the epoch timestamps of time_columns as text, in the format of the
+    dump.'''
+    text_format = '%Y-%m-%dT%H:%M:%f' if unit == 'ms' else '%Y-%m-%dT%H:%M:%S'
+    fields = []
+    for column in columns:
+        if column in time_columns:
+            value = '{0} / 1000.0'.format(column) if unit == 'ms' else column
+            fields.append("strftime('{0}', {1}, 'unixepoch') AS {2}".format(
+                text_format, value, column))
+        else:
+            fields.append(column)
+    view = table + '_decoded'
+    db.execute('DROP VIEW IF EXISTS {0}'.format(view))
+    db.execute('CREATE VIEW {0} AS SELECT {1} FROM {2}'.format(view, ', '.join(fields), table))
+
+
+def insert_rows(db, query, batch):
+    '''Inserts the (row_num, values) pairs of batch with one executemany.
+    A failing row is logged and skipped, and the rest of the batch is sent
+    again after it, as the rows before it have been inserted already.
+    Returns the set of the row numbers which failed.'''
+    failed = set()
+    while batch:
+        sent = [0]
+
+        def values():
+            for row_num, row in batch:
+                sent[0] += 1
+                yield row
+
+        try:
+            db.executemany(query, values())
+            break
+        except Exception as e:
+            failing = max(sent[0] - 1, 0)
+            logging.warning('Row {0}: {1}'.format(batch[failing][0], e))
+            print('x', end='', flush=True)
+            failed.add(batch[failing][0])
+            batch = batch[failing + 1:]
+    return failed
+
+
+# The extensions of the files of a table in the dump, in the order they are
+# looked for, and the function which opens each compressed kind.
+DUMP_EXTENSIONS = ['.xml', '.xml.gz', '.xml.bz2', '.xml.xz']
+DECOMPRESSORS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+
+def dump_file_path(dump_path, table):
+    '''Returns the path of the file holding table in dump_path, which may be
+    compressed with gzip, bz2 or xz.'''
+    for extension in DUMP_EXTENSIONS:
+        file_path = os.path.join(dump_path, table + extension)
+        if os.path.exists(file_path):
+            return file_path
+    raise IOError('There is no {0} in {1}'.format(
+        ', '.join(table + x for x in DUMP_EXTENSIONS), dump_path))
+
+
+def open_dump(raw_file, file_path):
+    '''Returns the binary file reading the XML of the dump file opened as
+    raw_file, decompressing it as it goes if it is compressed.'''
+    decompressor = DECOMPRESSORS.get(os.path.splitext(file_path)[1])
+    return decompressor(raw_file) if decompressor is not None else raw_file
+
+
+def iterparse_rows(xml_file):
+    '''Yields the attributes of every element of the XML file, as parsed by
+    ElementTree.'''
+    for events, element in etree.iterparse(xml_file):
+        yield element.attrib
+        element.clear()
+
+
+def expat_rows(xml_file, chunk_size=1 << 16):
+    '''Yields the attributes of every element of the XML file, like
+    iterparse_rows, but takes them from the start tags reported by expat
+    rather than building an element for each. The file is parsed by chunks
+    of chunk_size bytes.'''
+    rows = []
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = lambda name, attributes: rows.append(attributes)
+    while True:
+        data = xml_file.read(chunk_size)
+        parser.Parse(data, not data)
+        for attributes in rows:
+            yield attributes
+        del rows[:]
+        if not data:
+            break
+
+
+def column_type(db, table, column):
+    '''Returns the declared type of the column of table, or None when there
+    is no such table or column.'''
+    for row in db.execute('PRAGMA table_info({0})'.format(table)).fetchall():
+        if row[1] == column:
+            return row[2].upper()
+    return None
+
+
+def table_definition(create_query, table, fields, time_columns, without_rowid=False):
+    '''Returns the statement creating table with the (name, type) fields,
+    where the time_columns hold epoch numbers.'''
+    sql_create = create_query.format(
+        table=table,
+        fields=', '.join(['{0} {1}'.format(name, 'INTEGER' if name in time_columns else type)
+                          for name, type in fields.items()]))
+    return sql_create + ' WITHOUT ROWID' if without_rowid else sql_create
+
+
+def load_file(db, table_name, file_path, fields, progress,
+              done_bytes=0,
+              create_query='CREATE TABLE IF NOT EXISTS {table} ({fields})',
+              insert_query='INSERT INTO {table} ({columns}) VALUES ({values})',
+              records=0,
+              commit_every=0,
+              time_columns=(),
+              epoch=None,
+              batch_size=1000,
+              parser='expat',
+              without_rowid=(),
+              post_tags=True):
+    '''Creates table_name with the (name, type) fields and inserts the rows
+    of the XML file at file_path into it, skipping the first `records` ones.
+    With commit_every, commits with a checkpoint every commit_every rows;
+    the rest is left to the caller to commit. The rows are read by
+    expat_rows, or by iterparse_rows if parser is 'iterparse'. The tables
+    in without_rowid are created WITHOUT ROWID. With post_tags, the tags of
+    the Posts are staged in _post_tags along with the rows.
+
+    Returns the number of rows read and whether there were errors.'''
+    errors = False
+    print("Opening {0}".format(os.path.basename(file_path)))
+    # The position is taken in the file as stored, compressed or not.
+    with open(file_path, 'rb') as raw_file:
+        xml_file = open_dump(raw_file, file_path)
+        progress.tell = lambda: done_bytes + raw_file.tell()
+        rows = iterparse_rows(xml_file) if parser == 'iterparse' else expat_rows(xml_file)
+        to_epoch = epoch_milliseconds if epoch == 'ms' else epoch_seconds
+
+        sql_create = table_definition(create_query, table_name, fields, time_columns,
+                                      table_name in without_rowid)
+        print('Creating table {0}'.format(table_name))
+
+        try:
+            logging.info(sql_create)
+            db.execute(sql_create)
+        except Exception as e:
+            logging.warning('During creation of table:')
+            logging.warning(e)
+            errors = True
+        if post_tags and table_name == 'Posts':
+            db.execute(STAGED_POST_TAGS)
+
+        # Every row is inserted into all the columns, the attributes it
+        # lacks as NULL, so that one statement serves the whole table.
+        # The attributes are matched to the columns case-insensitively,
+        # like SQLite does (ParentId fills ParentID).
+        columns = list(fields.keys())
+        positions = dict((name.lower(), i) for i, name in enumerate(columns))
+        attribute_positions = {}
+        time_positions = [positions[name.lower()] for name in time_columns]
+        query = insert_query.format(table=table_name,
+                                    columns=', '.join(columns),
+                                    values=', '.join(['?'] * len(columns)))
+        logging.info(query)
+        batch = []
+        tag_batch = []
+        tags_position = positions['tags'] if post_tags and table_name == 'Posts' else None
+        id_position = positions.get('id')
+
+        # The rows committed before can only be skipped after parsing them.
+        row_num = 0
+        for attributes in progress.timed(rows, 'parse'):
+            try:
+                if attributes:
+                    row_num += 1
+                    if row_num <= records:
+                        continue
+
+                    progress.count()
+                    values = [None] * len(columns)
+                    for key, value in attributes.items():
+                        position = attribute_positions.get(key)
+                        if position is None:
+                            if key.lower() not in positions:
+                                raise ValueError('table {0} has no column named {1}'
+                                                 .format(table_name, key))
+                            position = attribute_positions[key] = positions[key.lower()]
+                        values[position] = value
+                    for position in time_positions:
+                        if values[position] is not None:
+                            values[position] = to_epoch(values[position])
+                    batch.append((row_num, values))
+                    if tags_position is not None and values[tags_position]:
+                        tag_batch.extend((row_num, values[id_position], name)
+                                         for name in split_tags(values[tags_position]))
+
+                    checkpoint = commit_every > 0 and row_num % commit_every == 0
+                    if len(batch) >= batch_size or checkpoint:
+                        failed = insert_rows(db, query, batch)
+                        errors |= len(failed) > 0
+                        stage_post_tags(db, tag_batch, failed)
+                        batch, tag_batch = [], []
+                    if checkpoint:
+                        write_checkpoint(db, table_name, file_path, None, row_num)
+            except Exception as e:
+                logging.warning(e)
+                print('x', end='', flush=True)
+                errors = True
+        failed = insert_rows(db, query, batch)
+        errors |= len(failed) > 0
+        stage_post_tags(db, tag_batch, failed)
+        print("\n")
+    return row_num, errors
+
+
+def write_shard(shard_file, files, results, options):
+    '''Loads the (table, file_path, fields, time_columns) files taken from the
+    files queue into tables of the shard database with load_file, until it
+    gets None.
+
+    Puts (table, shard_file, rows, errors, stats, failure) into the results
+    queue for every file, where failure is the error which stopped the
+    writer, or None.
+    After an error, the remaining files are taken but not loaded.'''
+    failure = None
+    try:
+        db = sqlite3.connect(shard_file)
+        apply_pragmas(db, SHARD_PRAGMAS)
+    except Exception as e:
+        failure = '{0}: {1}'.format(shard_file, e)
+
+    while True:
+        task = files.get()
+        if task is None:
+            break
+        table_name, file_path, fields, time_columns = task
+        progress = Progress(0)
+        rows, errors = 0, False
+        if failure is None:
+            try:
+                progress.enter('insert')
+                rows, errors = load_file(db, table_name, file_path, fields, progress,
+                                         time_columns=time_columns, **options)
+                db.commit()
+                progress.leave()
+            except Exception as e:
+                failure = '{0}: {1}'.format(shard_file, e)
+        results.put((table_name, shard_file, rows, errors, progress.stats(), failure))
+
+    if failure is None:
+        db.close()
+
+
+def check_writers(writers, exitcodes):
+    '''Raises RuntimeError if one of the writer processes, whose exit codes
+    were exitcodes, crashed or was killed, or if all of them are gone.'''
+    for writer, exitcode in zip(writers, exitcodes):
+        if exitcode not in (None, 0):
+            raise RuntimeError('The shard writer {0} exited with code {1}'.format(
+                writer.name, exitcode))
+    if all(exitcode is not None for exitcode in exitcodes):
+        raise RuntimeError('The shard writers exited without reporting')
+
+
+def write_shards(shard_files, tasks, progress, options):
+    '''Loads the (table, file_path, fields, time_columns) files into the shard
+    databases,
+    each written by a process of its own, which take the files from a common
+    queue, largest first. The rows and the time of the writers are added to
+    progress.
+
+    Returns the shard file holding each table and whether there were errors.
+    Raises ValueError if a writer failed, and RuntimeError if a writer died
+    before reporting all its tables.'''
+    queued = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    for task in sorted(tasks, key=lambda task: os.path.getsize(task[1]), reverse=True):
+        queued.put(task)
+    writers = [multiprocessing.Process(target=write_shard,
+                                       args=(shard_file, queued, results, options))
+               for shard_file in shard_files]
+    for writer in writers:
+        writer.daemon = True
+        writer.start()
+        queued.put(None)
+
+    sizes = dict((table_name, os.path.getsize(file_path))
+                 for table_name, file_path, _, _ in tasks)
+    done_bytes = [0]
+    progress.tell = lambda: done_bytes[0]
+    shard_of, failures, errors = {}, [], False
+    for _ in tasks:
+        while True:
+            # Read before waiting, so that a writer which reported and then
+            # exited has its result in results already.
+            exitcodes = [writer.exitcode for writer in writers]
+            try:
+                result = results.get(timeout=1)
+                break
+            except queue.Empty:
+                check_writers(writers, exitcodes)
+        table_name, shard_file, rows, table_errors, stats, failure = result
+        shard_of[table_name] = shard_file
+        done_bytes[0] += sizes[table_name]
+        progress.merge(stats)
+        errors |= table_errors
+        if failure is not None:
+            failures.append(failure)
+        else:
+            print('Loaded {0} rows into {1}'.format(rows, table_name))
+            if progress.every > 0:
+                progress.log()
+    for writer in writers:
+        writer.join()
+
+    if len(failures) > 0:
+        raise ValueError(failures[0])
+    return shard_of, errors
+
+
 def dump_files(file_names, anathomy,
                dump_path='.',
                dump_database_name='stackoverflow.sqlite',
                create_query='CREATE TABLE IF NOT EXISTS {table} ({fields})',
                insert_query='INSERT INTO {table} ({columns}) VALUES ({values})',
                log_filename='so-parser.log',
-               level=logging.INFO):
+               level=logging.INFO,
+               pragmas=(),
+               commit_every=0,
+               resume=False,
+               progress_every=30,
+               stats_file=None,
+               epoch=None,
+               batch_size=1000,
+               shards=0,
+               parser='expat',
+               without_rowid=(),
+               indexes=None,
+               analyze=True,
+               post_tags=True,
+               post_tags_indexes=None):
+    '''Loads the XML files of the file_names tables into the database, then
+    builds the (table, column) indexes, by default those on the FOREIGN_KEYS
+    columns, and runs ANALYZE. With post_tags, the tags of the Posts are
+    split into PostTags, whose post_tags_indexes, by default the one on
+    PostTags.TagId, are built once it is filled.'''
     logging.basicConfig(filename=os.path.join(dump_path, log_filename),
                         level=level)
     errors = False
     db = sqlite3.connect(os.path.join(dump_path, dump_database_name))
-    for file in file_names:
-        print("Opening {0}.xml".format(file))
-        with open(os.path.join(dump_path, file + '.xml')) as xml_file:
-            tree = etree.iterparse(xml_file)
+    previous_pragmas = apply_pragmas(db, pragmas)
+    checkpointing = commit_every > 0 or resume
+    file_paths = dict((file, dump_file_path(dump_path, file)) for file in file_names)
+    file_sizes = dict((file, os.path.getsize(file_paths[file])) for file in file_names)
+    # With epoch, the DATETIME columns hold numbers.
+    time_columns = dict((file, set(name for name, type in anathomy[file].items()
+                                   if type == 'DATETIME') if epoch else set())
+                        for file in file_names)
+    options = dict(create_query=create_query, insert_query=insert_query,
+                   epoch=epoch, batch_size=batch_size, parser=parser,
+                   without_rowid=without_rowid, post_tags=post_tags)
+    if indexes is None:
+        indexes = [(file, column) for file in file_names for column in anathomy[file]
+                   if column in FOREIGN_KEYS]
+    if post_tags_indexes is None:
+        post_tags_indexes = [('PostTags', 'TagId')]
+    if post_tags and 'Posts' in file_names:
+        db.execute(POST_TAGS)
+    drop_indexes(db, indexes)
+    # The position in the input counts the bytes of the files done before.
+    done_bytes = 0
+    progress = Progress(progress_every, sum(file_sizes.values()))
+
+    if shards > 0:
+        # Every file goes to a single shard, which keeps the order of its rows.
+        shard_files = [os.path.join(dump_path, '{0}.shard{1}'.format(dump_database_name, x))
+                       for x in range(min(shards, len(file_sizes)))]
+        for shard_file in shard_files:
+            if os.path.exists(shard_file):
+                os.remove(shard_file)
+        try:
+            print('Writing {0} shards'.format(len(shard_files)))
+            shard_of, errors = write_shards(
+                shard_files,
+                [(file, file_paths[file], anathomy[file],
+                  time_columns[file])
+                 for file in file_names],
+                progress, options)
+            done_bytes = sum(file_sizes.values())
+
+            # The shards are attached once written, as this connection could
+            # keep them locked otherwise.
+            progress.enter('merge')
+            for x, shard_file in enumerate(shard_files):
+                db.execute('ATTACH DATABASE ? AS shard{0}'.format(x), (shard_file,))
+            for file in file_names:
+                db.execute(table_definition(create_query, file, anathomy[file],
+                                            time_columns[file], file in without_rowid))
+                columns = ', '.join(anathomy[file].keys())
+                shard = 'shard{0}'.format(shard_files.index(shard_of[file]))
+                rows = db.execute('INSERT INTO main.{0} ({1}) SELECT {1} FROM {2}.{0}'
+                                  .format(file, columns, shard)).rowcount
+                print('Merged {0} rows of {1} from {2}'.format(rows, file, shard))
+                if post_tags and file == 'Posts':
+                    db.execute(STAGED_POST_TAGS)
+                    db.execute('INSERT INTO main._post_tags SELECT * FROM {0}._post_tags'
+                               .format(shard))
+            db.commit()
+            for x in range(len(shard_files)):
+                db.execute('DETACH DATABASE shard{0}'.format(x))
+            for file in file_names:
+                if time_columns[file]:
+                    create_time_view(db, file, list(anathomy[file].keys()),
+                                     time_columns[file], epoch)
+            progress.leave()
+        finally:
+            for shard_file in shard_files:
+                if os.path.exists(shard_file):
+                    os.remove(shard_file)
+    else:
+        for file in file_names:
+            file_path = file_paths[file]
+            file_size = file_sizes[file]
+            offset, records = 0, 0
+            if checkpointing:
+                last_checkpoint = read_checkpoint(db, file, file_path)
+                if resume:
+                    offset, records = last_checkpoint
+                    if offset == file_size:
+                        print("Skipping {0}, it has already been imported".format(
+                            os.path.basename(file_path)))
+                        done_bytes += file_size
+                        continue
+
             table_name = file
+            progress.enter('insert')
+            row_num, file_errors = load_file(db, table_name, file_path, anathomy[table_name],
+                                             progress, done_bytes=done_bytes, records=records,
+                                             commit_every=commit_every,
+                                             time_columns=time_columns[table_name], **options)
+            errors |= file_errors
+            if checkpointing:
+                write_checkpoint(db, table_name, file_path, file_size, row_num)
+            else:
+                db.commit()
+            if time_columns[table_name]:
+                create_time_view(db, table_name, list(anathomy[table_name].keys()),
+                                 time_columns[table_name], epoch)
+            progress.leave()
+            done_bytes += file_size
 
-            sql_create = create_query.format(
-                table=table_name,
-                fields=", ".join(['{0} {1}'.format(name, type) for name, type in anathomy[table_name].items()]))
-            print('Creating table {0}'.format(table_name))
+    progress.tell = lambda: done_bytes
+    progress.log()
 
-            try:
-                logging.info(sql_create)
-                db.execute(sql_create)
-            except Exception as e:
-                logging.warning('During creation of table:')
-                logging.warning(e)
-                errors = True
+    resolve_post_tags(db, post_tags_indexes)
+    create_indexes(db, indexes)
+    if analyze:
+        start = time.time()
+        db.execute('ANALYZE')
+        db.commit()
+        print('Analyzed the database in {0:.2f}s'.format(time.time() - start))
+    apply_pragmas(db, previous_pragmas)
 
-            for events, row in tree:
-                try:
-                    if row.attrib.values():
-                        logging.debug(row.attrib.items())
-                        keys, values = list(zip(*row.attrib.items()))
-                        query = insert_query.format(
-                            table=table_name,
-                            columns=', '.join(keys),
-                            values=('?, ' * len(values))[:-2])
-                        db.execute(query, values)
-                        # print('.', end='', flush=True)
-                except Exception as e:
-                    logging.warning(e)
-                    print('x', end='', flush=True)
-                    errors = True
-                finally:
-                    row.clear()
-            print("\n")
-            db.commit()
-            del (tree)
+    if stats_file is not None:
+        progress.write(stats_file)
 
     if errors:
         print("\nThere were errors.\n")
 
 
 if __name__ == '__main__':
-    dump_files(ANATHOMY.keys(), ANATHOMY)
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('dump_path',
+            help='The directory holding the files of the dump (Posts.xml, '
+                 'Users.xml, ...), which may also be compressed as '
+                 'Posts.xml.gz, Posts.xml.bz2 or Posts.xml.xz.',
+            nargs='?',
+            default='.')
+    argParser.add_argument('--database',
+            help='The SQLite database to fill. Defaults to stackoverflow.sqlite '
+                 'in the directory of the dump.',
+            default=None)
+    argParser.add_argument('--tables',
+            help='Comma separated tables to import, out of {0}. Defaults to '
+                 'all of them.'.format(', '.join(ANATHOMY)),
+            default=None)
+    argParser.add_argument('--fast-load',
+            help='Apply a pragma profile for bulk loading (in-memory journal, '
+                 'no syncing, large cache, exclusive lock) while inserting. '
+                 'The previous settings are restored after the commit.',
+            action='store_true')
+    argParser.add_argument('--pragma',
+            help='Set a pragma while loading, given as NAME=VALUE, e.g. '
+                 'synchronous=FULL. Overrides the --fast-load profile. '
+                 'May be repeated.',
+            action='append',
+            default=[])
+    argParser.add_argument('--commit-every',
+            help='Commit after every N rows, so that an interrupted import '
+                 'can be continued with --resume.',
+            type=int,
+            default=0)
+    argParser.add_argument('--resume',
+            help='Skip the files which have been imported completely and the '
+                 'rows committed from the others by an earlier run with '
+                 '--commit-every.',
+            action='store_true')
+    argParser.add_argument('--epoch',
+            help='Store the DATETIME columns as integer seconds (s) or '
+                 'milliseconds (ms) since 1970-01-01 UTC rather than as '
+                 'text, and add the view <table>_decoded which shows them '
+                 'as text.',
+            choices=['s', 'ms'],
+            default=None)
+    argParser.add_argument('--progress',
+            help='Print the throughput, the share of the input consumed and '
+                 'where the time goes every N seconds. 0 only prints them at '
+                 'the end.',
+            type=int,
+            default=30)
+    argParser.add_argument('--stats',
+            help='Write the throughput and timing statistics of the load to '
+                 'this file as JSON at the end.',
+            default=None)
+    argParser.add_argument('--batch-size',
+            help='Number of rows to send to SQLite with one executemany call.',
+            type=int,
+            default=1000)
+    argParser.add_argument('--shards',
+            help='Number of processes which parse and insert the files into '
+                 'shard databases of their own next to the database, which '
+                 'are merged into it at the end with ATTACH and INSERT ... '
+                 'SELECT. Cannot be combined with --commit-every or --resume.',
+            type=int,
+            default=0)
+
+    argParser.add_argument('--without-rowid',
+            help='Comma separated tables to create WITHOUT ROWID, which '
+                 'stores their rows in the index of their Id. It can save '
+                 'space for tables of small rows such as Votes or PostLinks.',
+            default='')
+    argParser.add_argument('--index',
+            help='Build an index on TABLE.COLUMN after all rows have been '
+                 'loaded. May be repeated.',
+            action='append',
+            default=[])
+    argParser.add_argument('--no-default-indexes',
+            help='Do not build the default indexes on the {0} columns and '
+                 'PostTags.TagId.'.format(
+                ', '.join(FOREIGN_KEYS)),
+            action='store_true')
+    argParser.add_argument('--no-post-tags',
+            help='Do not split the Tags of the Posts into the PostTags '
+                 'table of (PostId, TagId) pairs.',
+            action='store_true')
+    argParser.add_argument('--no-analyze',
+            help='Do not run ANALYZE at the end.',
+            action='store_true')
+    argParser.add_argument('--parser',
+            help='How to read the rows: expat takes their attributes from '
+                 'the parser directly, iterparse builds an ElementTree '
+                 'element for each row first.',
+            choices=['expat', 'iterparse'],
+            default='expat')
+
+    args = argParser.parse_args()
+    tables = list(ANATHOMY.keys())
+    if args.tables is not None:
+        tables = [x.strip() for x in args.tables.split(',') if x.strip()]
+        for table in tables:
+            if table not in ANATHOMY:
+                argParser.error('Unknown table {0}, the tables are {1}'.format(
+                    table, ', '.join(ANATHOMY)))
+    without_rowid = [x.strip() for x in args.without_rowid.split(',') if x.strip()]
+    for table in without_rowid:
+        if table not in ANATHOMY:
+            argParser.error('Unknown table {0}, the tables are {1}'.format(
+                table, ', '.join(ANATHOMY)))
+    indexes = [] if args.no_default_indexes else \
+        [(table, column) for table in tables for column in ANATHOMY[table]
+         if column in FOREIGN_KEYS]
+    indexes += [tuple(x.split('.', 1)) for x in args.index]
+    for table in tables:
+        try:
+            dump_file_path(args.dump_path, table)
+        except IOError as e:
+            argParser.error(str(e))
+    if args.shards > 0 and (args.commit_every > 0 or args.resume):
+        argParser.error('--shards cannot be combined with --commit-every or --resume')
+    database = os.path.abspath(args.database) if args.database is not None else 'stackoverflow.sqlite'
+    if os.path.exists(os.path.join(args.dump_path, database)):
+        # The DATETIME columns of existing tables must hold what --epoch loads.
+        db = sqlite3.connect(os.path.join(args.dump_path, database))
+        for table in tables:
+            for column, type in ANATHOMY[table].items():
+                existing = column_type(db, table, column) if type == 'DATETIME' else None
+                if existing is not None and (existing == 'INTEGER') != (args.epoch is not None):
+                    argParser.error('The table {0} was created {1} --epoch'.format(
+                        table, 'without' if args.epoch else 'with'))
+        db.close()
+    dump_files(tables, ANATHOMY,
+               dump_path=args.dump_path,
+               dump_database_name=database,
+               pragmas=load_pragmas(args.fast_load, args.pragma),
+               commit_every=args.commit_every,
+               resume=args.resume,
+               progress_every=args.progress,
+               stats_file=args.stats,
+               epoch=args.epoch,
+               batch_size=args.batch_size,
+               shards=args.shards,
+               parser=args.parser,
+               without_rowid=without_rowid,
+               indexes=indexes,
+               analyze=not args.no_analyze,
+               post_tags=not args.no_post_tags,
+               post_tags_indexes=[] if args.no_default_indexes else [('PostTags', 'TagId')])
@@ -0,0 +1,94 @@
+'''The scripts are copied and run independently of each other, so the code
+they share is pasted into each of them. These tests check that the copies
+have stayed identical, so that a fix made to one copy is made to all.
+
+The scripts are compared as text, as some of them only run on Python 2.
+so2sqlite.py is left out: it is written for Python 3 and has helpers of its
+own.'''
+
+import glob
+import os
+import re
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPTS = sorted(x for x in glob.glob(os.path.join(ROOT, '*2sqlite.py'))
+                 if os.path.basename(x) != 'so2sqlite.py')
+
+# The classes, functions and constants which every script defining them
+# must define the same way. STAGES is not among them, as it lists the
+# stages of each script.
+SHARED = [
+    # Instrumentation
+    'logTime', 'Progress', 'BackgroundReader', 'Rejects',
+    # Pragmas, indexes and checkpoints
+    'FAST_LOAD_PRAGMAS', 'loadPragmas', 'applyPragmas', 'dropIndexes',
+    'createIndexes', 'readCheckpoint', 'writeCheckpoint', 'columnType',
+    'inputSize',
+    # Timestamps
+    'epochSeconds', 'epochMilliseconds', 'createTimeView',
+    # Parallel decompression
+    'BZ2_BLOCK_MAGIC', 'BZ2_EOS_MAGIC', 'BZ2_HEADER', 'GZIP_MAGIC',
+    'readBits', 'findBits', 'bz2Boundaries', 'bz2Ranges',
+    'decompressBz2Range', 'decompressBz2Sequential', 'plausibleMember',
+    'gzipRanges', 'decompressGzipRange', 'decompressRange',
+    'ParallelDecompressor',
+    # Shards
+    'checkWriters',
+]
+
+
+def brackets(line):
+    '''Returns the number of brackets which line opens but does not close.'''
+    return sum(line.count(x) for x in '([{') - sum(line.count(x) for x in ')]}')
+
+
+def definition(source, name):
+    '''Returns the source of the top-level class, function or assignment of
+    name in source, or None if there is none.'''
+    match = re.search(r'^(?:(?:class|def) %s\b|%s = )' % (name, name), source, re.M)
+    if match is None:
+        return None
+    lines = source[match.start():].split('\n')
+    assignment = lines[0].startswith(name + ' = ')
+    end, depth = 1, brackets(lines[0]) if assignment else 0
+    # The body goes on while the lines are indented, blank, or close the
+    # brackets of an assignment.
+    while end < len(lines) and (lines[end][:1] in ('', ' ') or depth > 0):
+        if assignment:
+            depth += brackets(lines[end])
+        end += 1
+    return '\n'.join(lines[:end]).rstrip()
+
+
+class SharedCodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sources = {}
+        for script in SCRIPTS:
+            with open(script) as sourceFile:
+                self.sources[os.path.basename(script)] = sourceFile.read()
+
+    def test_copies_are_identical(self):
+        for name in SHARED:
+            copies = dict((script, definition(source, name))
+                          for script, source in self.sources.items())
+            copies = dict((script, x) for script, x in copies.items() if x is not None)
+            self.assertGreater(len(copies), 1, '%s is not shared by several scripts' % name)
+            first = sorted(copies)[0]
+            differing = sorted(x for x in copies if copies[x] != copies[first])
+            self.assertEqual(differing, [], '%s differs between %s and %s' % (
+                name, first, ', '.join(differing)))
+
+    def test_definition(self):
+        source = ('A = [\n    1,\n]\n\ndef f(x):\n    return \'[%s\' % x\n\n\n'
+                  'class B(object):\n    pass\nC = 1\n')
+        self.assertEqual(definition(source, 'A'), 'A = [\n    1,\n]')
+        self.assertEqual(definition(source, 'f'), 'def f(x):\n    return \'[%s\' % x')
+        self.assertEqual(definition(source, 'B'), 'class B(object):\n    pass')
+        self.assertIsNone(definition(source, 'D'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+'''Loads small StackExchange dumps with so2sqlite.py, which needs Python 3.'''
+
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'so2sqlite.py')
+
+POSTS = '''<?xml version="1.0" encoding="utf-8"?>
+<posts>
+  <row Id="1" PostTypeId="1" Title="First" Tags="&lt;python&gt;&lt;sqlite&gt;" />
+  <row Id="2" PostTypeId="1" Title="Second" Tags="&lt;sqlite&gt;&lt;unknown&gt;" />
+  <row Id="3" PostTypeId="2" ParentID="1" />
+</posts>
+'''
+
+TAGS = '''<?xml version="1.0" encoding="utf-8"?>
+<tags>
+  <row Id="10" TagName="python" Count="1" />
+  <row Id="20" TagName="sqlite" Count="2" />
+</tags>
+'''
+
+
+@unittest.skipIf(sys.version_info[0] < 3, 'so2sqlite.py needs Python 3')
+class PostTagsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name, content in [('Posts.xml', POSTS), ('Tags.xml', TAGS)]:
+            with open(os.path.join(self.directory, name), 'w') as xmlFile:
+                xmlFile.write(content)
+        self.database = os.path.join(self.directory, 'so.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self, tables, *options):
+        subprocess.check_call([sys.executable, SCRIPT, self.directory, '--database',
+                               self.database, '--tables', tables] + list(options),
+                              stdout=subprocess.DEVNULL)
+
+    def query(self, sql):
+        db = sqlite3.connect(self.database)
+        try:
+            return db.execute(sql).fetchall()
+        finally:
+            db.close()
+
+    def assertPostTags(self, indexed=True):
+        self.assertEqual(self.query('SELECT PostId, TagId FROM PostTags ORDER BY PostId, TagId'),
+                         [(1, 10), (1, 20), (2, 20)])
+        self.assertEqual(self.query("SELECT name FROM sqlite_master WHERE type = 'table' "
+                                    "AND name = '_post_tags'"), [])
+        self.assertEqual(self.query("SELECT name FROM sqlite_master WHERE type = 'index' "
+                                    "AND tbl_name = 'PostTags'"),
+                         [('idx_PostTags_TagId',)] if indexed else [])
+
+    def test_same_run(self):
+        self.load('Posts,Tags')
+        self.assertPostTags()
+
+    def test_posts_then_tags(self):
+        self.load('Posts')
+        self.assertEqual(self.query('SELECT COUNT(*) FROM _post_tags'), [(4,)])
+        self.load('Tags')
+        self.assertPostTags()
+
+    def test_tags_then_posts(self):
+        self.load('Tags')
+        self.load('Posts')
+        self.assertPostTags()
+
+    def test_no_default_indexes(self):
+        self.load('Posts', '--no-default-indexes')
+        self.load('Tags', '--no-default-indexes')
+        self.assertPostTags(indexed=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
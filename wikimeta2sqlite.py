@@ -3,15 +3,947 @@ from __future__ import print_function
 import sqlite3
 import bz2
 import gzip
+import zlib
+import io
+import os
 import sys
+import time
+import json
+import threading
+import collections
+import multiprocessing
 import argparse
 import datetime as D
+from binascii import hexlify, unhexlify
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 def logTime(chkpoint):
     print('*** Checkpoint: {} at \x1b[31m{}\x1b[0m'.format(chkpoint, D.datetime.now()))
     sys.stdout.flush()
 
 
+# Pragmas applied with --fast-load. Every load runs in a single transaction,
+# so the journal only needs to support a rollback, not a crash.
+FAST_LOAD_PRAGMAS = [
+    ('page_size', '65536'),
+    ('journal_mode', 'MEMORY'),
+    ('synchronous', 'OFF'),
+    ('cache_size', '-1048576'),
+    ('temp_store', 'MEMORY'),
+    ('locking_mode', 'EXCLUSIVE'),
+]
+
+# Pragmas of the shard databases written with --shards. They are removed
+# once merged, so they need no journal at all.
+SHARD_PRAGMAS = [
+    ('page_size', '65536'),
+    ('journal_mode', 'OFF'),
+    ('synchronous', 'OFF'),
+    ('cache_size', '-65536'),
+    ('temp_store', 'MEMORY'),
+    ('locking_mode', 'EXCLUSIVE'),
+]
+
+
+def loadPragmas(fastLoad, overrides):
+    '''Returns the (name, value) pragmas to use while loading: the fast load
+    profile if requested, with the NAME=VALUE overrides applied on top.'''
+    pragmas = list(FAST_LOAD_PRAGMAS) if fastLoad else []
+    for override in overrides:
+        name, value = override.split('=', 1)
+        names = [x for x, _ in pragmas]
+        if name in names:
+            pragmas[names.index(name)] = (name, value)
+        else:
+            pragmas.append((name, value))
+    return pragmas
+
+
+def applyPragmas(conn, pragmas):
+    '''Sets the (name, value) pragmas and returns their previous values.
+
+    The page_size is a property of the database file and is not returned.'''
+    previous = []
+    for name, value in pragmas:
+        if name != 'page_size':
+            previous.append((name, conn.execute('PRAGMA %s' % name).fetchone()[0]))
+        conn.execute('PRAGMA %s = %s' % (name, value))
+    return previous
+
+
+def dropIndexes(conn, indexes):
+    '''Drops the indexes which createIndexes builds, so that they are not
+    updated row by row while loading into existing tables.'''
+    for table, column in indexes:
+        conn.execute('DROP INDEX IF EXISTS "idx_%s_%s"' % (table, column))
+
+
+def createIndexes(conn, indexes):
+    '''Builds an index on each (table, column) pair, reporting the time
+    each of them took.'''
+    for table, column in indexes:
+        start = D.datetime.now()
+        conn.execute('CREATE INDEX IF NOT EXISTS "idx_%s_%s" ON "%s" ("%s")' %
+                     (table, column, table, column))
+        conn.commit()
+        logTime('Created index on {}.{} in {:.2f}s'.format(
+            table, column, (D.datetime.now() - start).total_seconds()))
+
+
+def readCheckpoint(conn, target, inputName):
+    '''Returns the (offset, records) stored by the last commit of inputName
+    into target, or (0, 0) if there is none.'''
+    conn.execute('CREATE TABLE IF NOT EXISTS _checkpoints '
+                 '("target" TEXT, "input" TEXT, "offset" INTEGER, '
+                 '"records" INTEGER, "time" TEXT, PRIMARY KEY ("target", "input"))')
+    checkpoint = conn.execute('SELECT "offset", "records" FROM _checkpoints '
+                              'WHERE "target" = ? AND "input" = ?',
+                              (target, inputName)).fetchone()
+    return checkpoint if checkpoint is not None else (0, 0)
+
+
+def writeCheckpoint(conn, target, inputName, offset, records):
+    '''Commits, storing the input offset and the number of records read so
+    far in the same transaction.'''
+    conn.execute('INSERT OR REPLACE INTO _checkpoints VALUES (?, ?, ?, ?, ?)',
+                 (target, inputName, offset, records, str(D.datetime.now())))
+    conn.commit()
+    logTime('Committed {} records'.format(records))
+
+
+class Rejects(object):
+    '''Keeps the records which could not be loaded in the <table>_rejects
+    table, with their position in the input, the stage which failed (parse,
+    convert or insert), the error and the raw record. They are written in
+    batches, in the transaction of the load.
+
+    With fileColumn, the name of the input file is kept too, for the inputs
+    whose positions start again with every file.
+
+    Raises ValueError once more than maxErrors records have been rejected.'''
+
+    def __init__(self, table, position='line', maxErrors=None, batchSize=1000,
+                 fileColumn=False):
+        self.table = table + '_rejects'
+        self.position = position
+        self.fileColumn = fileColumn
+        self.maxErrors = maxErrors
+        self.batchSize = batchSize
+        self.pending = []
+        self.counts = {}
+
+    def create(self, cur):
+        cur.execute('CREATE TABLE IF NOT EXISTS %s ("%s" INTEGER, "stage" TEXT, '
+                    '"error" TEXT, "raw" TEXT)' % (self.table, self.position))
+        columns = [x[1] for x in cur.execute('PRAGMA table_info(%s)' % self.table).fetchall()]
+        if self.fileColumn and 'file' not in columns:
+            cur.execute('ALTER TABLE %s ADD COLUMN "file" TEXT' % self.table)
+
+    def add(self, cur, position, stage, error, raw, fileName=None):
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8', 'replace')
+        self.pending.append((position, stage, str(error), raw) +
+                            ((fileName,) if self.fileColumn else ()))
+        if len(self.pending) >= self.batchSize:
+            self.flush(cur)
+        self.merge({stage: 1})
+
+    def merge(self, counts):
+        '''Adds the counts by stage of records rejected elsewhere.'''
+        for stage, count in counts.items():
+            self.counts[stage] = self.counts.get(stage, 0) + count
+        if self.maxErrors is not None and self.total() > self.maxErrors:
+            raise ValueError('More than {} records rejected, see table {}'.format(
+                self.maxErrors, self.table))
+
+    def flush(self, cur):
+        if len(self.pending) > 0:
+            cur.executemany('INSERT INTO %s VALUES (?, ?, ?, ?%s)' % (
+                self.table, ', ?' if self.fileColumn else ''), self.pending)
+            self.pending = []
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def log(self):
+        if self.total() > 0:
+            logTime('Rejected {} records ({}), see table {}'.format(
+                self.total(),
+                ', '.join('{} {}'.format(self.counts[x], x) for x in sorted(self.counts)),
+                self.table))
+
+
+class BackgroundReader(object):
+    '''Reads the lines of a (compressed) file in a background thread.
+
+    The thread reads blocks of about blockSize bytes of lines ahead of the
+    consumer and hands them over through a queue of at most depth blocks, so
+    that decompression overlaps with parsing and inserting. Supports
+    readline(), iteration and tell().'''
+
+    def __init__(self, inputFile, depth, blockSize=1 << 20):
+        # Keep the file open after the thread has read it to the end.
+        self.inputFile = inputFile
+        self.queue = queue.Queue(depth)
+        self.depth = depth
+        self.eof = ''
+        self.lines, self.index = [], 0
+        self.finished = False
+        try:
+            self.position = inputFile.tell()
+        except (IOError, OSError, ValueError):
+            self.position = 0
+        self.blocks, self.totalDepth = 0, 0
+        self.consumerWaits, self.readerWaits = 0, 0
+        # A Progress which counts the time spent waiting for lines as read.
+        self.progress = None
+        thread = threading.Thread(target=self.readBlocks,
+                                  args=(inputFile, blockSize))
+        thread.daemon = True
+        thread.start()
+
+    def readBlocks(self, inputFile, blockSize):
+        try:
+            while True:
+                lines = inputFile.readlines(blockSize)
+                self.put(lines)
+                if len(lines) == 0:
+                    break
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.readerWaits += 1
+            self.queue.put(item)
+
+    def nextBlock(self):
+        if self.finished:
+            return False
+
+        try:
+            item = self.queue.get_nowait()
+        except queue.Empty:
+            self.consumerWaits += 1
+            if self.progress is not None:
+                self.progress.enter('read')
+            item = self.queue.get()
+            if self.progress is not None:
+                self.progress.leave()
+
+        if isinstance(item, Exception):
+            raise item
+
+        self.blocks += 1
+        self.totalDepth += self.queue.qsize()
+        self.lines, self.index = item, 0
+        self.finished = len(item) == 0
+        if not self.finished:
+            # readline returns an empty line of the same type at the end.
+            self.eof = item[0][:0]
+        return not self.finished
+
+    def readline(self):
+        if self.index == len(self.lines) and not self.nextBlock():
+            return self.eof
+
+        line = self.lines[self.index]
+        self.index += 1
+        self.position += len(line)
+        return line
+
+    def __iter__(self):
+        while self.index < len(self.lines) or self.nextBlock():
+            line = self.lines[self.index]
+            self.index += 1
+            self.position += len(line)
+            yield line
+
+    def tell(self):
+        return self.position
+
+    def report(self):
+        '''Logs how full the queue was. A nearly empty queue means that reading
+        is the bottleneck, a nearly full one that the import is.'''
+        logTime('Read {} blocks ahead: average queue depth {:.1f} of {}, '
+                'import waited {} times, reader waited {} times'.format(
+                    self.blocks, float(self.totalDepth) / max(self.blocks, 1),
+                    self.depth, self.consumerWaits, self.readerWaits))
+
+
+# A bz2 block starts with the 48 bit number pi and a stream ends with sqrt(pi),
+# both followed by a 32 bit CRC. Neither is aligned to a byte.
+BZ2_BLOCK_MAGIC = 0x314159265359
+BZ2_EOS_MAGIC = 0x177245385090
+BZ2_HEADER = 0x425a6839  # 'BZh9', the largest block size
+GZIP_MAGIC = b'\x1f\x8b\x08'
+
+
+def readBits(data, start, count):
+    '''Returns count bits of data from bit offset start as an integer.'''
+    first, last = start // 8, (start + count + 7) // 8
+    value = int(hexlify(data[first:last]), 16)
+    return (value >> (last * 8 - start - count)) & ((1 << count) - 1)
+
+
+def findBits(data, magic):
+    '''Returns the bit offsets of the 48 bit magic number in data which are
+    followed by at least 32 more bits of data.'''
+    found = []
+    for shift in range(8):
+        # The magic number shifted into a window of 7 bytes; the bytes it
+        # fills completely are searched for, the partial ones compared after.
+        window = magic << (8 - shift)
+        mask = ((1 << 48) - 1) << (8 - shift)
+        keyStart = 0 if shift == 0 else 1
+        key = unhexlify('%014x' % window)[keyStart:6]
+        index = data.find(key)
+        while index >= 0:
+            start = index - keyStart
+            if start >= 0 and start * 8 + shift + 80 <= len(data) * 8 and \
+                    int(hexlify(data[start:start + 7]), 16) & mask == window:
+                found.append(start * 8 + shift)
+            index = data.find(key, index + 1)
+    return sorted(found)
+
+
+def bz2Boundaries(fileName, windowSize=1 << 24):
+    '''Yields (bitOffset, isBlock, crc) for the start of every block and the
+    end of every stream of a bz2 file, in order.'''
+    with open(fileName, 'rb') as compressed:
+        base, data, last = 0, b'', -1
+        while True:
+            more = compressed.read(windowSize)
+            data += more
+            for bit, isBlock in sorted([(x, True) for x in findBits(data, BZ2_BLOCK_MAGIC)] +
+                                       [(x, False) for x in findBits(data, BZ2_EOS_MAGIC)]):
+                if base * 8 + bit > last:
+                    last = base * 8 + bit
+                    yield last, isBlock, readBits(data, bit + 48, 32)
+
+            if len(more) == 0:
+                break
+            # Keep the end, where a magic number may have been cut off.
+            base += len(data) - 16
+            data = data[-16:]
+
+
+def bz2Ranges(fileName, rangeSize):
+    '''Groups the blocks of a bz2 file into ranges of about rangeSize
+    compressed bytes, which do not cross the end of a stream.
+
+    Yields (startBit, endBit, crc), with the CRC of the stream which holds
+    only the blocks of the range.'''
+    start, crc = None, 0
+    for bit, isBlock, blockCRC in bz2Boundaries(fileName):
+        if start is not None and (not isBlock or bit - start >= rangeSize * 8):
+            yield start, bit, crc
+            start, crc = None, 0
+        if isBlock:
+            if start is None:
+                start = bit
+            crc = (((crc << 1) | (crc >> 31)) & 0xffffffff) ^ blockCRC
+    if start is not None:
+        raise IOError('Compressed file ended before the end of its data')
+
+
+def decompressBz2Range(fileName, startBit, endBit, crc):
+    '''Decompresses the blocks between two bit offsets of a bz2 file, by
+    wrapping them into a stream of their own.'''
+    with open(fileName, 'rb') as compressed:
+        compressed.seek(startBit // 8)
+        data = compressed.read((endBit + 7) // 8 - startBit // 8)
+    count = endBit - startBit
+    stream = (((BZ2_HEADER << count | readBits(data, startBit % 8, count)) << 48 |
+               BZ2_EOS_MAGIC) << 32) | crc
+    length = (32 + count + 80 + 7) // 8
+    stream <<= length * 8 - (32 + count + 80)
+    return bz2.decompress(unhexlify('%0*x' % (length * 2, stream)))
+
+
+def decompressBz2Sequential(fileName, skip=0, readSize=1 << 20):
+    '''Decompresses all the streams of a bz2 file one after the other, in
+    this process, leaving out the first skip bytes of the output.
+
+    Yields (data, compressedOffset) pairs.'''
+    with open(fileName, 'rb') as compressed:
+        decompressor = bz2.BZ2Decompressor()
+        data = compressed.read(readSize)
+        while len(data) > 0:
+            try:
+                output = decompressor.decompress(data)
+            except EOFError:
+                # The stream before ended with the data read before.
+                decompressor = bz2.BZ2Decompressor()
+                continue
+            if len(decompressor.unused_data) > 0:
+                data = decompressor.unused_data
+                decompressor = bz2.BZ2Decompressor()
+            else:
+                data = compressed.read(readSize)
+
+            if skip >= len(output):
+                skip -= len(output)
+                continue
+            yield output[skip:], compressed.tell() - len(data)
+            skip = 0
+
+
+def plausibleMember(data):
+    '''Tells whether data starts with a gzip member: the header flags must be
+    valid and the beginning must decompress.'''
+    if len(data) < 18 or ord(data[3:4]) & 0xe0:
+        return False
+    try:
+        zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data[:1 << 16])
+    except zlib.error:
+        return False
+    return True
+
+
+def gzipRanges(fileName, rangeSize, windowSize=1 << 20):
+    '''Splits a gzip file into ranges of about rangeSize bytes, at the first
+    plausible member header after each rangeSize bytes. Yields (start, end)
+    byte offsets; the end of the last range is None.'''
+    with open(fileName, 'rb') as compressed:
+        start = 0
+        while True:
+            position, end = start + rangeSize, None
+            while end is None:
+                compressed.seek(position)
+                data = compressed.read(windowSize + (1 << 16))
+                index = data.find(GZIP_MAGIC)
+                while 0 <= index < windowSize:
+                    if plausibleMember(data[index:]):
+                        end = position + index
+                        break
+                    index = data.find(GZIP_MAGIC, index + 1)
+                if len(data) <= windowSize:
+                    break
+                position += windowSize
+
+            yield start, end
+            if end is None:
+                break
+            start = end
+
+
+def decompressGzipRange(fileName, start, end):
+    '''Decompresses the gzip members between two byte offsets of a file.
+
+    Returns the data and whether the last member ended at the end of the
+    range, which it does not when the range was split at a false header.'''
+    with open(fileName, 'rb') as compressed:
+        compressed.seek(start)
+        data = compressed.read(-1 if end is None else end - start)
+
+    # A member which ends with the range leaves the extra byte unused.
+    data += b'\x00'
+    output = []
+    try:
+        while True:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            output.append(decompressor.decompress(data))
+            data = decompressor.unused_data
+            if len(data) == 0:
+                return b''.join(output), False
+            if len(data.strip(b'\x00')) == 0:
+                return b''.join(output), True
+    except zlib.error:
+        return None, False
+
+
+def decompressRange(task):
+    '''Decompresses a range of a bz2 or gzip file in a worker process.'''
+    fileName, kind, start, end, crc = task
+    if kind == 'bz2':
+        return decompressBz2Range(fileName, start, end, crc), True
+    return decompressGzipRange(fileName, start, end)
+
+
+class ParallelDecompressor(object):
+    '''Decompresses the blocks of a bz2 file or the members of a gzip file in
+    a pool of processes, in ranges of about rangeSize compressed bytes.
+
+    The decompressed ranges are put back together in order. Supports
+    readline(), readlines(), iteration, tell() and seeking forward, so that
+    it can also be used through a BackgroundReader. A gzip file with a single member is
+    decompressed by a single process.
+
+    The bz2 blocks are found by their magic numbers, which may also occur by
+    chance inside the compressed data. A false block start makes the blocks
+    around it fail to decompress, so when a range fails the rest of the file
+    is decompressed sequentially by this process instead, from the
+    beginning, leaving out what was already read.'''
+
+    def __init__(self, fileName, kind, processes, rangeSize=1 << 22):
+        self.fileName, self.kind, self.processes = fileName, kind, processes
+        self.pool = multiprocessing.Pool(processes)
+        if kind == 'bz2':
+            ranges = bz2Ranges(fileName, rangeSize)
+        else:
+            ranges = ((start, end, None)
+                      for start, end in gzipRanges(fileName, rangeSize))
+        self.chunks = self.decompressFile(ranges)
+        self.data, self.position = b'', 0
+        self.lines, self.index = [], 0
+        self.compressed = 0
+
+    def decompressFile(self, ranges):
+        '''Yields the decompressed ranges in order, falling back to sequential
+        decompression if a bz2 range fails.'''
+        emitted = 0
+        try:
+            for data in self.decompressRanges(ranges):
+                emitted += len(data)
+                yield data
+        except (IOError, OSError, ValueError, EOFError) as e:
+            if self.kind != 'bz2':
+                raise
+            logTime('Decompressing sequentially after a failed range: {}'.format(e))
+            # Only the ranges in flight are left to the pool; terminate() can
+            # deadlock on them in Python 2.
+            self.pool.close()
+            for data, compressed in decompressBz2Sequential(self.fileName, emitted):
+                self.compressed = compressed
+                yield data
+
+    def decompressRanges(self, ranges):
+        '''Yields the decompressed ranges in order, with at most
+        2 * processes ranges in flight.'''
+        pending = collections.deque()
+        exhausted = False
+        mergeStart = None
+        while True:
+            while not exhausted and len(pending) < 2 * self.processes:
+                nextRange = next(ranges, None)
+                if nextRange is None:
+                    exhausted = True
+                    break
+                task = (self.fileName, self.kind) + nextRange
+                pending.append((task, self.pool.apply_async(decompressRange, (task,))))
+
+            if len(pending) == 0:
+                break
+
+            task, result = pending.popleft()
+            _, _, start, end, _ = task
+            data, complete = result.get()
+            if mergeStart is not None:
+                # The range before was split at a false member header.
+                start, mergeStart = mergeStart, None
+                data, complete = decompressGzipRange(self.fileName, start, end)
+            if not complete:
+                if end is None:
+                    raise IOError('Compressed file ended before the end of its data')
+                mergeStart = start
+                continue
+
+            if end is None:
+                self.compressed = os.path.getsize(self.fileName)
+            else:
+                self.compressed = (end + 7) // 8 if self.kind == 'bz2' else end
+            yield data
+
+        self.pool.close()
+
+    def fill(self):
+        '''Appends the next decompressed range to the data, returning False
+        at the end of the file.'''
+        data = next(self.chunks, None)
+        if data is None:
+            return False
+        self.data += data
+        return True
+
+    def readlines(self, hint=-1):
+        '''Returns the complete lines of at least the next decompressed range.'''
+        if self.index < len(self.lines):
+            lines = self.lines[self.index:]
+            self.lines, self.index = [], 0
+            return lines
+
+        while True:
+            end = self.data.rfind(b'\n') + 1
+            if end > 0 or not self.fill():
+                break
+        if end == 0:
+            end = len(self.data)
+
+        lines = io.BytesIO(self.data[:end]).readlines()
+        self.data = self.data[end:]
+        self.position += end
+        return lines
+
+    def readline(self):
+        if self.index == len(self.lines):
+            self.lines, self.index = self.readlines(), 0
+            if len(self.lines) == 0:
+                return b''
+
+        line = self.lines[self.index]
+        self.index += 1
+        return line
+
+    def __iter__(self):
+        while True:
+            lines = self.readlines()
+            if len(lines) == 0:
+                break
+            for line in lines:
+                yield line
+
+    def seek(self, offset):
+        '''Skips forward to the uncompressed offset.'''
+        unread = b''.join(self.readlines()) if self.index < len(self.lines) else b''
+        self.data = unread + self.data
+        self.position -= len(unread)
+        while self.position + len(self.data) < offset:
+            self.position += len(self.data)
+            self.data = b''
+            if not self.fill():
+                return
+        self.data = self.data[max(offset - self.position, 0):]
+        self.position = max(offset, self.position)
+
+    def tell(self):
+        return self.position - sum(len(x) for x in self.lines[self.index:])
+
+    def compressedPosition(self):
+        '''Returns the compressed offset up to which the file has been
+        decompressed.'''
+        return self.compressed
+
+
+STAGES = ['read', 'parse', 'convert', 'insert', 'merge', 'other']
+
+
+class Progress(object):
+    '''Measures the throughput of a load and where its time goes.
+
+    The time is split between the stages entered with enter() or by
+    iterating through timed(); the stages nest, and the time outside of any
+    stage counts as other. Reading only counts the time spent waiting for a
+    BackgroundReader; otherwise it is part of parsing.
+
+    Every `every` seconds, count() logs the records per second, the bytes
+    per second of the uncompressed and the compressed input, how much of the
+    input has been consumed with an estimate of the time left, and the share
+    of each stage.'''
+
+    def __init__(self, every=30, totalBytes=None, tell=None, compressedTell=None,
+                 compressed=False):
+        self.every = every
+        # The share consumed of a compressed input is only known from the
+        # position in the compressed file.
+        self.totalBytes = totalBytes if compressedTell is not None or not compressed else None
+        self.tell, self.compressedTell = tell, compressedTell
+        self.records = 0
+        self.firstPosition = self.position(tell) or 0
+        self.firstCompressed = self.position(compressedTell) or 0
+        self.started = self.mark = self.logged = time.time()
+        self.stack = ['other']
+        self.stages = dict((x, 0.0) for x in STAGES)
+
+    def enter(self, stage):
+        now = time.time()
+        self.stages[self.stack[-1]] += now - self.mark
+        self.mark = now
+        self.stack.append(stage)
+
+    def leave(self):
+        now = time.time()
+        self.stages[self.stack.pop()] += now - self.mark
+        self.mark = now
+
+    def timed(self, iterable, stage):
+        '''Yields the items of iterable, counting the time taken to get them
+        as stage. Does what enter() and leave() do, inline, as it runs for
+        every record.'''
+        stages, stack, clock = self.stages, self.stack, time.time
+        iterator = iter(iterable)
+        while True:
+            now = clock()
+            stages[stack[-1]] += now - self.mark
+            self.mark = now
+            stack.append(stage)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                now = clock()
+                stages[stack.pop()] += now - self.mark
+                self.mark = now
+            yield item
+
+    def count(self):
+        self.records += 1
+        if self.every > 0 and self.records % 100 == 0 and \
+                time.time() - self.logged >= self.every:
+            self.log()
+
+    def position(self, tell):
+        try:
+            return tell() if tell is not None else None
+        except (IOError, OSError, ValueError):
+            return None
+
+    def stats(self):
+        '''Returns the statistics of this run so far as a dictionary. The
+        bytes are counted from where the run started.'''
+        now = time.time()
+        seconds = max(now - self.started, 1e-6)
+        stages = dict(self.stages)
+        stages[self.stack[-1]] += now - self.mark
+        stats = {
+            'records': self.records,
+            'seconds': seconds,
+            'records_per_second': self.records / seconds,
+            'stage_seconds': stages,
+        }
+        uncompressed = self.position(self.tell)
+        if uncompressed is not None:
+            stats['bytes'] = uncompressed - self.firstPosition
+            stats['bytes_per_second'] = stats['bytes'] / seconds
+        compressed = self.position(self.compressedTell)
+        if compressed is not None:
+            stats['compressed_bytes'] = compressed - self.firstCompressed
+            stats['compressed_bytes_per_second'] = stats['compressed_bytes'] / seconds
+
+        if self.compressedTell is not None:
+            consumed, rate = compressed, stats.get('compressed_bytes_per_second')
+        else:
+            consumed, rate = uncompressed, stats.get('bytes_per_second')
+        if consumed is not None and self.totalBytes:
+            stats['consumed'] = min(float(consumed) / self.totalBytes, 1.0)
+            if rate > 0:
+                stats['eta_seconds'] = max(self.totalBytes - consumed, 0) / rate
+        return stats
+
+    def log(self):
+        stats = self.stats()
+        parts = ['{} records ({:.0f}/s)'.format(stats['records'], stats['records_per_second'])]
+        if 'bytes' in stats:
+            parts.append('{:.1f} MB ({:.2f} MB/s)'.format(
+                stats['bytes'] / 1e6, stats['bytes_per_second'] / 1e6))
+        if 'compressed_bytes' in stats:
+            parts.append('{:.1f} MB compressed ({:.2f} MB/s)'.format(
+                stats['compressed_bytes'] / 1e6, stats['compressed_bytes_per_second'] / 1e6))
+        if 'consumed' in stats:
+            parts.append('{:.1f}% of the input'.format(100 * stats['consumed']))
+        if 'eta_seconds' in stats:
+            parts.append('ETA {}'.format(D.timedelta(seconds=int(stats['eta_seconds']))))
+        stages = stats['stage_seconds']
+        total = max(sum(stages.values()), 1e-6)
+        parts.append(' '.join('{} {:.0f}%'.format(x, 100 * stages[x] / total)
+                              for x in STAGES if stages[x] > 0))
+        logTime(', '.join(parts))
+        self.logged = time.time()
+
+    def write(self, fileName):
+        '''Writes the statistics as JSON.'''
+        with open(fileName, 'w') as statsFile:
+            json.dump(self.stats(), statsFile, indent=2, sort_keys=True)
+
+
+def compressedTell(inputFile):
+    '''Returns the tell function of the compressed file which inputFile
+    decompresses, or None if it is not exposed, as for bz2 in Python 2.'''
+    if isinstance(inputFile, ParallelDecompressor):
+        return inputFile.compressedPosition
+    rawFile = getattr(inputFile, 'fileobj', None) or getattr(inputFile, '_fp', None)
+    return rawFile.tell if rawFile is not None else None
+
+
+def inputSize(fileName):
+    '''Returns the size of the input file, or None for stdin.'''
+    try:
+        return os.path.getsize(fileName) if fileName != '-' else None
+    except OSError:
+        return None
+
+
+# The days since 1970-01-01 of each date parsed by epochSeconds.
+EPOCH_DAYS = {}
+
+
+def epochSeconds(text):
+    '''Returns the seconds since 1970-01-01 of a YYYY-MM-DD HH:MM:SS UTC
+    timestamp, which may use a T between the date and the time and end with
+    a fraction of a second or a Z.
+
+    The fields are read at their fixed positions rather than with strptime,
+    and the days of each date are only computed once.'''
+    if text[4:5] != '-' or text[7:8] != '-' or text[13:14] != ':' or text[16:17] != ':':
+        raise ValueError('Not a timestamp: {}'.format(text))
+    date = text[:10]
+    days = EPOCH_DAYS.get(date)
+    if days is None:
+        days = (D.date(int(text[0:4]), int(text[5:7]), int(text[8:10])) -
+                D.date(1970, 1, 1)).days
+        EPOCH_DAYS[date] = days
+    return days * 86400 + int(text[11:13]) * 3600 + int(text[14:16]) * 60 + int(text[17:19])
+
+
+def epochMilliseconds(text):
+    '''Returns the milliseconds since 1970-01-01 of a timestamp read by
+    epochSeconds.'''
+    fraction = text[20:23].rstrip('Z') if text[19:20] == '.' else ''
+    return epochSeconds(text) * 1000 + (int(fraction.ljust(3, '0')) if fraction else 0)
+
+
+def createTimeView(conn, table, columns, timeColumns, textFormat, unit):
+    '''(Re)creates the view <table>_decoded, which shows the rows of table
+    with the epoch timestamps of timeColumns as text in textFormat, a
+    strftime format.'''
+    if unit == 'ms':
+        textFormat = textFormat.replace('%S', '%f')
+    fields = []
+    for column in columns:
+        if column in timeColumns:
+            value = '"%s" / 1000.0' % column if unit == 'ms' else '"%s"' % column
+            fields.append("strftime('%s', %s, 'unixepoch') AS \"%s\"" % (textFormat, value, column))
+        else:
+            fields.append('"%s"' % column)
+    view = table + '_decoded'
+    conn.execute('DROP VIEW IF EXISTS %s' % view)
+    conn.execute('CREATE VIEW %s AS SELECT %s FROM %s' % (view, ', '.join(fields), table))
+    logTime('Created view {}'.format(view))
+
+
+def columnType(cur, table, column):
+    '''Returns the declared type of the column of table.'''
+    for x in cur.execute('PRAGMA table_info(%s)' % table).fetchall():
+        if x[1] == column:
+            return x[2].upper()
+    return None
+
+
+def writeShard(shardFile, tables, chunks, results, insertChunk, rejects):
+    '''Creates the (table, columns) tables and the rejects table in the shard
+    database and inserts the chunks taken from the chunks queue with
+    insertChunk(cur, chunk, rejects), until it gets None.
+
+    Puts the error which stopped the writer, or None, and the counts of
+    rejected records by stage into the results queue. After an error, the
+    remaining chunks are taken but not inserted.'''
+    failure = None
+    try:
+        conn = sqlite3.connect(shardFile)
+        applyPragmas(conn, SHARD_PRAGMAS)
+        conn.text_factory = str
+        cur = conn.cursor()
+        for table, columns in tables:
+            cur.execute('CREATE TABLE %s (%s)' % (table, columns))
+        rejects.create(cur)
+    except Exception as e:
+        failure = '%s: %s' % (shardFile, e)
+
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            break
+        if failure is not None:
+            continue
+
+        try:
+            insertChunk(cur, chunk, rejects)
+        except Exception as e:
+            failure = '%s: %s' % (shardFile, e)
+
+    if failure is None:
+        try:
+            rejects.flush(cur)
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            failure = '%s: %s' % (shardFile, e)
+    results.put((failure, rejects.counts))
+
+
+def checkWriters(writers, exitcodes):
+    '''Raises RuntimeError if one of the writer processes, whose exit codes
+    were exitcodes, crashed or was killed, or if all of them are gone.'''
+    for writer, exitcode in zip(writers, exitcodes):
+        if exitcode not in (None, 0):
+            raise RuntimeError('The shard writer %s exited with code %d' % (writer.name, exitcode))
+    if all(exitcode is not None for exitcode in exitcodes):
+        raise RuntimeError('The shard writers exited without reporting')
+
+
+def writeShards(shardFiles, chunks, tables, insertChunk, rejects, progress=None):
+    '''Inserts the (first, lines, records) chunks into the tables of the
+    shard databases, each written by a process of its own, which take the
+    chunks from a common queue. The records rejected by the writers are
+    counted in rejects.
+
+    Raises ValueError if a writer failed, and RuntimeError if a writer died,
+    rather than waiting on it forever.'''
+    queued = multiprocessing.Queue(2 * len(shardFiles))
+    results = multiprocessing.Queue()
+    writers = [multiprocessing.Process(target=writeShard,
+                                       args=(shardFile, tables, queued, results,
+                                             insertChunk, rejects))
+               for shardFile in shardFiles]
+    for writer in writers:
+        writer.daemon = True
+        writer.start()
+
+    def put(chunk):
+        while True:
+            exitcodes = [writer.exitcode for writer in writers]
+            try:
+                queued.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                checkWriters(writers, exitcodes)
+
+    for chunk in chunks:
+        if progress is not None:
+            for _ in range(chunk[2]):
+                progress.count()
+        put(chunk)
+    for writer in writers:
+        put(None)
+
+    # The exit codes are read before waiting, so that a writer which reported
+    # and then exited has its outcome in results already.
+    outcomes = []
+    while len(outcomes) < len(writers):
+        exitcodes = [writer.exitcode for writer in writers]
+        try:
+            outcomes.append(results.get(timeout=1))
+        except queue.Empty:
+            checkWriters(writers, exitcodes)
+    for writer in writers:
+        writer.join()
+
+    failures = [failure for failure, _ in outcomes if failure is not None]
+    if len(failures) > 0:
+        raise ValueError(failures[0])
+    for _, counts in outcomes:
+        rejects.merge(counts)
+
+
+def mergeShards(cur, tableNames, shardNames):
+    '''Copies the rows of the tables in the attached shard databases into the
+    tables of the main database.'''
+    for shardName in shardNames:
+        rows = 0
+        for table in tableNames:
+            cur.execute('INSERT INTO main.%s SELECT * FROM %s.%s' % (
+                table, shardName, table))
+            rows += cur.rowcount
+        logTime('Merged {} rows from shard {}'.format(rows, shardName))
+
+
 argParser = argparse.ArgumentParser()
 argParser.add_argument('inputFile',
         help='The file to read quotes from.')
@@ -23,6 +955,76 @@ argParser.add_argument('--min-date',
         help='Discard all timestamps below this date (ISO-8601 format).',
         default='')
 
+argParser.add_argument('--fast-load',
+        help='Apply a pragma profile for bulk loading (in-memory journal, '
+             'no syncing, large cache, exclusive lock) while inserting. '
+             'The previous settings are restored after the commit.',
+        action='store_true')
+argParser.add_argument('--pragma',
+        help='Set a pragma while loading, given as NAME=VALUE, e.g. '
+             'synchronous=FULL. Overrides the --fast-load profile. '
+             'May be repeated.',
+        action='append',
+        default=[])
+argParser.add_argument('--index',
+        help='Build an index on TABLE.COLUMN after all rows have been '
+             'loaded. May be repeated.',
+        action='append',
+        default=[])
+argParser.add_argument('--no-default-indexes',
+        help='Do not build the default indexes of this script.',
+        action='store_true')
+argParser.add_argument('--commit-every',
+        help='Commit after every N blocks, storing the input offset reached '
+             'so that the load can be continued with --resume.',
+        type=int,
+        default=0)
+argParser.add_argument('--resume',
+        help='Continue after the last commit of an earlier run with '
+             '--commit-every on the same input.',
+        action='store_true')
+argParser.add_argument('--read-ahead',
+        help='Number of blocks of about 1 MB of lines which a background '
+             'thread decompresses ahead of the import, with --gzip or --bz2. '
+             '0 decompresses inline.',
+        type=int,
+        default=16)
+argParser.add_argument('--decompress-workers',
+        help='Number of processes which decompress the input, with --bz2 '
+             'or --gzip. The blocks of bz2 files and the members of '
+             'concatenated gzip files are decompressed in parallel.',
+        type=int,
+        default=0)
+argParser.add_argument('--shards',
+        help='Number of processes which parse and insert the blocks into '
+             'shard databases of their own next to the database, which are '
+             'merged into it at the end with ATTACH and INSERT ... SELECT. '
+             'Cannot be combined with --commit-every or --resume.',
+        type=int,
+        default=0)
+argParser.add_argument('--epoch',
+        help='Store the timestamps as integer seconds (s) or milliseconds '
+             '(ms) since 1970-01-01 UTC rather than as text, and add the '
+             'view <table>_decoded which shows them as text.',
+        choices=['s', 'ms'],
+        default=None)
+argParser.add_argument('--max-errors',
+        help='Stop the load, rolling back to the last commit, once more than '
+             'N blocks have been rejected. The rejected blocks are kept in '
+             'the table <table_prefix>_rejects. By default, the load goes on '
+             'however many blocks are rejected.',
+        type=int,
+        default=None)
+argParser.add_argument('--progress',
+        help='Log the throughput, the share of the input consumed and where '
+             'the time goes every N seconds. 0 only logs them at the end.',
+        type=int,
+        default=30)
+argParser.add_argument('--stats',
+        help='Write the throughput and timing statistics of the load to this '
+             'file as JSON at the end.',
+        default=None)
+
 group = argParser.add_mutually_exclusive_group()
 group.add_argument('--gzip',
         help='Assume file uses the gzip compression.',
@@ -32,28 +1034,39 @@ group.add_argument('--bz2',
         action='store_true')
 
 args = argParser.parse_args()
+if args.shards > 0 and (args.commit_every > 0 or args.resume):
+    argParser.error('--shards cannot be combined with --commit-every or --resume')
 
 inputFile = None
-if args.bz2:
+if (args.bz2 or args.gzip) and args.decompress_workers > 0:
+    inputFile = ParallelDecompressor(args.inputFile, 'bz2' if args.bz2 else 'gzip',
+                                     args.decompress_workers)
+elif args.bz2:
     inputFile = bz2.BZ2File(args.inputFile, 'rU')
 elif args.gzip:
     inputFile = gzip.open(args.inputFile, 'rU')
 else:
     inputFile = open(args.inputFile, 'rU')
+rawTell = compressedTell(inputFile)
 
 minDate = args.min_date
 
 conn = sqlite3.connect(args.sqlitedb)
+previousPragmas = applyPragmas(conn, loadPragmas(args.fast_load, args.pragma))
 # Always return bytestrings
 conn.text_factory = str
 cur = conn.cursor()
 
 table_prefix = args.table_prefix
 
+# With --epoch, the timestamps are numbers.
+timeType = 'INTEGER' if args.epoch else 'TEXT'
+toEpoch = epochMilliseconds if args.epoch == 'ms' else epochSeconds
+
 table_revisions = table_prefix + '_revision'
 columns_revision = ('"article_id" INTEGER, "rev_id" INTEGER, '
-                    '"article_title" TEXT, "timestamp" TEXT, '
-                    '"username" TEXT, "user_id" TEXT')
+                    '"article_title" TEXT, "timestamp" %s, '
+                    '"username" TEXT, "user_id" TEXT' % timeType)
 insert_revision = 'INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?)' % (table_revisions,)
 
 table_category = table_prefix + '_category'
@@ -103,21 +1116,21 @@ insert_minor = 'INSERT INTO %s VALUES (?, ?)' % (table_minor,)
 table_textdata = table_prefix + '_textdata'
 columns_textdata = ('"rev_id" INTEGER, "TEXTDATA" TEXT')
 insert_textdata = 'INSERT INTO %s VALUES (?, ?)' % (table_textdata,)
+tables = [(table_revisions, columns_revision),
+          (table_category, columns_category),
+          (table_image, columns_image),
+          (table_main, columns_main),
+          (table_talk, columns_talk),
+          (table_user, columns_user),
+          (table_user_talk, columns_user_talk),
+          (table_other, columns_other),
+          (table_external, columns_external),
+          (table_template, columns_template),
+          (table_comment, columns_comment),
+          (table_minor, columns_minor),
+          (table_textdata, columns_textdata)]
 
-
-for table, columns in [(table_revisions, columns_revision),
-                       (table_category, columns_category),
-                       (table_image, columns_image),
-                       (table_main, columns_main),
-                       (table_talk, columns_talk),
-                       (table_user, columns_user),
-                       (table_user_talk, columns_user_talk),
-                       (table_other, columns_other),
-                       (table_external, columns_external),
-                       (table_template, columns_template),
-                       (table_comment, columns_comment),
-                       (table_minor, columns_minor),
-                       (table_textdata, columns_textdata)]:
+for table, columns in tables:
     try:
         create_query = 'CREATE TABLE %s (%s)' % (table, columns)
         cur.execute(create_query)
@@ -125,13 +1138,64 @@ for table, columns in [(table_revisions, columns_revision),
     except:
         logTime('Skipping creation of table {}'.format(table))
 
+if columnType(cur, table_revisions, 'timestamp') != timeType:
+    argParser.error('The table {} was created {} --epoch'.format(
+        table_revisions, 'without' if args.epoch else 'with'))
+
+rejects = Rejects(table_prefix, position='block', maxErrors=args.max_errors)
+rejects.create(cur)
+
+default_indexes = [(table_revisions, 'rev_id'),
+                   (table_revisions, 'article_id'),
+                   (table_category, 'rev_id'),
+                   (table_image, 'rev_id'),
+                   (table_main, 'rev_id'),
+                   (table_talk, 'rev_id'),
+                   (table_user, 'rev_id'),
+                   (table_user_talk, 'rev_id'),
+                   (table_other, 'rev_id'),
+                   (table_external, 'rev_id'),
+                   (table_template, 'rev_id'),
+                   (table_comment, 'rev_id'),
+                   (table_minor, 'rev_id'),
+                   (table_textdata, 'rev_id')]
+indexes = ([] if args.no_default_indexes else default_indexes) + \
+          [tuple(x.split('.', 1)) for x in args.index]
+dropIndexes(conn, indexes)
+
+shardFiles = ['%s.shard%d' % (args.sqlitedb, x) for x in range(args.shards)]
+shardNames = ['shard%d' % x for x in range(args.shards)]
+for shardFile in shardFiles:
+    if os.path.exists(shardFile):
+        os.remove(shardFile)
+attached = []
+
+checkpointing = args.commit_every > 0 or args.resume
+offset, records = 0, 0
+if checkpointing:
+    lastCheckpoint = readCheckpoint(conn, args.table_prefix, args.inputFile)
+    if args.resume:
+        offset, records = lastCheckpoint
+        inputFile.seek(offset)
+        logTime('Resuming after block {}'.format(records))
+
+if (args.bz2 or args.gzip) and args.read_ahead > 0:
+    inputFile = BackgroundReader(inputFile, args.read_ahead)
+
+progress = Progress(args.progress, inputSize(args.inputFile), inputFile.tell, rawTell,
+                    compressed=args.bz2 or args.gzip)
+if isinstance(inputFile, BackgroundReader):
+    inputFile.progress = progress
+
 
 def assertType(lineType, kind, blockNum):
-    assert lineType == kind, '{} line corrupt in {}'.find(kind, blockNum)
+    assert lineType == kind, '{} line corrupt in {}'.format(kind, blockNum)
 
 
-def getLineDataOfKind(inputFile, kind, blockNum):
-    line = inputFile.readline().strip()
+def getLineDataOfKind(inputFile, kind, blockNum, lines):
+    line = inputFile.readline()
+    lines.append(line)
+    line = line.strip()
     if line == '':
         return None
     data = line.split(' ')
@@ -140,14 +1204,19 @@ def getLineDataOfKind(inputFile, kind, blockNum):
 
 
 def blockReader(inputFile):
-    '''Read one wikipedia metadata block from the passed file.'''
+    '''Read one wikipedia metadata block from the passed file.
+
+    The lines of the block are kept in its 'lines'. A malformed block is
+    skipped up to the empty line which ends it, and yielded as a dict with
+    its 'error' and its 'raw' lines instead.'''
     blockNum = 0
     while True:
+        lines = []
         try:
             blockNum += 1
-            block = {}
+            block = {'lines': lines}
 
-            revisionData = getLineDataOfKind(inputFile, 'REVISION', blockNum)
+            revisionData = getLineDataOfKind(inputFile, 'REVISION', blockNum, lines)
             if revisionData is None:
                 # The first block line was empty, finish reading
                 break
@@ -161,74 +1230,170 @@ def blockReader(inputFile):
                     'user_id': revisionData[5]
             }
 
-            block['CATEGORY'] = getLineDataOfKind(inputFile, 'CATEGORY', blockNum)
-            block['IMAGE'] = getLineDataOfKind(inputFile, 'IMAGE', blockNum)
-            block['MAIN'] = getLineDataOfKind(inputFile, 'MAIN', blockNum)
-            block['TALK'] = getLineDataOfKind(inputFile, 'TALK', blockNum)
-            block['USER'] = getLineDataOfKind(inputFile, 'USER', blockNum)
-            block['USER_TALK'] = getLineDataOfKind(inputFile, 'USER_TALK', blockNum)
-            block['OTHER'] = getLineDataOfKind(inputFile, 'OTHER', blockNum)
-            block['EXTERNAL'] = getLineDataOfKind(inputFile, 'EXTERNAL', blockNum)
-            block['TEMPLATE'] = getLineDataOfKind(inputFile, 'TEMPLATE', blockNum)
-            block['COMMENT'] = ' '.join(getLineDataOfKind(inputFile, 'COMMENT', blockNum))
-            block['MINOR'] = int(getLineDataOfKind(inputFile, 'MINOR', blockNum)[0])
-            block['TEXTDATA'] = int(getLineDataOfKind(inputFile, 'TEXTDATA', blockNum)[0])
+            block['CATEGORY'] = getLineDataOfKind(inputFile, 'CATEGORY', blockNum, lines)
+            block['IMAGE'] = getLineDataOfKind(inputFile, 'IMAGE', blockNum, lines)
+            block['MAIN'] = getLineDataOfKind(inputFile, 'MAIN', blockNum, lines)
+            block['TALK'] = getLineDataOfKind(inputFile, 'TALK', blockNum, lines)
+            block['USER'] = getLineDataOfKind(inputFile, 'USER', blockNum, lines)
+            block['USER_TALK'] = getLineDataOfKind(inputFile, 'USER_TALK', blockNum, lines)
+            block['OTHER'] = getLineDataOfKind(inputFile, 'OTHER', blockNum, lines)
+            block['EXTERNAL'] = getLineDataOfKind(inputFile, 'EXTERNAL', blockNum, lines)
+            block['TEMPLATE'] = getLineDataOfKind(inputFile, 'TEMPLATE', blockNum, lines)
+            block['COMMENT'] = ' '.join(getLineDataOfKind(inputFile, 'COMMENT', blockNum, lines))
+            block['MINOR'] = int(getLineDataOfKind(inputFile, 'MINOR', blockNum, lines)[0])
+            block['TEXTDATA'] = int(getLineDataOfKind(inputFile, 'TEXTDATA', blockNum, lines)[0])
 
             emptyLine = inputFile.readline()
-            assert emptyLine == '\n', 'No empty line after block {}'.format(blockNum)
+            lines.append(emptyLine)
+            assert emptyLine in ('\n', ''), 'No empty line after block {}'.format(blockNum)
 
             yield block
         except Exception, e:
-            print('Encountered error: ', e)
-            print('In block: ', blockNum)
-            break
+            line = lines[-1]
+            while line != '' and line != '\n':
+                line = inputFile.readline()
+                lines.append(line)
+            yield {'error': str(e), 'raw': ''.join(lines)}
 
 def insertWithRevId(cur, insert_statement, dataList, revId):
     cur.executemany(insert_statement, ((revId, x) for x in dataList))
 
+
+def insertBlock(cur, block):
+    '''Inserts the revision of the block and the links it lists.'''
+    revData = block['REVISION']
+    revId = revData['rev_id']
+    timestamp = toEpoch(revData['timestamp']) if args.epoch else revData['timestamp']
+    cur.execute(insert_revision,
+            (revData['article_id'], revData['rev_id'],
+             revData['article_title'], timestamp,
+             revData['username'], revData['user_id']))
+
+    insertWithRevId(cur, insert_category, block['CATEGORY'], revId)
+    insertWithRevId(cur, insert_image, block['IMAGE'], revId)
+    insertWithRevId(cur, insert_main, block['MAIN'], revId)
+    insertWithRevId(cur, insert_talk, block['TALK'], revId)
+    insertWithRevId(cur, insert_user, block['USER'], revId)
+    insertWithRevId(cur, insert_user_talk, block['USER_TALK'], revId)
+    insertWithRevId(cur, insert_other, block['OTHER'], revId)
+    insertWithRevId(cur, insert_external, block['EXTERNAL'], revId)
+    insertWithRevId(cur, insert_template, block['TEMPLATE'], revId)
+
+    cur.execute(insert_comment, (revId, block['COMMENT']))
+    cur.execute(insert_minor, (revId, block['MINOR']))
+    cur.execute(insert_textdata, (revId, block['TEXTDATA']))
+
+
+def blockChunks(inputFile, chunkSize=1000):
+    '''Groups the lines of the file into (firstBlock, lines, blocks) chunks
+    of chunkSize blocks, each ending with the empty line after a block.'''
+    firstBlock, lines, blocks = 1, [], 0
+    for text in iter(inputFile.readline, ''):
+        lines.append(text)
+        if text == '\n':
+            blocks += 1
+            if blocks == chunkSize:
+                yield firstBlock, lines, blocks
+                firstBlock, lines, blocks = firstBlock + blocks, [], 0
+    if len(lines) > 0:
+        yield firstBlock, lines, blocks
+
+
+def insertBlocks(cur, chunk, rejects):
+    '''Inserts the blocks of a (firstBlock, lines, blocks) chunk which are
+    newer than --min-date.'''
+    blockNum, lines, _ = chunk
+    for block in blockReader(io.BytesIO(''.join(lines))):
+        if 'error' in block:
+            rejects.add(cur, blockNum, 'parse', block['error'], block['raw'])
+        elif block['REVISION']['timestamp'] > minDate:
+            try:
+                insertBlock(cur, block)
+            except Exception, e:
+                rejects.add(cur, blockNum, 'insert', e, ''.join(block['lines']))
+        blockNum += 1
+
+
+blockNum = records
+
+progress.enter('insert')
 try:
     blockCounter = 0
-    for block in blockReader(inputFile):
+    if args.shards > 0:
+        logTime('Writing {} shards'.format(args.shards))
+        writeShards(shardFiles, blockChunks(inputFile), tables, insertBlocks, rejects,
+                    progress)
+        # The shards are attached once written, as this connection could
+        # keep them locked otherwise.
+        for shardFile, shardName in zip(shardFiles, shardNames):
+            conn.execute('ATTACH DATABASE ? AS %s' % shardName, (shardFile,))
+            attached.append(shardName)
+        progress.enter('merge')
+        mergeShards(cur, [table for table, _ in tables] + [rejects.table], shardNames)
+        progress.leave()
+        blocks = []
+    else:
+        blocks = progress.timed(blockReader(inputFile), 'parse')
+
+    for block in blocks:
+        blockNum += 1
+        progress.count()
+        if 'error' in block:
+            rejects.add(cur, blockNum, 'parse', block['error'], block['raw'])
+            continue
+
         # Only count this block if the timestamp is greater than the
         # minimum data passed.
         if block['REVISION']['timestamp'] > minDate:
             blockCounter += 1
 
             try:
-                revData = block['REVISION']
-                revId = revData['rev_id']
-                cur.execute(insert_revision,
-                        (revData['article_id'], revData['rev_id'],
-                         revData['article_title'], revData['timestamp'],
-                         revData['username'], revData['user_id']))
-
-                insertWithRevId(cur, insert_category, block['CATEGORY'], revId)
-                insertWithRevId(cur, insert_image, block['IMAGE'], revId)
-                insertWithRevId(cur, insert_main, block['MAIN'], revId)
-                insertWithRevId(cur, insert_talk, block['TALK'], revId)
-                insertWithRevId(cur, insert_user, block['USER'], revId)
-                insertWithRevId(cur, insert_user_talk, block['USER_TALK'], revId)
-                insertWithRevId(cur, insert_other, block['OTHER'], revId)
-                insertWithRevId(cur, insert_external, block['EXTERNAL'], revId)
-                insertWithRevId(cur, insert_template, block['TEMPLATE'], revId)
-
-                cur.execute(insert_comment, (revId, block['COMMENT']))
-                cur.execute(insert_minor, (revId, block['MINOR']))
-                cur.execute(insert_textdata, (revId, block['TEXTDATA']))
+                insertBlock(cur, block)
             except Exception, e:
-                print("Error in block %d: %s" % (blockCounter, e), file=sys.stderr)
+                rejects.add(cur, blockNum, 'insert', e, ''.join(block['lines']))
 
             if blockCounter % 100000 == 0:
                 logTime('{} records processed'.format(blockCounter))
 
+        if args.commit_every > 0 and blockNum % args.commit_every == 0:
+            rejects.flush(cur)
+            writeCheckpoint(conn, args.table_prefix, args.inputFile, inputFile.tell(), blockNum)
+
 except Exception, e:
     print('General error on line %d: %s' % (blockCounter, e), file=sys.stderr)
     logTime('Rolling back changes')
     conn.rollback()
     cur.close()
 else:
+    rejects.flush(cur)
+    rejects.log()
     logTime('Committing to disk')
-    conn.commit()
+    if checkpointing:
+        writeCheckpoint(conn, args.table_prefix, args.inputFile, inputFile.tell(), blockNum)
+    else:
+        conn.commit()
     cur.close()
+    if args.epoch:
+        createTimeView(conn, table_revisions,
+                       ['article_id', 'rev_id', 'article_title', 'timestamp',
+                        'username', 'user_id'],
+                       ['timestamp'], '%Y-%m-%dT%H:%M:%SZ', args.epoch)
+
+progress.leave()
+progress.log()
+if isinstance(inputFile, BackgroundReader):
+    inputFile.report()
+
+for shardName in attached:
+    conn.execute('DETACH DATABASE %s' % shardName)
+for shardFile in shardFiles:
+    if os.path.exists(shardFile):
+        os.remove(shardFile)
+
+createIndexes(conn, indexes)
+applyPragmas(conn, previousPragmas)
+
+if args.stats is not None:
+    progress.write(args.stats)
 
 logTime('Finished')